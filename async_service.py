@@ -0,0 +1,353 @@
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response
+import download_cache
+import face_registry
+import facefusion_pool
+import http_client
+import in_memory_pipeline
+import jobs
+import metrics
+import result_cache
+import scheduler
+import tracing
+import service
+import single_image
+import workspace
+
+try:
+    import aiohttp
+    from aiohttp import web
+    session_key = web.AppKey("session", aiohttp.ClientSession) if hasattr(web, "AppKey") else "session"
+except ImportError:
+    aiohttp = None
+
+# asyncio serving mode of the consolidated service (see service.py), same ports and routes.
+# Connections are accepted on event loops, and the single-image swap routes run natively on
+# them with the same steps as the Flask views (see single_image.py): inputs download through
+# aiohttp into the download cache, S3 uploads are awaited through their transfer futures, the
+# FaceFusion work is handed to a small executor sized to the worker pool and file and index
+# work to the blocking executor. A request waiting on the network therefore holds no thread, so a
+# few loops keep hundreds of connections open. All other routes (two-pass, video, multiple
+# image, jobs, stats) are served by the unchanged Flask views on a bounded thread pool, except
+# the job event streams, which are written to the client event by event.
+#
+#   pip install aiohttp
+#   python3 async_service.py
+
+loop_threads = int(os.getenv("ASYNC_LOOP_THREADS", "1"))
+inference_threads = int(os.getenv("ASYNC_INFERENCE_THREADS", str(facefusion_pool.pool_size or max(1, (os.cpu_count() or 4) // 4))))
+blocking_threads = int(os.getenv("ASYNC_BLOCKING_THREADS", "32"))
+connections_per_host = int(os.getenv("ASYNC_HTTP_CONNECTIONS_PER_HOST", "64"))
+max_body_bytes = int(os.getenv("ASYNC_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+
+# Same JSON layout as Flask's jsonify, so both modes answer byte for byte alike
+_dumps = functools.partial(json.dumps, sort_keys=True, separators=(",", ":"))
+
+# Routes of the scripts that swap one source onto one target, served natively
+single_image_routes = {
+    "image-swap-api": {"route": "/faceswap"},
+    "new-api-v3": {"route": "/faceswap"},
+    "new-api-v4": {"route": "/single-image-faceswap", "check_gender": True}
+}
+
+# FaceFusion runs (worker pool or subprocess) and face analysis
+inference_executor = ThreadPoolExecutor(max_workers=inference_threads, thread_name_prefix="inference")
+# Flask views, file hashing and waits on identical in-flight requests
+blocking_executor = ThreadPoolExecutor(max_workers=blocking_threads, thread_name_prefix="blocking")
+
+
+def _run_in(executor, function, *args):
+    return asyncio.get_running_loop().run_in_executor(executor, tracing.bind(function), *args)
+
+
+# Function to run a request's downloads concurrently under one total deadline; tasks maps a
+# name to a coroutine. Returns the same names mapped to each result, or None for tasks that
+# failed or didn't finish in time (the same contract as http_client.gather).
+async def gather(tasks, deadline_seconds=None):
+    futures = {name: asyncio.ensure_future(task) for name, task in tasks.items()}
+    await asyncio.wait(futures.values(), timeout=deadline_seconds or http_client.download_deadline)
+
+    results = {}
+    for name, future in futures.items():
+        if not future.done():
+            future.cancel()
+            print(f"Error downloading {name}: Download deadline exceeded")
+            results[name] = None
+        elif future.exception() is not None:
+            print(f"Error downloading {name}: {future.exception()}")
+            results[name] = None
+        else:
+            results[name] = future.result()
+    return results
+
+
+# Function to download a URL into memory; returns the body or None when the server didn't answer 200
+async def fetch_bytes(session, url, max_bytes=None):
+    started = time.perf_counter()
+    body = None
+    try:
+        with tracing.span("download", bind_thread=False, url=tracing.safe_url(url), path="memory") as download_span:
+            body = await _fetch_bytes(session, url, max_bytes)
+            download_span.set(ok=body is not None, bytes=len(body) if body is not None else 0)
+        return body
+    finally:
+        metrics.observe_download("memory", started, body is not None)
+
+
+async def _fetch_bytes(session, url, max_bytes):
+    async with session.get(url) as response:
+        if response.status != 200:
+            return None
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(1024 * 1024):
+            body += chunk
+            if max_bytes and len(body) > max_bytes:
+                raise Exception(f"Download of {url} is larger than {max_bytes} bytes")
+        metrics.downloaded_bytes.inc(len(body), source="network")
+        return bytes(body)
+
+
+# Function to get the local source image for a request (see face_registry.resolve_source)
+async def resolve_source(session, source_url, face_id, file_path):
+    if face_id:
+        return await _run_in(blocking_executor, face_registry.resolve_source, source_url, face_id, file_path, None)
+
+    if not await download_cache.fetch_async(session, source_url, file_path):
+        return None
+    return file_path
+
+
+# Async form of result_cache.coalesce. Entering may wait for an identical request that is
+# still running, so it happens off the loop; if this request is cancelled meanwhile, the
+# in-flight slot it may have taken is released as soon as the wait returns.
+@contextlib.asynccontextmanager
+async def coalesce(key):
+    coalescing = result_cache.coalesce(key)
+    entering = _run_in(blocking_executor, coalescing.__enter__)
+    try:
+        result = await asyncio.shield(entering)
+    except asyncio.CancelledError:
+        def release(future):
+            if future.exception() is None:
+                coalescing.__exit__(None, None, None)
+        entering.add_done_callback(release)
+        raise
+    try:
+        yield result
+    finally:
+        coalescing.__exit__(None, None, None)
+
+
+# Function to run a single-image swap the way single_image.swap() does, with its network waits
+# awaited on the loop and every other step on the executors; returns (body, status code)
+async def swap_single_image(session, module, path, data, check_gender=False):
+    request_workspace = workspace.Workspace()
+    try:
+        job = single_image.SingleImageSwap(data, path, module.build_command, module.s3_bucket_name, request_workspace)
+        invalid = await _run_in(blocking_executor, job.invalid, check_gender)
+        if invalid:
+            return invalid
+
+        if await _run_in(blocking_executor, job.in_memory):
+            answered = await swap_in_memory(session, job)
+            if answered:
+                return answered
+        return await swap_files(session, job)
+    except Exception as e:
+        return single_image.error_response(e)
+    finally:
+        await _run_in(blocking_executor, request_workspace.cleanup)
+
+
+# Function to swap one image in memory; returns (body, status code), or None when the request
+# should take the disk path instead
+async def swap_in_memory(session, job):
+    job.lap()
+    source_path = await _run_in(blocking_executor, job.registered_source_path)
+    if source_path:
+        source_task = _run_in(blocking_executor, in_memory_pipeline.read_file, source_path)
+    else:
+        source_task = fetch_bytes(session, job.source_url, in_memory_pipeline.max_image_bytes)
+    downloads = await gather({
+        "source": source_task,
+        "target": fetch_bytes(session, job.target_url, in_memory_pipeline.max_image_bytes)
+    })
+    answered = await _run_in(blocking_executor, job.check_bytes, downloads["source"], downloads["target"])
+    if answered:
+        return answered
+
+    async with coalesce(job.result_key) as result:
+        if result.body:
+            return result.body, 200
+        try:
+            await _run_in(inference_executor, job.swap_bytes)
+        except facefusion_pool.WorkerError as e:
+            print(f"In-memory swap unavailable, using the disk path: {e}")
+            return None
+        output_s3_url = await asyncio.wrap_future(job.upload_bytes())
+        return await _run_in(blocking_executor, result.store, job.in_memory_body(output_s3_url)), 200
+
+
+async def swap_files(session, job):
+    downloads = await gather({
+        "source": resolve_source(session, job.source_url, job.face_id, job.source_path),
+        "target": download_cache.fetch_async(session, job.target_url, job.target_path)
+    })
+    answered = await _run_in(blocking_executor, job.check_files, downloads["source"], downloads["target"])
+    if answered:
+        return answered
+    await _run_in(blocking_executor, job.register_source)
+
+    async with coalesce(job.result_key) as result:
+        if result.body:
+            return result.body, 200
+        await _run_in(inference_executor, job.run)
+        output_s3_url = await asyncio.wrap_future(job.upload_file())
+        return await _run_in(blocking_executor, result.store, job.body(output_s3_url)), 200
+
+
+# Function to serve a request with a Flask app on the blocking executor
+async def call_flask(flask_app, request):
+    body = await request.read()
+    environ = EnvironBuilder(
+        path=request.path,
+        method=request.method,
+        query_string=request.query_string,
+        headers=list(request.headers.items()),
+        data=body
+    ).get_environ()
+    environ["REMOTE_ADDR"] = request.remote or ""
+    response = await _run_in(blocking_executor, Response.from_app, flask_app, environ)
+    headers = [(name, value) for name, value in response.headers.items() if name.lower() != "content-length"]
+    return web.Response(body=response.get_data(), status=response.status_code, headers=headers)
+
+
+# Function to stream a job's server-sent events; the Flask path would buffer the whole stream
+async def job_events_handler(request):
+    job_id = request.match_info["job_id"]
+    if not jobs.get_job(job_id):
+        return web.json_response({"error": "Job not found"}, status=404, dumps=_dumps)
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+    events = jobs.events(job_id)
+    try:
+        # Each wait for the next event holds a blocking thread for at most JOB_EVENTS_KEEPALIVE
+        while True:
+            event = await _run_in(blocking_executor, next, events, None)
+            if event is None:
+                break
+            await response.write(event.encode())
+    finally:
+        # A client gone mid-wait leaves the generator running on its thread until that wait ends
+        if not events.gi_running:
+            events.close()
+    await response.write_eof()
+    return response
+
+
+def _wants_async(request, data):
+    return request.query.get("async", "").lower() in ("1", "true") or data.get("async") is True
+
+
+def single_image_handler(flask_app, module, route, check_gender=False):
+    service_name = metrics.service_name(flask_app)
+
+    async def handler(request):
+        try:
+            data = await request.json()
+        except Exception:
+            data = None
+        # Background jobs and malformed bodies keep the Flask view's handling
+        if not isinstance(data, dict) or _wants_async(request, data):
+            return await call_flask(flask_app, request)
+
+        # Requests served here bypass the Flask request hooks, so they are recorded and traced here
+        started = time.perf_counter()
+        metrics.requests_in_flight.inc(service=service_name)
+        trace = tracing.begin_trace(f"{request.method} {route}", request.path, request.headers.get("traceparent"), bind_thread=False, method=request.method, route=route)
+        status_code = 500
+        try:
+            response = await serve_single_image(request, data, module, check_gender)
+            status_code = response.status
+            if trace:
+                response.headers["X-Trace-Id"] = trace.root.trace_id
+            return response
+        finally:
+            metrics.requests_in_flight.dec(service=service_name)
+            metrics.observe_request(service_name, route, request.method, status_code, time.perf_counter() - started)
+            tracing.finish_trace(trace, status_code=status_code)
+    return handler
+
+
+# Function to admit and run a single-image swap on the loop; returns the aiohttp response
+async def serve_single_image(request, data, module, check_gender):
+    try:
+        scheduler.check("image")
+    except scheduler.SchedulerBusy as e:
+        return web.json_response({"error": str(e), "retry_after": e.retry_after}, status=429, headers={"Retry-After": str(e.retry_after)}, dumps=_dumps)
+
+    body, status_code = await swap_single_image(request.app[session_key], module, result_cache.script_route(module.__file__), data, check_gender)
+    return web.json_response(body, status=status_code, dumps=_dumps)
+
+
+# Function to build the aiohttp app of one port; mounts maps a path prefix to a script name
+def create_app(flask_app, mounts, session):
+    if aiohttp is None:
+        raise Exception("aiohttp is required for the asyncio service: pip install aiohttp")
+    app = web.Application(client_max_size=max_body_bytes)
+    app[session_key] = session
+    for prefix, name in mounts.items():
+        settings = single_image_routes.get(name)
+        if settings and name in service.scripts:
+            route = prefix + settings["route"]
+            app.router.add_post(route, single_image_handler(flask_app, service.scripts[name], route, settings.get("check_gender", False)))
+
+    app.router.add_get("/jobs/{job_id}/events", job_events_handler)
+
+    async def flask_handler(request):
+        return await call_flask(flask_app, request)
+
+    app.router.add_route("*", "/{path:.*}", flask_handler)
+    return app
+
+
+# Function to list each port with the Flask app behind it and the scripts it serves natively
+def port_apps():
+    ports = {service.service_port: (service.app, {f"/{name}": name for name in service.scripts})}
+    for port, name in service.legacy_ports.items():
+        if name in service.scripts:
+            ports[port] = (service.scripts[name].app, {"": name})
+    return ports
+
+
+async def serve(reuse_port=False):
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, limit_per_host=connections_per_host),
+        timeout=aiohttp.ClientTimeout(sock_connect=http_client.connect_timeout, sock_read=http_client.read_timeout)
+    )
+    try:
+        for port, (flask_app, mounts) in port_apps().items():
+            runner = web.AppRunner(create_app(flask_app, mounts, session), access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, service.service_host, port, reuse_port=reuse_port).start()
+        await asyncio.Event().wait()
+    finally:
+        await session.close()
+
+
+if __name__ == '__main__':
+    if aiohttp is None:
+        raise SystemExit("aiohttp is required for the asyncio service: pip install aiohttp")
+    # Several loops share the ports through SO_REUSEPORT; the kernel spreads connections across them
+    for _ in range(loop_threads - 1):
+        threading.Thread(target=asyncio.run, args=(serve(True),), daemon=True).start()
+    print(f"Serving on port {service.service_port} and legacy ports {sorted(service._port_apps)} with {loop_threads} event loop(s)")
+    asyncio.run(serve(loop_threads > 1))
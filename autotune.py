@@ -0,0 +1,221 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-host tuning of FaceFusion's --execution-thread-count and --execution-queue-count and of
+# how many runs go at once. The autotune command sweeps these settings with representative
+# image and video swaps, records throughput and p95 latency of every combination and saves
+# the best one per job type as this host's profile. At startup the services load the profile:
+# run_facefusion rewrites the thread and queue counts of every command of that job type, the
+# scheduler runs at most the tuned number of those jobs at once, and the worker pool is sized
+# to the largest of them. A profile made on a machine with another number of CPUs is ignored.
+#
+#   FACEFUSION_PATH=/home/azureuser/facefusion python3 autotune.py --source face.jpg \
+#       --image target.jpg --video clip.mp4 --threads 1 2 4 8 --queues 1 2 --concurrency 1 2 4
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+profile_path = os.getenv("AUTOTUNE_PROFILE_PATH", os.path.join(base_path, ".autotune-profile.json"))
+profile_enabled = os.getenv("AUTOTUNE_PROFILE", "1") == "1"
+
+
+def _cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def _load_profile():
+    if not profile_enabled or not os.path.exists(profile_path):
+        return {}
+    try:
+        with open(profile_path) as file:
+            saved = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Error loading the autotune profile {profile_path}: {e}")
+        return {}
+    if saved.get("host", {}).get("cpus") != _cpus():
+        print(f"Ignoring the autotune profile {profile_path}: it was made on a host with {saved.get('host', {}).get('cpus')} CPUs")
+        return {}
+    return saved.get("job_types", {})
+
+
+profile = _load_profile()
+
+
+# Function to get the FaceFusion options the profile sets for a job type, e.g. {"--execution-thread-count": "2"}
+def overrides(job_type):
+    settings = profile.get(job_type)
+    if not settings:
+        return {}
+    return {
+        "--execution-thread-count": str(settings["execution_thread_count"]),
+        "--execution-queue-count": str(settings["execution_queue_count"])
+    }
+
+
+# Function to get how many runs of a job type may go at once, or None when it isn't tuned
+def concurrency(job_type):
+    return profile.get(job_type, {}).get("concurrency")
+
+
+# Function to get the worker pool size the profile calls for, or None when nothing is tuned
+def pool_size():
+    return max((settings["concurrency"] for settings in profile.values()), default=None)
+
+
+# Function to run one swap in a fresh workspace and time it; the target is copied under the
+# workspace's unique name because FaceFusion keys its temp frames on the target file name
+def timed_swap(build_command, source_path, target_path, threads, queues):
+    import facefusion_pool
+    import workspace
+    run_workspace = workspace.Workspace()
+    try:
+        extension = os.path.splitext(target_path)[1]
+        run_target = run_workspace.file(f"target{extension}")
+        shutil.copyfile(target_path, run_target)
+        command = build_command(source_path, run_target, run_workspace.file(f"output{extension}"))
+        command = facefusion_pool._with_option(command, "--execution-thread-count", str(threads))
+        command = facefusion_pool._with_option(command, "--execution-queue-count", str(queues))
+        started = time.perf_counter()
+        # Straight to the pool: the sweep sets its own concurrency instead of the scheduler's
+        process = facefusion_pool._run_facefusion(command, None, False)
+        seconds = time.perf_counter() - started
+        if process.returncode != 0:
+            print(f"Swap failed with {threads} threads and {queues} queues: {process.stderr[-500:]}")
+            return None
+        return seconds
+    finally:
+        run_workspace.cleanup()
+
+
+def run_batch(build_command, source_path, target_path, threads, queues, concurrency_level, jobs):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency_level) as executor:
+        latencies = list(executor.map(lambda _: timed_swap(build_command, source_path, target_path, threads, queues), range(jobs)))
+    elapsed = time.perf_counter() - started
+    succeeded = sorted(latency for latency in latencies if latency is not None)
+    result = {
+        "execution_thread_count": threads,
+        "execution_queue_count": queues,
+        "concurrency": concurrency_level,
+        "jobs": jobs,
+        "failed": jobs - len(succeeded)
+    }
+    if succeeded:
+        result.update({
+            "throughput_per_minute": round(len(succeeded) / elapsed * 60, 2),
+            "latency_p50_seconds": round(statistics.median(succeeded), 3),
+            "latency_p95_seconds": round(succeeded[int(0.95 * (len(succeeded) - 1))], 3)
+        })
+    return result
+
+
+# Function to pick the highest throughput among the runs without failures that meet the p95
+# limit, or the lowest p95 when none meets it
+def best_result(results, max_p95=None):
+    complete = [result for result in results if not result["failed"]]
+    if not complete:
+        return None
+    within = [result for result in complete if max_p95 is None or result["latency_p95_seconds"] <= max_p95]
+    if within:
+        return max(within, key=lambda result: (result["throughput_per_minute"], -result["latency_p95_seconds"]))
+    return min(complete, key=lambda result: result["latency_p95_seconds"])
+
+
+def sweep(job_type, build_command, source_path, target_path, args):
+    import facefusion_pool
+    results = []
+    for concurrency_level in args.concurrency:
+        combinations = [
+            (threads, queues) for threads in args.threads for queues in args.queues
+            if threads * concurrency_level <= args.max_oversubscription * _cpus()
+        ]
+        if not combinations:
+            continue
+        # Warm workers like the services use, one per job in flight
+        pool = None
+        if not args.subprocess:
+            pool = facefusion_pool.FaceFusionPool(concurrency_level, facefusion_pool.max_jobs_per_worker)
+            # Workers start in the background; only a pool whose first worker came up is used
+            if not pool.wait_ready(facefusion_pool.startup_timeout):
+                print("FaceFusion workers unavailable, sweeping with subprocess runs")
+                pool.close()
+                pool = None
+        facefusion_pool.pool_size = concurrency_level if pool else 0
+        facefusion_pool._pool = pool
+        try:
+            # Untimed round so model loading isn't charged to the first combination
+            run_batch(build_command, source_path, target_path, combinations[0][0], combinations[0][1], concurrency_level, concurrency_level)
+            for threads, queues in combinations:
+                result = run_batch(build_command, source_path, target_path, threads, queues, concurrency_level, args.jobs or 2 * concurrency_level)
+                print(json.dumps(dict(result, job_type=job_type)))
+                results.append(result)
+        finally:
+            if pool:
+                pool.close()
+            facefusion_pool._pool = None
+    return results
+
+
+# Function to load one service script by file name (the consolidated service would load them all)
+def _load_script(name):
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune FaceFusion thread and queue counts and job concurrency for this host")
+    parser.add_argument("--source", required=True, help="Source face image")
+    parser.add_argument("--image", help="Representative target image")
+    parser.add_argument("--video", help="Representative (short) target video")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--queues", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--jobs", type=int, help="Swaps per combination (default: twice the concurrency)")
+    parser.add_argument("--max-oversubscription", type=float, default=2.0, help="Skip combinations using more threads than this many times the CPUs")
+    parser.add_argument("--max-p95-image", type=float)
+    parser.add_argument("--max-p95-video", type=float)
+    parser.add_argument("--subprocess", action="store_true", help="Run every swap as a fresh FaceFusion process instead of on warm workers")
+    parser.add_argument("--output", default=profile_path)
+    args = parser.parse_args()
+    if not args.image and not args.video:
+        parser.error("give a target --image, --video or both")
+
+    source_path = os.path.abspath(args.source)
+    # Each job type is swapped with the command of the script that serves it
+    targets = {"image": ("new-api-v4", args.image, args.max_p95_image), "video": ("video-faceswap-api-v2", args.video, args.max_p95_video)}
+
+    saved = {
+        "host": {"cpus": _cpus(), "hostname": platform.node(), "machine": platform.machine()},
+        "created_at": time.time(),
+        "job_types": {},
+        "results": {}
+    }
+    for job_type, (script_name, target_path, max_p95) in targets.items():
+        if not target_path:
+            continue
+        results = sweep(job_type, _load_script(script_name).build_command, source_path, os.path.abspath(target_path), args)
+        saved["results"][job_type] = results
+        best = best_result(results, max_p95)
+        if best is None:
+            print(f"No {job_type} combination completed without failures; the {job_type} jobs keep their defaults")
+            continue
+        saved["job_types"][job_type] = {
+            key: best[key] for key in ("execution_thread_count", "execution_queue_count", "concurrency", "throughput_per_minute", "latency_p95_seconds")
+        }
+
+    temp_path = args.output + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(saved, file, indent=2)
+    os.replace(temp_path, args.output)
+    print(json.dumps({"profile": args.output, "job_types": saved["job_types"]}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import face_registry  # noqa: E402
+import facefusion_pool  # noqa: E402
+
+# Compares adaptive detection (0° first, other angles only when nothing is found) with the
+# current behaviour of always running the detector at 0, 90, 180 and 270 degrees. It runs the
+# same analysis a worker does, in this process, so it needs a FaceFusion checkout with its
+# models downloaded:
+#
+#   FACEFUSION_PATH=/home/azureuser/facefusion python3 benchmarks/adaptive_angles.py \
+#       upright.jpg exif-rotated.jpg sideways.jpg --rounds 5
+
+
+# Function to analyse every image in one detection mode; returns the per-image measurements
+def measure(images, adaptive, rounds):
+    import facefusion_engine
+    from facefusion.face_store import clear_static_faces
+    facefusion_engine.adaptive_angles = adaptive
+
+    measurements = []
+    for image_path in images:
+        latencies = []
+        for _ in range(rounds):
+            # Without this the second round would be answered from FaceFusion's face cache
+            clear_static_faces()
+            facefusion_engine.take_detection_stats()
+            started = time.perf_counter()
+            faces = facefusion_engine.analyse_image(image_path, face_registry.detection_args)
+            latencies.append(time.perf_counter() - started)
+            stats = facefusion_engine.take_detection_stats()
+        measurements.append({
+            "image": os.path.basename(image_path),
+            "faces": len(faces),
+            "detector_calls": stats["detector_calls"],
+            "matched_angles": stats["matched_angles"],
+            "median_seconds": round(statistics.median(latencies), 4)
+        })
+    return measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark adaptive face detector angles against always scanning four")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    images = [os.path.abspath(image_path) for image_path in args.images]
+    os.chdir(facefusion_pool.base_path)
+    sys.path.insert(0, facefusion_pool.base_path)
+    import facefusion_engine
+    facefusion_engine.warmup()
+    # One untimed pass so model loading isn't charged to the first mode
+    measure(images[:1], True, 1)
+
+    result = {}
+    for mode, adaptive in (("always_4", False), ("adaptive", True)):
+        measurements = measure(images, adaptive, args.rounds)
+        result[mode] = {
+            "detector_calls": sum(measurement["detector_calls"] for measurement in measurements),
+            "total_median_seconds": round(sum(measurement["median_seconds"] for measurement in measurements), 4),
+            "images": measurements
+        }
+    # Adaptive mode must still find a face in every image where the full scan finds one
+    result["adaptive_misses_no_faces"] = all(
+        adaptive["faces"] > 0 or always["faces"] == 0
+        for always, adaptive in zip(result["always_4"]["images"], result["adaptive"]["images"])
+    )
+    result["detector_calls_saved"] = result["always_4"]["detector_calls"] - result["adaptive"]["detector_calls"]
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
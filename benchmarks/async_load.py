@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import aiohttp
+
+# Load comparison of the threaded Flask services and the asyncio service (async_service.py).
+# The same single-image swap is sent to each URL with an increasing number of requests in
+# flight. The inputs come from a local fixture server that answers after a delay, like a slow
+# CDN, and every request asks for a distinct URL without result caching, so each one really
+# downloads, swaps and uploads. Give the server's pid to also record its peak thread count.
+#
+#   python3 new-api-v4.py &                               # threaded dev server on 8011
+#   SERVICE_PORT=8100 python3 async_service.py &          # asyncio service on 8100
+#   python3 benchmarks/async_load.py --image face.jpg --input-delay 2 --concurrency 10 100 300 \
+#       --threaded http://localhost:8011/single-image-faceswap \
+#       --async http://localhost:8100/new-api-v4/single-image-faceswap
+
+
+def start_fixture(image_path, delay, port):
+    with open(image_path, 'rb') as file:
+        image = file.read()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# Function to read a process's thread count from /proc
+def thread_count(pid):
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+async def sample_threads(pid, peak, stop):
+    while not stop.is_set():
+        count = thread_count(pid)
+        if count:
+            peak[0] = max(peak[0], count)
+        await asyncio.sleep(0.1)
+
+
+async def send_request(session, url, payload):
+    started = time.perf_counter()
+    try:
+        async with session.post(url, json=payload) as response:
+            await response.read()
+            status_code = response.status
+    except Exception as e:
+        print(f"Request failed: {e}")
+        status_code = None
+    return status_code, time.perf_counter() - started
+
+
+async def run_level(url, fixture_url, payload, concurrency, pid, timeout):
+    payloads = [
+        dict(payload, source_url=f"{fixture_url}/source-{concurrency}-{index}.jpg", target_url=f"{fixture_url}/target-{concurrency}-{index}.jpg", cache=False)
+        for index in range(concurrency)
+    ]
+    peak = [0]
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_threads(pid, peak, stop)) if pid else None
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(send_request(session, url, item) for item in payloads))
+        elapsed = time.perf_counter() - started
+    stop.set()
+    if sampler:
+        await sampler
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        "concurrency": concurrency,
+        "succeeded": sum(1 for status_code, _ in results if status_code == 200),
+        "failed": sum(1 for status_code, _ in results if status_code != 200),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(len(results) / elapsed, 2),
+        "latency_p50_seconds": round(statistics.median(latencies), 3),
+        "latency_p95_seconds": round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+        "latency_max_seconds": round(latencies[-1], 3),
+        "peak_server_threads": peak[0] or None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the threaded and asyncio services under load")
+    parser.add_argument("--threaded", help="Swap URL of the threaded service")
+    parser.add_argument("--async", dest="async_url", help="Swap URL of the asyncio service")
+    parser.add_argument("--threaded-pid", type=int)
+    parser.add_argument("--async-pid", type=int)
+    parser.add_argument("--image", required=True, help="Image served as both source and target")
+    parser.add_argument("--input-delay", type=float, default=1.0, help="Seconds the fixture waits before answering")
+    parser.add_argument("--fixture-port", type=int, default=0)
+    parser.add_argument("--payload", default="{}", help="Extra JSON request fields, e.g. '{\"in_memory\": false}'")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--timeout", type=float, default=900)
+    args = parser.parse_args()
+
+    fixture_url = start_fixture(os.path.abspath(args.image), args.input_delay, args.fixture_port)
+    payload = json.loads(args.payload)
+    services = {"threaded": (args.threaded, args.threaded_pid), "async": (args.async_url, args.async_pid)}
+    result = {"input_delay_seconds": args.input_delay}
+    for name, (url, pid) in services.items():
+        if url:
+            result[name] = [asyncio.run(run_level(url, fixture_url, payload, concurrency, pid, args.timeout)) for concurrency in args.concurrency]
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
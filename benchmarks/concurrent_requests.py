@@ -0,0 +1,66 @@
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Fires the same swap request at a running service, first one at a time and then with
+# several requests in flight, and prints the throughput of each run.
+#
+#   python3 benchmarks/concurrent_requests.py http://localhost:8011/single-image-faceswap \
+#       --payload '{"source_url": "...", "target_url": "..."}' --requests 16 --concurrency 8
+
+
+# Function to send one request and time it
+def send_request(url, payload, timeout):
+    started = time.perf_counter()
+    try:
+        response = requests.post(url, json=payload, timeout=timeout)
+        status_code = response.status_code
+    except Exception as e:
+        print(f"Request failed: {e}")
+        status_code = None
+    return status_code, time.perf_counter() - started
+
+
+# Function to send a batch of requests with a given number in flight
+def run_batch(url, payload, total, concurrency, timeout):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: send_request(url, payload, timeout), range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for _, latency in results)
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "succeeded": sum(1 for status_code, _ in results if status_code == 200),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_minute": round(total / elapsed * 60, 2),
+        "latency_p50_seconds": round(statistics.median(latencies), 3),
+        "latency_max_seconds": round(latencies[-1], 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare serial and concurrent throughput of a swap endpoint")
+    parser.add_argument("url")
+    parser.add_argument("--payload", required=True, help="JSON request body")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=900)
+    args = parser.parse_args()
+
+    payload = json.loads(args.payload)
+    serial = run_batch(args.url, payload, args.requests, 1, args.timeout)
+    concurrent = run_batch(args.url, payload, args.requests, args.concurrency, args.timeout)
+    print(json.dumps({
+        "serial": serial,
+        "concurrent": concurrent,
+        "speedup": round(serial["elapsed_seconds"] / concurrent["elapsed_seconds"], 2)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import facefusion_pool  # noqa: E402
+
+# Compares face-region (ROI) processing of large image targets with the full-frame path: the
+# same in-memory swap a worker runs, once on the whole frame restricted to the output resolution
+# and once region by region at native resolution. Reports the swap time of both, the pixels the
+# processors worked on, and how far the ROI output (scaled to the full-frame output's size)
+# differs from the full-frame output. The swap options are those of image-swap-api. Needs a
+# FaceFusion checkout with its models:
+#
+#   FACEFUSION_PATH=/home/azureuser/facefusion python3 benchmarks/face_regions.py source.jpg \
+#       group-24mp.jpg portrait-48mp.jpg --rounds 3
+
+
+# Function to get the FaceFusion args of image-swap-api's single-image swap
+def swap_args():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "image-swap-api.py")
+    spec = importlib.util.spec_from_file_location("image_swap_api", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.build_command("source.jpg", "target.jpg", "output.jpg")[2:]
+
+
+def swap(args, source_bytes, target_bytes, face_regions):
+    import facefusion_engine
+    from facefusion.face_store import clear_static_faces
+    # Neither mode may be answered from the faces cached by the other
+    clear_static_faces()
+    facefusion_engine.take_detection_stats()
+    started = time.perf_counter()
+    output_bytes = facefusion_engine.swap_in_memory(args, source_bytes, target_bytes, None, face_regions)
+    seconds = time.perf_counter() - started
+    return output_bytes, seconds, facefusion_engine.take_detection_stats()
+
+
+def decode(image_bytes):
+    import cv2
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+
+# Function to compare the ROI output with the full-frame output at the full-frame output's size
+def difference(full_frame_bytes, roi_bytes):
+    import cv2
+    full_frame = decode(full_frame_bytes).astype(np.float32)
+    roi_frame = cv2.resize(decode(roi_bytes), (full_frame.shape[1], full_frame.shape[0]), interpolation=cv2.INTER_AREA).astype(np.float32)
+    error = np.abs(full_frame - roi_frame)
+    mse = float(np.mean(error ** 2))
+    return {
+        "mean_abs": round(float(error.mean()), 3),
+        "max_abs": round(float(error.max()), 1),
+        "psnr_db": round(10 * np.log10(255 ** 2 / mse), 2) if mse else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark face-region processing against the full-frame path")
+    parser.add_argument("source")
+    parser.add_argument("targets", nargs="+")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--detect-size", type=int, default=facefusion_pool.face_region_settings["detect_size"])
+    parser.add_argument("--padding", type=float, default=facefusion_pool.face_region_settings["padding"])
+    parser.add_argument("--feather", type=float, default=facefusion_pool.face_region_settings["feather"])
+    args = parser.parse_args()
+
+    paths = [os.path.abspath(path) for path in [args.source] + args.targets]
+    command_args = swap_args()
+    os.chdir(facefusion_pool.base_path)
+    sys.path.insert(0, facefusion_pool.base_path)
+    import facefusion_engine
+    facefusion_engine.warmup()
+
+    face_regions = {"detect_size": args.detect_size, "padding": args.padding, "feather": args.feather}
+    with open(paths[0], "rb") as file:
+        source_bytes = file.read()
+    results = []
+    for target_path in paths[1:]:
+        with open(target_path, "rb") as file:
+            target_bytes = file.read()
+        # One untimed pass so model loading isn't charged to the first mode
+        swap(command_args, source_bytes, target_bytes, None)
+
+        seconds = {"full_frame": [], "roi": []}
+        for _ in range(args.rounds):
+            full_frame_bytes, full_frame_seconds, _ = swap(command_args, source_bytes, target_bytes, None)
+            roi_bytes, roi_seconds, roi_stats = swap(command_args, source_bytes, target_bytes, face_regions)
+            seconds["full_frame"].append(full_frame_seconds)
+            seconds["roi"].append(roi_seconds)
+
+        target_shape = decode(target_bytes).shape
+        full_frame_shape = decode(full_frame_bytes).shape
+        roi_shape = decode(roi_bytes).shape
+        full_frame_median = statistics.median(seconds["full_frame"])
+        roi_median = statistics.median(seconds["roi"])
+        results.append({
+            "target": os.path.basename(target_path),
+            "target_resolution": f"{target_shape[1]}x{target_shape[0]}",
+            "full_frame": {
+                "seconds": round(full_frame_median, 3),
+                "output_resolution": f"{full_frame_shape[1]}x{full_frame_shape[0]}",
+                "processed_pixels": full_frame_shape[0] * full_frame_shape[1]
+            },
+            "roi": {
+                "seconds": round(roi_median, 3),
+                "output_resolution": f"{roi_shape[1]}x{roi_shape[0]}",
+                "processed_pixels": roi_stats.get("regions", {}).get("region_pixels", roi_shape[0] * roi_shape[1]),
+                "regions": roi_stats.get("regions", {}).get("regions", 0)
+            },
+            "speedup": round(full_frame_median / roi_median, 2),
+            "difference_at_full_frame_size": difference(full_frame_bytes, roi_bytes)
+        })
+    print(json.dumps({"settings": face_regions, "rounds": args.rounds, "targets": results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
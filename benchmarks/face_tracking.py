@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import face_registry  # noqa: E402
+import facefusion_pool  # noqa: E402
+
+# Compares face tracking (full detection every N frames, optical flow in between) with full
+# detection on every frame over the frames of one video. Reports the face analysis frames per
+# second of both modes and how far the tracked 68 landmarks drift from the detected ones, in
+# pixels and relative to the face box diagonal. Needs a FaceFusion checkout with its models:
+#
+#   FACEFUSION_PATH=/home/azureuser/facefusion python3 benchmarks/face_tracking.py target.mp4 \
+#       --detect-every 10 --max-frames 300
+
+
+def read_frames(video_path, max_frames):
+    import cv2
+    capture = cv2.VideoCapture(video_path)
+    frames = []
+    while len(frames) < max_frames:
+        has_frame, frame = capture.read()
+        if not has_frame:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+def analyse(frames, tracking):
+    import facefusion_engine
+    from facefusion.face_store import clear_static_faces
+    # Full detection must not be answered from the faces cached by the previous mode
+    clear_static_faces()
+    facefusion_engine.take_detection_stats()
+    started = time.perf_counter()
+    faces_per_frame = facefusion_engine.analyse_frames(frames, tracking)
+    seconds = time.perf_counter() - started
+    return faces_per_frame, seconds, facefusion_engine.take_detection_stats()
+
+
+def _center(face):
+    return (face.bounding_box[:2] + face.bounding_box[2:]) / 2
+
+
+# Function to measure the landmark error of each tracked face against the nearest detected face
+def landmark_drift(detected_frames, tracked_frames):
+    pixels = []
+    relative = []
+    lost_faces = 0
+    for detected_faces, tracked_faces in zip(detected_frames, tracked_frames):
+        lost_faces += max(0, len(detected_faces) - len(tracked_faces))
+        for tracked_face in tracked_faces:
+            if not detected_faces:
+                continue
+            detected_face = min(detected_faces, key=lambda face: np.linalg.norm(_center(face) - _center(tracked_face)))
+            error = np.linalg.norm(tracked_face.landmark_set["68"] - detected_face.landmark_set["68"], axis=1).mean()
+            width, height = detected_face.bounding_box[2:] - detected_face.bounding_box[:2]
+            pixels.append(error)
+            relative.append(error / np.hypot(width, height))
+    if not pixels:
+        return {"lost_faces": lost_faces}
+    return {
+        "mean_pixels": round(float(np.mean(pixels)), 3),
+        "p95_pixels": round(float(np.percentile(pixels, 95)), 3),
+        "max_pixels": round(float(np.max(pixels)), 3),
+        "mean_relative_to_box_diagonal": round(float(np.mean(relative)), 5),
+        "lost_faces": lost_faces
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark face tracking against full per-frame detection")
+    parser.add_argument("video")
+    parser.add_argument("--detect-every", type=int, default=facefusion_pool.face_tracking_settings["detect_every"])
+    parser.add_argument("--min-confidence", type=float, default=facefusion_pool.face_tracking_settings["min_confidence"])
+    parser.add_argument("--scene-cut-threshold", type=float, default=facefusion_pool.face_tracking_settings["scene_cut_threshold"])
+    parser.add_argument("--max-frames", type=int, default=300)
+    args = parser.parse_args()
+
+    video_path = os.path.abspath(args.video)
+    os.chdir(facefusion_pool.base_path)
+    sys.path.insert(0, facefusion_pool.base_path)
+    import facefusion_engine
+    facefusion_engine.warmup()
+    facefusion_engine.apply_program_args(["headless-run", "--source-paths", video_path, "--target-path", video_path, "--output-path", video_path] + face_registry.detection_args)
+
+    frames = read_frames(video_path, args.max_frames)
+    if not frames:
+        raise SystemExit(f"Could not read frames from {video_path}")
+    # One untimed pass so model loading isn't charged to the first mode
+    analyse(frames[:1], None)
+
+    tracking = {
+        "detect_every": args.detect_every,
+        "min_confidence": args.min_confidence,
+        "scene_cut_threshold": args.scene_cut_threshold
+    }
+    detected, detection_seconds, detection_stats = analyse(frames, None)
+    tracked, tracking_seconds, tracking_stats = analyse(frames, tracking)
+
+    detection_fps = len(frames) / detection_seconds
+    tracking_fps = len(frames) / tracking_seconds
+    print(json.dumps({
+        "frames": len(frames),
+        "tracking_settings": tracking,
+        "full_detection": {"fps": round(detection_fps, 2), "detector_calls": detection_stats["detector_calls"]},
+        "tracking": {
+            "fps": round(tracking_fps, 2),
+            "detector_calls": tracking_stats["detector_calls"],
+            "frames": tracking_stats.get("tracking", {})
+        },
+        "fps_gained": round(tracking_fps - detection_fps, 2),
+        "speedup": round(tracking_fps / detection_fps, 2),
+        "landmark_drift": landmark_drift(detected, tracked)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
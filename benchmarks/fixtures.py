@@ -0,0 +1,202 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+
+# Offline fixtures for the stage benchmarks: synthetic face images and videos, an HTTP server
+# for the inputs, a minimal S3 stand-in for the uploads and the stub swap engine.
+
+
+# Skin tone (BGR) of the synthetic faces; the stub detector finds faces by it
+skin_color = (150, 180, 220)
+
+
+def _draw_face(image, center, axes):
+    cv2.ellipse(image, center, axes, 0, 0, 360, skin_color, -1)
+    for side in (-1, 1):
+        cv2.circle(image, (center[0] + side * axes[0] // 2, center[1] - axes[1] // 4), max(2, axes[0] // 8), (40, 40, 40), -1)
+    cv2.ellipse(image, (center[0], center[1] + axes[1] // 2), (axes[0] // 3, axes[1] // 10), 0, 0, 180, (60, 60, 160), -1)
+
+
+# Function to draw a synthetic face-like image: gradient background, skin-toned faces with eyes and
+# mouth; one face moved sideways by shift, or several side by side
+def synthetic_image(width, height, shift=0.0, faces=1):
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.dstack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)), np.full((height, width), 96, np.float32)]).astype(np.uint8)
+    if faces == 1:
+        _draw_face(image, (int(width * (0.5 + 0.2 * np.sin(shift))), height // 2), (max(8, width // 8), max(10, height // 4)))
+    else:
+        for index in range(faces):
+            _draw_face(image, (int(width * (index + 0.5) / faces), height // 2), (max(8, width // (4 * faces)), max(10, height // 4)))
+    return image
+
+
+def write_image(path, width, height, shift=0.0, faces=1):
+    cv2.imwrite(path, synthetic_image(width, height, shift, faces), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    return path
+
+
+# Function to write a synthetic video with the face moving across the frame
+def write_video(path, width, height, frames, fps=24):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for index in range(frames):
+        writer.write(synthetic_image(width, height, index / fps))
+    writer.release()
+    return path
+
+
+# Function to create the media set used by the benchmarks in a directory
+def create_media(directory, image_size, video_size, video_frames):
+    os.makedirs(directory, exist_ok=True)
+    return {
+        "source": write_image(os.path.join(directory, "source.jpg"), *image_size, shift=0.3),
+        "source_2": write_image(os.path.join(directory, "source_2.jpg"), *image_size, shift=-0.3),
+        "target_image": write_image(os.path.join(directory, "target.jpg"), *image_size),
+        "target_group": write_image(os.path.join(directory, "target_group.jpg"), *image_size, faces=2),
+        "target_video": write_video(os.path.join(directory, "target.mp4"), *video_size, video_frames)
+    }
+
+
+# Function to fill a faceswap-images style library (one folder per gender) with synthetic targets
+def create_library(directory, image_size, count):
+    for gender in ("male", "female"):
+        os.makedirs(os.path.join(directory, gender), exist_ok=True)
+        for index in range(count):
+            write_image(os.path.join(directory, gender, f"{gender}_{index}.jpg"), *image_size, shift=index)
+    return directory
+
+
+def _serve(handler_class):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# Function to serve the files of a directory over HTTP with ETags, after an optional delay.
+# Any query string is ignored, so distinct URLs can point at the same file.
+def start_http_fixture(directory, delay=0.0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            path = os.path.join(directory, self.path.split("?")[0].lstrip("/"))
+            if not os.path.isfile(path):
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            with open(path, 'rb') as file:
+                body = file.read()
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            time.sleep(delay)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return _serve(Handler)
+
+
+# Function to decode an aws-chunked request body ("<hex size>[;signature]\r\n<data>\r\n ... 0\r\n<trailers>")
+def _decode_aws_chunked(body):
+    data = bytearray()
+    position = 0
+    while True:
+        line_end = body.index(b"\r\n", position)
+        size = int(body[position:line_end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[line_end + 2:line_end + 2 + size]
+        position = line_end + 2 + size + 2
+
+
+# Function to start a minimal S3 stand-in: path-style PUT, HEAD and GET of objects in any bucket
+def start_s3_fixture():
+    objects = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, body=b"", headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _read_body(self):
+            if "chunked" in self.headers.get("Transfer-Encoding", ""):
+                body = bytearray()
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    if size == 0:
+                        while self.rfile.readline() not in (b"\r\n", b""):
+                            pass
+                        break
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+                body = bytes(body)
+            else:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+                body = _decode_aws_chunked(body)
+            return body
+
+        def do_PUT(self):
+            body = self._read_body()
+            key = self.path.split("?")[0]
+            if key.count("/") > 1:
+                objects[key] = body
+            self._reply(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+        # HEAD answers with the object's headers only; _reply leaves the body out
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            body = objects.get(self.path.split("?")[0])
+            if body is None:
+                self._reply(404)
+            else:
+                self._reply(200, body, {"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+        def log_message(self, *args):
+            pass
+
+    server, url = _serve(Handler)
+    server.objects = objects
+    return server, url
+
+
+# Path of the stub swap engine, a drop-in for facefusion.py (see stub_facefusion.py)
+stub_engine_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_facefusion.py")
+stub_package_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_package", "facefusion")
+
+
+# Function to lay out a FaceFusion checkout in a directory with the stub engine as facefusion.py
+# and the stub package beside it, so warm workers pointed at it (FACEFUSION_PATH) run the stub
+# for their CLI jobs as well as their in-process ones; returns the path of facefusion.py
+def install_stub_engine(directory):
+    os.makedirs(directory, exist_ok=True)
+    script_path = os.path.join(directory, "facefusion.py")
+    shutil.copyfile(stub_engine_path, script_path)
+    shutil.copytree(stub_package_path, os.path.join(directory, "facefusion"), ignore=shutil.ignore_patterns("__pycache__"), dirs_exist_ok=True)
+    return script_path
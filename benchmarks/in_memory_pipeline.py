@@ -0,0 +1,50 @@
+import argparse
+import json
+import statistics
+import time
+import requests
+
+# Compares the in-memory and disk paths of a single-image endpoint on a running service by
+# sending the same swap with "in_memory": true and false in alternation.
+#
+#   python3 benchmarks/in_memory_pipeline.py http://localhost:8011/single-image-faceswap \
+#       --payload '{"source_url": "...", "target_url": "..."}' --rounds 10
+
+
+def timed_request(url, payload):
+    started = time.perf_counter()
+    response = requests.post(url, json=payload, timeout=900)
+    return time.perf_counter() - started, response.status_code, response.json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the in-memory and disk single-image pipelines")
+    parser.add_argument("url")
+    parser.add_argument("--payload", required=True, help="JSON request body")
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    payload = json.loads(args.payload)
+    latencies = {"in_memory": [], "disk": []}
+    disk_io_avoided = []
+    for _ in range(args.rounds):
+        for mode in ("in_memory", "disk"):
+            latency, status_code, body = timed_request(args.url, dict(payload, in_memory=(mode == "in_memory")))
+            if status_code != 200:
+                print(f"{mode} request failed: {body}")
+                continue
+            latencies[mode].append(latency)
+            if mode == "in_memory":
+                if body.get("pipeline") != "in-memory":
+                    print("Service fell back to the disk path; is the FaceFusion worker pool running?")
+                disk_io_avoided.append(body.get("disk_io_avoided_bytes", 0))
+
+    result = {mode: round(statistics.median(values), 3) if values else None for mode, values in latencies.items()}
+    if result["in_memory"] and result["disk"]:
+        result["latency_saved_seconds"] = round(result["disk"] - result["in_memory"], 3)
+    result["disk_io_avoided_bytes_per_request"] = int(statistics.median(disk_io_avoided)) if disk_io_avoided else None
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+import boto3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s3_uploader  # noqa: E402
+
+# Compares the old upload path (a new boto3 client per upload, one upload at a time) with the
+# shared client and parallel uploads. Run it against a local S3-compatible server to measure
+# offline, e.g. `moto_server -p 5000` and then
+#
+#   S3_ENDPOINT_URL=http://localhost:5000 AWS_ACCESS_KEY=x AWS_SECRET_KEY=x AWS_REGION=us-east-1 \
+#       python3 benchmarks/s3_upload.py --bucket bench-bucket --file output.jpg --uploads 5
+
+
+# Function to upload the way the services did before: a fresh client for every upload
+def upload_with_new_clients(file_path, bucket_name, uploads):
+    started = time.perf_counter()
+    for _ in range(uploads):
+        s3_client = boto3.client(
+            's3',
+            aws_access_key_id=s3_uploader.aws_access_key,
+            aws_secret_access_key=s3_uploader.aws_secret_key,
+            region_name=s3_uploader.aws_region,
+            endpoint_url=s3_uploader.s3_endpoint_url
+        )
+        s3_client.upload_file(file_path, bucket_name, f"{uuid.uuid4()}.jpg")
+    return time.perf_counter() - started
+
+
+# Function to upload on the shared client with all uploads in flight at once
+def upload_with_shared_client(file_path, bucket_name, uploads):
+    started = time.perf_counter()
+    futures = [s3_uploader.upload_file(file_path, bucket_name, ".jpg") for _ in range(uploads)]
+    for future in futures:
+        future.result()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-call S3 clients against the shared uploader")
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--file", required=True)
+    parser.add_argument("--uploads", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--create-bucket", action="store_true")
+    args = parser.parse_args()
+
+    if args.create_bucket:
+        s3_uploader.get_client().create_bucket(Bucket=args.bucket)
+    # Warm the shared client once, like a long-running service would be
+    upload_with_shared_client(args.file, args.bucket, 1)
+
+    new_clients = [upload_with_new_clients(args.file, args.bucket, args.uploads) for _ in range(args.rounds)]
+    shared_client = [upload_with_shared_client(args.file, args.bucket, args.uploads) for _ in range(args.rounds)]
+    print(json.dumps({
+        "uploads_per_round": args.uploads,
+        "new_client_per_upload_seconds": round(min(new_clients), 4),
+        "shared_client_parallel_seconds": round(min(shared_client), 4),
+        "speedup": round(min(new_clients) / min(shared_client), 2)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
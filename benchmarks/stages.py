@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, benchmark_directory)
+import fixtures  # noqa: E402
+# The service modules come from the repository, not from the benchmarks of the same name (in_memory_pipeline.py)
+sys.path[:] = [path for path in sys.path if os.path.abspath(path or ".") != benchmark_directory]
+sys.path.insert(0, os.path.dirname(benchmark_directory))
+
+# Per-stage benchmark of every swap endpoint, fully offline: synthetic media served by a local
+# HTTP fixture, uploads to a local S3 stand-in and a stub engine with controllable latency in
+# place of FaceFusion (see fixtures.py and stub_facefusion.py). The stub is installed as the
+# FaceFusion checkout, so the endpoints take their production paths: warm workers (with
+# --pool-size 0, a fresh process per run), in-memory swaps, source registration and the
+# single-pass swap. Each endpoint of the consolidated service is called through its Flask route
+# and the shared stage functions are timed while it runs:
+#
+#   download   input downloads (download cache, in-memory fetches)
+#   select     picking inputs: content hashes, stored faces, library targets
+#   dispatch   run_facefusion time not spent inside the engine (queueing, process start, pipe)
+#   inference  whole engine calls: run_facefusion, in-memory and single-pass swaps, face analysis
+#   encode     output encoding inside the engine (CLI runs)
+#   upload     S3 uploads until they finish
+#
+# Requests skip the result cache unless --cache is given, since every round sends the same
+# content and would otherwise only measure cache hits.
+#
+# Stages running in parallel within one request count once (the union of their intervals);
+# dispatch and encode are summed over the request's engine runs. The medians are written as
+# JSON and compared with a baseline; the run fails when a stage got slower than the baseline by
+# more than the threshold, or when an endpoint didn't answer 200.
+#
+#   python3 benchmarks/stages.py --output results.json --save-baseline baseline.json
+#   python3 benchmarks/stages.py --output results.json --baseline baseline.json --threshold 0.2
+
+stage_names = ("download", "select", "dispatch", "inference", "encode", "upload")
+
+
+def _payload(*fields):
+    def build(urls):
+        return {name: urls[key] for name, key in fields}
+    return build
+
+
+def _uncached(payload_for):
+    return lambda urls: dict(payload_for(urls), cache=False)
+
+
+# Endpoint name -> (route on the consolidated service, request body built from the input URLs)
+endpoints = {
+    "image-swap-api": ("/image-swap-api/faceswap", _payload(("source_url", "source"), ("target_url", "target_image"))),
+    "new-api-v3": ("/new-api-v3/faceswap", _payload(("source_url", "source"), ("target_url", "target_image"))),
+    "new-api-v4": ("/new-api-v4/single-image-faceswap", _payload(("source_url", "source"), ("target_url", "target_image"))),
+    "v6": ("/v6/five-images-faceswap", lambda urls: {"source_url": urls["source"], "gender": "male", "count": 5}),
+    "mulitiple-image-faceswap-v2": ("/mulitiple-image-faceswap-v2/multiple-image-faceswap", _payload(("source_url", "source"), ("target_url", "target_group"))),
+    "multiple-image-faceswap-v3": ("/multiple-image-faceswap-v3/faceswap", _payload(("source_url_1", "source"), ("source_url_2", "source_2"), ("target_url", "target_group"))),
+    "multiple-image-faceswap-api-v4": ("/multiple-image-faceswap-api-v4/multiple-image-faceswap", lambda urls: dict(
+        _payload(("source_url_1", "source"), ("source_url_2", "source_2"), ("target_url", "target_group"))(urls), source_gender_1="male", source_gender_2="female")),
+    "mutiple-image-faceswap": ("/mutiple-image-faceswap/multiple-image-faceswap", _payload(("source_url1", "source"), ("source_url2", "source_2"), ("target_url", "target_video"))),
+    "video-faceswap-api-v1": ("/video-faceswap-api-v1/faceswap", _payload(("source_url", "source"), ("target_url", "target_video"))),
+    "video-faceswap-api-v2": ("/video-faceswap-api-v2/faceswap", _payload(("source_url", "source"), ("target_url", "target_video")))
+}
+
+
+class StageRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.intervals = {name: [] for name in stage_names}
+            self.durations = {name: 0.0 for name in stage_names}
+
+    def interval(self, name, started, finished):
+        with self.lock:
+            self.intervals[name].append((started, finished))
+
+    def duration(self, name, seconds):
+        with self.lock:
+            self.durations[name] += seconds
+
+    # Function to get each stage's time: the union of its intervals plus its summed durations
+    def totals(self):
+        with self.lock:
+            totals = {}
+            for name in stage_names:
+                covered = 0.0
+                end = None
+                for started, finished in sorted(self.intervals[name]):
+                    if end is None or started > end:
+                        covered += finished - started
+                        end = finished
+                    elif finished > end:
+                        covered += finished - end
+                        end = finished
+                totals[name] = covered + self.durations[name]
+            return totals
+
+
+recorder = StageRecorder()
+
+
+def _timed(module, function_name, stage):
+    original = getattr(module, function_name)
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            recorder.interval(stage, started, time.perf_counter())
+    setattr(module, function_name, wrapper)
+
+
+# Function to time a function that returns a future until the future is done
+def _timed_future(module, function_name, stage):
+    original = getattr(module, function_name)
+
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        future = original(*args, **kwargs)
+        future.add_done_callback(lambda _: recorder.interval(stage, started, time.perf_counter()))
+        return future
+    setattr(module, function_name, wrapper)
+
+
+# Function to wrap the shared stage functions the endpoints go through with timers
+def instrument():
+    import download_cache
+    import face_registry
+    import facefusion_pool
+    import http_client
+    import library_index
+    import result_cache
+    import s3_uploader
+
+    _timed(download_cache, "fetch", "download")
+    _timed(http_client, "fetch_bytes", "download")
+    _timed(face_registry, "seed_faces", "select")
+    _timed(result_cache, "file_hashes", "select")
+    _timed(library_index, "sample", "select")
+    _timed(library_index, "target_faces", "select")
+
+    _timed(facefusion_pool, "swap_in_memory", "inference")
+    _timed(facefusion_pool, "swap_by_position", "inference")
+    _timed(facefusion_pool, "analyse_image", "inference")
+
+    run_facefusion = facefusion_pool.run_facefusion
+
+    def timed_run_facefusion(command, *args, **kwargs):
+        # The scripts point at /home/azureuser/facefusion; subprocess runs go to the installed stub
+        command = [command[0], facefusion_pool.script_path] + list(command[2:])
+        started = time.perf_counter()
+        process = run_facefusion(command, *args, **kwargs)
+        finished = time.perf_counter()
+        recorder.interval("inference", started, finished)
+        engine = _stub_report(process.stdout)
+        if engine:
+            recorder.duration("encode", engine["encode_seconds"])
+            recorder.duration("dispatch", max(0.0, finished - started - engine["engine_seconds"]))
+        return process
+    facefusion_pool.run_facefusion = timed_run_facefusion
+
+    _timed_future(s3_uploader, "upload_file", "upload")
+    _timed_future(s3_uploader, "upload_bytes", "upload")
+
+
+def _stub_report(stdout):
+    for line in reversed((stdout or "").splitlines()):
+        if line.startswith('{"stub"'):
+            return json.loads(line)["stub"]
+    return None
+
+
+# Function to call one endpoint repeatedly and take the median time of every stage
+def run_endpoint(client, route, payload_for, urls, repeat):
+    samples = {name: [] for name in stage_names + ("total",)}
+    status_codes = []
+    for round_index in range(repeat + 1):
+        # Distinct URLs per round, so every round really downloads its inputs
+        round_urls = {key: f"{url}?round={round_index}-{time.monotonic_ns()}" for key, url in urls.items()}
+        recorder.reset()
+        started = time.perf_counter()
+        response = client.post(route, json=payload_for(round_urls))
+        total = time.perf_counter() - started
+        # Let uploads that finish after the response record their interval
+        time.sleep(0.01)
+        if round_index == 0:
+            # Warm-up round: imports, connection pools, first process start
+            continue
+        status_codes.append(response.status_code)
+        if response.status_code != 200:
+            print(f"{route} answered {response.status_code}: {response.get_json(silent=True)}")
+        samples["total"].append(total)
+        for name, seconds in recorder.totals().items():
+            samples[name].append(seconds)
+    return {
+        "status_codes": sorted(set(status_codes)),
+        "stages": {name: round(statistics.median(values), 6) for name, values in samples.items()}
+    }
+
+
+# Function to list the stages that got slower than the baseline by more than the threshold
+def compare(results, baseline, threshold, min_delta):
+    regressions = []
+    for endpoint, result in results["endpoints"].items():
+        baseline_stages = baseline.get("endpoints", {}).get(endpoint, {}).get("stages", {})
+        for stage, seconds in result["stages"].items():
+            before = baseline_stages.get(stage)
+            if before is None:
+                continue
+            if seconds > before * (1 + threshold) and seconds - before > min_delta:
+                regressions.append({
+                    "endpoint": endpoint,
+                    "stage": stage,
+                    "baseline_seconds": before,
+                    "seconds": seconds,
+                    "change": round(seconds / before - 1, 3) if before else None
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of every swap endpoint against offline fixtures")
+    parser.add_argument("--endpoints", nargs="+", choices=sorted(endpoints), default=sorted(endpoints))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--image-size", default="1280x720")
+    parser.add_argument("--video-size", default="640x360")
+    parser.add_argument("--video-frames", type=int, default=48)
+    parser.add_argument("--input-delay", type=float, default=0.0, help="Seconds the HTTP fixture waits before answering")
+    parser.add_argument("--image-latency", type=float, default=0.05, help="Stub engine seconds per image swap")
+    parser.add_argument("--frame-latency", type=float, default=0.005, help="Stub engine seconds per video frame")
+    parser.add_argument("--pool-size", type=int, default=2, help="Warm FaceFusion workers; 0 runs every swap as a fresh process")
+    parser.add_argument("--cache", action="store_true", help="Let requests use the result cache")
+    parser.add_argument("--output", help="Write the results JSON here")
+    parser.add_argument("--baseline", help="Compare with this results JSON and fail on regressions")
+    parser.add_argument("--save-baseline", help="Also write the results as a new baseline here")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown per stage, e.g. 0.2 = 20%%")
+    parser.add_argument("--min-delta", type=float, default=0.005, help="Ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args()
+
+    image_size = tuple(int(value) for value in args.image_size.split("x"))
+    video_size = tuple(int(value) for value in args.video_size.split("x"))
+    work_directory = tempfile.mkdtemp(prefix="stage-benchmark-")
+    media_directory = os.path.join(work_directory, "media")
+    media = fixtures.create_media(media_directory, image_size, video_size, args.video_frames)
+    _, media_url = fixtures.start_http_fixture(media_directory, args.input_delay)
+    _, s3_url = fixtures.start_s3_fixture()
+
+    fixtures.install_stub_engine(work_directory)
+
+    # The services read their settings at import, so the fixtures are wired in first
+    os.environ.update({
+        "FACEFUSION_PATH": work_directory,
+        "FACEFUSION_POOL_SIZE": str(args.pool_size),
+        "FACESWAP_IMAGES_PATH": fixtures.create_library(os.path.join(work_directory, "faceswap-images"), image_size, 6),
+        "AUTOTUNE_PROFILE": "0",
+        "S3_ENDPOINT_URL": s3_url,
+        "S3_BUCKET_NAME": "benchmark",
+        "AWS_ACCESS_KEY": "benchmark",
+        "AWS_SECRET_KEY": "benchmark",
+        "AWS_REGION": "us-east-1",
+        "STUB_IMAGE_LATENCY": str(args.image_latency),
+        "STUB_FRAME_LATENCY": str(args.frame_latency)
+    })
+    instrument()
+    import service
+    client = service.app.test_client()
+
+    urls = {key: f"{media_url}/{os.path.basename(path)}" for key, path in media.items()}
+    results = {
+        "host": {"cpus": os.cpu_count(), "hostname": platform.node(), "python": platform.python_version()},
+        "created_at": time.time(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "save_baseline")},
+        "endpoints": {}
+    }
+    for name in args.endpoints:
+        route, payload_for = endpoints[name]
+        results["endpoints"][name] = run_endpoint(client, route, payload_for if args.cache else _uncached(payload_for), urls, args.repeat)
+        print(json.dumps({name: results["endpoints"][name]["stages"]}))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as file:
+                json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        print(json.dumps({"baseline": args.baseline, "threshold": args.threshold, "regressions": regressions}, indent=2))
+        if regressions:
+            sys.exit(1)
+
+    failed = [name for name, result in results["endpoints"].items() if result["status_codes"] != [200]]
+    if failed:
+        print(f"Endpoints that didn't answer 200: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
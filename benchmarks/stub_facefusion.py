@@ -0,0 +1,81 @@
+import json
+import os
+import sys
+import time
+import cv2
+
+# Stand-in for facefusion.py in the stage benchmarks. It accepts the same headless-run and
+# batch-run flags, spends a controllable time per image or per video frame instead of running
+# the models, and writes the target to the output path with a real decode and encode. The last
+# stdout line reports its own timings so the benchmark can tell dispatch overhead from engine time.
+# Video frames are counted on stderr with a tqdm-style bar, as FaceFusion does.
+#
+#   STUB_IMAGE_LATENCY   seconds per image swap (default 0.05)
+#   STUB_FRAME_LATENCY   seconds per video frame (default 0.005)
+
+started = time.perf_counter()
+image_latency = float(os.getenv("STUB_IMAGE_LATENCY", "0.05"))
+frame_latency = float(os.getenv("STUB_FRAME_LATENCY", "0.005"))
+video_extensions = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v')
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def swap_image(target_path, output_path, quality):
+    image = cv2.imread(target_path)
+    if image is None:
+        raise SystemExit(f"Cannot read target image {target_path}")
+    time.sleep(image_latency)
+    encode_started = time.perf_counter()
+    cv2.imwrite(output_path, image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return time.perf_counter() - encode_started
+
+
+def swap_video(target_path, output_path):
+    capture = cv2.VideoCapture(target_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 24
+    total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) or 1
+    writer = None
+    encode_seconds = 0.0
+    done = 0
+    while True:
+        has_frame, frame = capture.read()
+        if not has_frame:
+            break
+        time.sleep(frame_latency)
+        done += 1
+        percent = min(100, 100 * done // total)
+        sys.stderr.write(f"\rprocessing: {percent:3d}%|{'#' * (percent // 10):<10}| {done}/{total} [stub]")
+        sys.stderr.flush()
+        encode_started = time.perf_counter()
+        if writer is None:
+            writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (frame.shape[1], frame.shape[0]))
+        writer.write(frame)
+        encode_seconds += time.perf_counter() - encode_started
+    capture.release()
+    sys.stderr.write("\n")
+    if writer is None:
+        raise SystemExit(f"Cannot read target video {target_path}")
+    encode_started = time.perf_counter()
+    writer.release()
+    return encode_seconds + time.perf_counter() - encode_started
+
+
+def main():
+    args = sys.argv[1:]
+    target_path = option(args, "--target-path")
+    output_path = option(args, "--output-path")
+    if not ("headless-run" in args or "batch-run" in args) or not target_path or not output_path:
+        raise SystemExit("usage: stub_facefusion.py headless-run|batch-run --target-path ... --output-path ...")
+
+    if target_path.lower().endswith(video_extensions):
+        encode_seconds = swap_video(target_path, output_path)
+    else:
+        encode_seconds = swap_image(target_path, output_path, int(option(args, "--output-image-quality", "90")))
+    print(json.dumps({"stub": {"engine_seconds": round(time.perf_counter() - started, 6), "encode_seconds": round(encode_seconds, 6)}}))
+
+
+if __name__ == '__main__':
+    main()
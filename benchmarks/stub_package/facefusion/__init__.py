@@ -0,0 +1,5 @@
+# Stand-in for the FaceFusion package in the stage benchmarks, installed next to the stub
+# facefusion.py (see stub_facefusion.py) so warm workers can run their in-process jobs: face
+# analysis, in-memory swaps and single-pass swaps. It implements only the functions
+# facefusion_engine calls; the detector finds one face in the middle of every frame and the
+# swapper spends STUB_IMAGE_LATENCY seconds per face instead of running a model.
@@ -0,0 +1 @@
+# Imported by the workers' warmup; the stub has nothing to preload
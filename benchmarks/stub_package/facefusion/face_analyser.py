@@ -0,0 +1,47 @@
+import numpy as np
+from facefusion import face_detector, state_manager
+from facefusion.types import Face
+
+embedding = np.ones(512, dtype=np.float32)
+
+
+def _face(bounding_box, score, landmark_5, angle):
+    landmark_68 = np.resize(landmark_5, (68, 2)).astype(np.float32)
+    return Face(
+        bounding_box=bounding_box,
+        score_set={"detector": score, "landmarker": score},
+        landmark_set={"5": landmark_5, "5/68": landmark_5, "68": landmark_68, "68/5": landmark_68},
+        angle=angle,
+        embedding=embedding,
+        normed_embedding=embedding / np.linalg.norm(embedding),
+        gender="male",
+        age=range(25, 32),
+        race="white"
+    )
+
+
+# Function to detect the faces of frames at the configured angles; the first angle with a face wins
+def get_many_faces(vision_frames):
+    faces = []
+    for vision_frame in vision_frames:
+        if vision_frame is None:
+            continue
+        for angle in state_manager.get_item("face_detector_angles") or [0]:
+            if angle == 0:
+                bounding_boxes, scores, landmarks = face_detector.detect_faces(vision_frame)
+            else:
+                bounding_boxes, scores, landmarks = face_detector.detect_rotated_faces(vision_frame, angle)
+            if bounding_boxes:
+                faces.extend(_face(*detected, angle) for detected in zip(bounding_boxes, scores, landmarks))
+                break
+    return faces
+
+
+def get_one_face(faces, position=0):
+    if not faces:
+        return None
+    return faces[min(position or 0, len(faces) - 1)]
+
+
+def get_average_face(faces):
+    return faces[0] if faces else None
@@ -0,0 +1,32 @@
+import cv2
+import numpy as np
+
+# Skin tone (BGR) of the faces the benchmark fixtures draw, with some slack for JPEG
+skin_low = np.array([125, 155, 195], np.uint8)
+skin_high = np.array([175, 205, 245], np.uint8)
+min_face_fraction = 0.002
+
+
+# Function to "detect" the skin-toned faces the fixtures draw; returns boxes, scores and 5-point landmarks
+def detect_faces(vision_frame):
+    height, width = vision_frame.shape[:2]
+    count, _, stats, _ = cv2.connectedComponentsWithStats(cv2.inRange(vision_frame, skin_low, skin_high))
+    bounding_boxes, scores, landmarks = [], [], []
+    for left, top, box_width, box_height, area in stats[1:count]:
+        if area < min_face_fraction * width * height:
+            continue
+        right, bottom = left + box_width, top + box_height
+        bounding_boxes.append(np.array([left, top, right, bottom], dtype=np.float32))
+        scores.append(0.9)
+        landmarks.append(np.array([
+            [left + box_width * 0.3, top + box_height * 0.4],
+            [left + box_width * 0.7, top + box_height * 0.4],
+            [left + box_width * 0.5, top + box_height * 0.55],
+            [left + box_width * 0.35, top + box_height * 0.75],
+            [left + box_width * 0.65, top + box_height * 0.75]
+        ], dtype=np.float32))
+    return bounding_boxes, scores, landmarks
+
+
+def detect_rotated_faces(vision_frame, angle):
+    return detect_faces(vision_frame)
@@ -0,0 +1,33 @@
+from facefusion import state_manager
+
+order_keys = {
+    "left-right": lambda face: face.bounding_box[0],
+    "right-left": lambda face: -face.bounding_box[0],
+    "top-bottom": lambda face: face.bounding_box[1],
+    "bottom-top": lambda face: -face.bounding_box[1],
+    "small-large": lambda face: (face.bounding_box[2] - face.bounding_box[0]) * (face.bounding_box[3] - face.bounding_box[1]),
+    "large-small": lambda face: -(face.bounding_box[2] - face.bounding_box[0]) * (face.bounding_box[3] - face.bounding_box[1]),
+    "best-worst": lambda face: -face.score_set.get("detector", 0),
+    "worst-best": lambda face: face.score_set.get("detector", 0)
+}
+
+
+# Function to order the faces by --face-selector-order and drop those outside the gender, race and age filters
+def sort_and_filter_faces(faces):
+    if not faces:
+        return faces
+    order = state_manager.get_item("face_selector_order")
+    if order:
+        faces = sorted(faces, key=order_keys[order])
+    gender = state_manager.get_item("face_selector_gender")
+    if gender:
+        faces = [face for face in faces if face.gender == gender]
+    race = state_manager.get_item("face_selector_race")
+    if race:
+        faces = [face for face in faces if face.race == race]
+    age_start = state_manager.get_item("face_selector_age_start")
+    age_end = state_manager.get_item("face_selector_age_end")
+    if age_start is not None or age_end is not None:
+        ages = set(range(age_start or 0, (age_end if age_end is not None else 100) + 1))
+        faces = [face for face in faces if ages & set(face.age)]
+    return faces
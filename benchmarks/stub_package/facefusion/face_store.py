@@ -0,0 +1,13 @@
+_reference_faces = {}
+
+
+def append_reference_face(name, face):
+    _reference_faces.setdefault(name, []).append(face)
+
+
+def get_reference_faces():
+    return _reference_faces or None
+
+
+def clear_reference_faces():
+    _reference_faces.clear()
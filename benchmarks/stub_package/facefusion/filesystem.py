@@ -0,0 +1,7 @@
+import os
+
+image_extensions = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def is_image(path):
+    return bool(path) and path.lower().endswith(image_extensions) and os.path.isfile(path)
@@ -0,0 +1,5 @@
+from facefusion.processors.modules import face_swapper
+
+
+def get_processors_modules(processors):
+    return [face_swapper]
@@ -0,0 +1,13 @@
+import os
+import time
+
+image_latency = float(os.getenv("STUB_IMAGE_LATENCY", "0.05"))
+
+
+def swap_face(source_face, target_face, vision_frame):
+    time.sleep(image_latency)
+    return vision_frame
+
+
+def process_frame(inputs):
+    return swap_face(inputs.get("source_face"), None, inputs["target_vision_frame"])
@@ -0,0 +1,45 @@
+import argparse
+
+# Options that always hold a list, however many values follow them
+list_options = ("source_paths", "face_detector_angles", "processors", "face_mask_types", "face_mask_padding")
+
+defaults = {
+    "face_detector_angles": [0],
+    "face_selector_mode": "reference",
+    "reference_face_position": 0,
+    "reference_face_distance": 0.6,
+    "processors": ["face_swapper"],
+    "output_image_quality": 80
+}
+
+
+def _value(text):
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+class Program:
+    # Function to parse "<command> --option value [value ...] ..." into a namespace of every option given
+    def parse_args(self, args):
+        options = dict(defaults)
+        name = None
+        for arg in list(args)[1:]:
+            if arg.startswith("--"):
+                name = arg[2:].replace("-", "_")
+                # FaceFusion accepts --processor as well as --processors
+                name = "processors" if name == "processor" else name
+                options[name] = []
+            elif name:
+                options[name].append(_value(arg))
+        for key, values in options.items():
+            if isinstance(values, list) and key not in list_options:
+                options[key] = values[0] if len(values) == 1 else values or None
+        return argparse.Namespace(**options)
+
+
+def create_program():
+    return Program()
@@ -0,0 +1,13 @@
+_items = {}
+
+
+def get_item(key):
+    return _items.get(key)
+
+
+def init_item(key, value):
+    _items[key] = value
+
+
+def set_item(key, value):
+    _items[key] = value
@@ -0,0 +1,3 @@
+from collections import namedtuple
+
+Face = namedtuple("Face", ["bounding_box", "score_set", "landmark_set", "angle", "embedding", "normed_embedding", "gender", "age", "race"])
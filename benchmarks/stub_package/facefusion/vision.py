@@ -0,0 +1,9 @@
+import cv2
+
+
+def read_image(image_path):
+    return cv2.imread(image_path)
+
+
+def read_static_image(image_path):
+    return read_image(image_path)
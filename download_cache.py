@@ -0,0 +1,383 @@
+from flask import jsonify
+import asyncio
+import contextlib
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import http_client
+import metrics
+import tracing
+
+# Content-addressed download cache. Blobs are stored once under their SHA-256, URLs map to
+# the blob they last returned together with the ETag/Last-Modified validators, and repeated
+# downloads become conditional requests answered with 304 when the remote file is unchanged.
+# The blob directory is kept under a byte budget by evicting the least recently used blobs.
+# Several processes share the cache: a download pins the blob it is about to place through a
+# counter in the index, with a lease so a crashed process can't keep a blob forever, and eviction
+# skips pinned blobs. Blobs are read-only and placed in workspaces as hard links (or copies with
+# DOWNLOAD_CACHE_PLACE=copy); a blob whose file changed after it was stored is dropped.
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+cache_path = os.getenv("DOWNLOAD_CACHE_PATH", os.path.join(base_path, ".download-cache"))
+cache_max_bytes = int(os.getenv("DOWNLOAD_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+pin_lease_seconds = float(os.getenv("DOWNLOAD_CACHE_PIN_LEASE_SECONDS", "3600"))
+place_mode = os.getenv("DOWNLOAD_CACHE_PLACE", "link")
+chunk_size = 1024 * 1024
+
+_lock = threading.Lock()
+_db = None
+_stats = {"hits": 0, "misses": 0, "revalidations": 0, "evictions": 0, "bytes_downloaded": 0, "bytes_from_cache": 0, "errors": 0}
+
+
+def _connect():
+    global _db
+    if _db is None:
+        os.makedirs(os.path.join(cache_path, "blobs"), exist_ok=True)
+        # Autocommit; writes that must not interleave with other processes use _transaction()
+        _db = sqlite3.connect(os.path.join(cache_path, "index.sqlite3"), check_same_thread=False, timeout=30, isolation_level=None)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, blob TEXT, etag TEXT, last_modified TEXT, fetched_at REAL)")
+        _db.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+        # Columns added after the first release of the cache
+        columns = {row[1] for row in _db.execute("PRAGMA table_info(blobs)")}
+        for name, definition in (("pins", "INTEGER NOT NULL DEFAULT 0"), ("pinned_until", "REAL NOT NULL DEFAULT 0"), ("mtime_ns", "INTEGER")):
+            if name not in columns:
+                _db.execute(f"ALTER TABLE blobs ADD COLUMN {name} {definition}")
+    return _db
+
+
+# Context manager for one index transaction holding the database's write lock, so pins and
+# evictions of the other processes sharing the cache can't interleave with it
+@contextlib.contextmanager
+def _transaction():
+    with _lock:
+        db = _connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
+def _blob_path(blob_hash):
+    return os.path.join(cache_path, "blobs", blob_hash[:2], blob_hash)
+
+
+def _count(name, value=1):
+    with _lock:
+        _stats[name] += value
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        total = result["hits"] + result["misses"]
+        result["hit_ratio"] = round(result["hits"] / total, 4) if total else None
+        db = _connect()
+        result["blobs"], result["bytes_stored"] = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        result["pinned"] = db.execute("SELECT COUNT(*) FROM blobs WHERE pins > 0 AND pinned_until >= ?", (time.time(),)).fetchone()[0]
+    result["max_bytes"] = cache_max_bytes
+    return result
+
+
+# Function to place a cached blob at the destination path, as a hard link to the read-only blob
+# when possible, else as a copy; returns False when the blob is no longer in the cache
+def _materialize(blob_hash, file_path):
+    if not os.path.exists(_blob_path(blob_hash)):
+        return False
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    if place_mode == "link":
+        try:
+            os.link(_blob_path(blob_hash), file_path)
+            return True
+        except OSError:
+            pass
+    shutil.copyfile(_blob_path(blob_hash), file_path)
+    return True
+
+
+# Function to delete a blob and the URLs pointing at it
+def _drop(db, blob_hash):
+    try:
+        os.remove(_blob_path(blob_hash))
+    except OSError:
+        pass
+    db.execute("DELETE FROM blobs WHERE hash = ?", (blob_hash,))
+    db.execute("DELETE FROM urls WHERE blob = ?", (blob_hash,))
+
+
+# Function to evict least recently used blobs until the cache fits its byte budget; blobs that
+# a download of any process is about to materialize (pinned, lease not expired) are skipped
+def _evict(db):
+    total = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+    unpinned = db.execute("SELECT hash, size FROM blobs WHERE pins <= 0 OR pinned_until < ? ORDER BY last_access", (time.time(),)).fetchall()
+    for blob_hash, size in unpinned:
+        if total <= cache_max_bytes:
+            break
+        _drop(db, blob_hash)
+        total -= size
+        _stats["evictions"] += 1
+
+
+# Function to keep a blob from being evicted by any process until _release() or the lease ends;
+# runs inside a _transaction()
+def _pin(db, blob_hash):
+    db.execute("UPDATE blobs SET pins = pins + 1, pinned_until = ? WHERE hash = ?", (time.time() + pin_lease_seconds, blob_hash))
+
+
+# Function to unpin a blob once its download is done with it, then evict what doesn't fit the budget
+def _release(blob_hash):
+    with _transaction() as db:
+        db.execute("UPDATE blobs SET pins = MAX(pins - 1, 0) WHERE hash = ?", (blob_hash,))
+        _evict(db)
+
+
+# Function to tell whether a blob is still the file that was stored: present and not modified
+# since (mtime_ns is None for blobs stored before it was recorded)
+def _intact(blob_hash, mtime_ns):
+    try:
+        stat = os.stat(_blob_path(blob_hash))
+    except OSError:
+        return False
+    return mtime_ns is None or stat.st_mtime_ns == mtime_ns
+
+
+# Function to look up the cached entry of a URL, dropping it if its blob has gone missing or was
+# modified. The blob of a returned entry is pinned; the caller releases it.
+def _lookup(url):
+    with _transaction() as db:
+        row = db.execute(
+            "SELECT urls.blob, urls.etag, urls.last_modified, blobs.mtime_ns FROM urls LEFT JOIN blobs ON blobs.hash = urls.blob WHERE urls.url = ?",
+            (url,)
+        ).fetchone()
+        if row and not _intact(row[0], row[3]):
+            _drop(db, row[0])
+            row = None
+        if row:
+            _pin(db, row[0])
+        return row[:3] if row else None
+
+
+def _touch(blob_hash):
+    with _lock:
+        _connect().execute("UPDATE blobs SET last_access = ? WHERE hash = ?", (time.time(), blob_hash))
+
+
+def _temp_blob_path():
+    return os.path.join(cache_path, "blobs", f".{uuid.uuid4().hex}.part")
+
+
+# Function to move a fully written temp file into the blob store under its content hash, read-only
+# so workspaces linking to it can't change it
+def _commit_blob(temp_path, blob_hash):
+    os.makedirs(os.path.dirname(_blob_path(blob_hash)), exist_ok=True)
+    os.chmod(temp_path, 0o444)
+    os.replace(temp_path, _blob_path(blob_hash))
+
+
+# Function to record the blob a URL returned together with its validators. The blob is pinned;
+# the caller releases it once it has been materialized.
+def _record(url, blob_hash, size, headers):
+    mtime_ns = os.stat(_blob_path(blob_hash)).st_mtime_ns
+    with _transaction() as db:
+        # Pins other processes hold on the same content stay in place
+        db.execute(
+            "INSERT INTO blobs (hash, size, last_access, mtime_ns) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(hash) DO UPDATE SET size = excluded.size, last_access = excluded.last_access, mtime_ns = excluded.mtime_ns",
+            (blob_hash, size, time.time(), mtime_ns)
+        )
+        db.execute(
+            "INSERT OR REPLACE INTO urls (url, blob, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            (url, blob_hash, headers.get("ETag"), headers.get("Last-Modified"), time.time())
+        )
+        _pin(db, blob_hash)
+        _stats["bytes_downloaded"] += size
+    metrics.downloaded_bytes.inc(size, source="network")
+    tracing.annotate(cache="miss", bytes=size)
+
+
+# Function to stream a response body into the blob store and record the URL that produced it
+def _store(url, response):
+    temp_path = _temp_blob_path()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size):
+                http_client.check_deadline()
+                file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        blob_hash = digest.hexdigest()
+        _commit_blob(temp_path, blob_hash)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    _record(url, blob_hash, size, response.headers)
+    return blob_hash
+
+
+# Function to place a freshly stored (pinned) blob at file_path and release it
+def _place(blob_hash, file_path):
+    try:
+        if not _materialize(blob_hash, file_path):
+            raise Exception(f"Blob {blob_hash} is missing from the download cache")
+        return blob_hash
+    finally:
+        _release(blob_hash)
+
+
+# Function to build the conditional request headers for a cached URL entry
+def _validators(cached):
+    headers = {}
+    if cached:
+        _, etag, last_modified = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        if headers:
+            _count("revalidations")
+    return headers
+
+
+# Function to serve a revalidated (304) URL from its cached blob; returns None when the blob has
+# gone missing and the URL has to be downloaded again
+def _hit(blob_hash, file_path):
+    if not _materialize(blob_hash, file_path):
+        return None
+    size = os.path.getsize(file_path)
+    _count("hits")
+    _count("bytes_from_cache", size)
+    metrics.downloaded_bytes.inc(size, source="cache")
+    tracing.annotate(cache="hit", bytes=size)
+    _touch(blob_hash)
+    return blob_hash
+
+
+# Function to download a URL to file_path through the cache; returns the blob's content hash or None
+def fetch(url, file_path):
+    started = time.perf_counter()
+    with tracing.span("download", url=tracing.safe_url(url), path="cache") as download_span:
+        blob_hash = _fetch(url, file_path)
+        download_span.set(ok=blob_hash is not None)
+    metrics.observe_download("cache", started, blob_hash is not None)
+    return blob_hash
+
+
+def _fetch(url, file_path):
+    cached = None
+    try:
+        cached = _lookup(url)
+        response = http_client.get(url, headers=_validators(cached))
+        if cached and response.status_code == 304:
+            response.close()
+            if _hit(cached[0], file_path):
+                return cached[0]
+            # The blob went missing since the lookup; download the file again
+            response = http_client.get(url)
+
+        if response.status_code != 200:
+            response.close()
+            _count("errors")
+            return None
+
+        _count("misses")
+        # The connection only goes back to the pool once the response is closed, also when
+        # the body fails partway (deadline, disk error)
+        try:
+            blob_hash = _store(url, response)
+        finally:
+            response.close()
+        return _place(blob_hash, file_path)
+    except Exception as e:
+        _count("errors")
+        print(f"Error downloading file: {e}")
+        return None
+    finally:
+        if cached:
+            _release(cached[0])
+
+
+# Function to download a URL through the cache on an asyncio HTTP session (aiohttp.ClientSession);
+# same result as fetch() without holding a thread while the body streams in
+async def fetch_async(session, url, file_path):
+    started = time.perf_counter()
+    with tracing.span("download", bind_thread=False, url=tracing.safe_url(url), path="cache") as download_span:
+        blob_hash = await _fetch_async(session, url, file_path)
+        download_span.set(ok=blob_hash is not None)
+    metrics.observe_download("cache", started, blob_hash is not None)
+    return blob_hash
+
+
+# Function to stream an aiohttp response body into the blob store; the file and index work runs
+# on a thread so the event loop only waits on the network
+async def _store_async(url, response):
+    temp_path = _temp_blob_path()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        file = await asyncio.to_thread(open, temp_path, 'wb')
+        try:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                await asyncio.to_thread(file.write, chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        finally:
+            await asyncio.to_thread(file.close)
+        blob_hash = digest.hexdigest()
+        await asyncio.to_thread(_commit_blob, temp_path, blob_hash)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    await asyncio.to_thread(_record, url, blob_hash, size, response.headers)
+    return blob_hash
+
+
+async def _fetch_async(session, url, file_path):
+    cached = None
+    try:
+        cached = await asyncio.to_thread(_lookup, url)
+        headers = _validators(cached)
+        if cached:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    if await asyncio.to_thread(_hit, cached[0], file_path):
+                        return cached[0]
+                    # The blob went missing since the lookup; download the file again below
+                elif response.status == 200:
+                    _count("misses")
+                    return await asyncio.to_thread(_place, await _store_async(url, response), file_path)
+                else:
+                    _count("errors")
+                    return None
+
+        async with session.get(url) as response:
+            if response.status != 200:
+                _count("errors")
+                return None
+            _count("misses")
+            blob_hash = await _store_async(url, response)
+        return await asyncio.to_thread(_place, blob_hash, file_path)
+    except Exception as e:
+        _count("errors")
+        print(f"Error downloading file: {e}")
+        return None
+    finally:
+        if cached:
+            await asyncio.to_thread(_release, cached[0])
+
+
+# Function to add the cache counters endpoint to a service
+def register_routes(app):
+    @app.route('/cache/stats', methods=['GET'])
+    def cache_stats():
+        return jsonify(stats()), 200
@@ -0,0 +1,354 @@
+from flask import request, jsonify
+import fcntl
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import numpy as np
+import download_cache
+import facefusion_pool
+
+# Registry of detected source faces keyed by the content hash of the source image. The face
+# analysis (box, landmarks, scores, embeddings) is kept in memory-mapped arrays, one row per
+# face, with a small JSON index mapping each image hash to its rows. The hash doubles as the
+# face_id clients can send instead of a source URL; plain URLs land in the same store after
+# download because the lookup is by content. Workers are handed the stored faces so the source
+# image isn't detected again on every headless-run.
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+registry_path = os.getenv("FACE_REGISTRY_PATH", os.path.join(base_path, ".face-registry"))
+
+# Detection options used to analyse sources; they match the flags the swap commands pass
+detection_args = [
+    "--face-detector-model", "yoloface",
+    "--face-detector-size", "640x640",
+    "--face-detector-angles", "0", "90", "180", "270",
+    "--face-detector-score", "0.5",
+    "--face-landmarker-model", "2dfan4",
+    "--face-landmarker-score", "0.5",
+    "--execution-providers", "cpu",
+    "--skip-download"
+]
+
+# Shape of every per-face array stored in the memory-mapped files
+face_array_shapes = {
+    "bounding_box": (4,),
+    "landmark_5": (5, 2),
+    "landmark_5_68": (5, 2),
+    "landmark_68": (68, 2),
+    "landmark_68_5": (68, 2),
+    "scores": (2,),
+    "embedding": (512,),
+    "normed_embedding": (512,)
+}
+face_meta_fields = ("angle", "gender", "age", "race")
+
+
+class FaceArrayStore:
+    def __init__(self, directory, initial_capacity=256):
+        self.directory = directory
+        self.initial_capacity = initial_capacity
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock_path = os.path.join(directory, ".lock")
+        self.index = None
+        self.index_mtime = None
+        self.arrays = {}
+        self._load()
+
+    def _array_path(self, name):
+        return os.path.join(self.directory, f"{name}.npy")
+
+    # Function to (re)load the JSON index and memory-map the arrays when another process changed them
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            mtime = None
+        if self.index is not None and mtime == self.index_mtime:
+            return
+
+        if mtime is None:
+            self.index = {"capacity": 0, "rows": 0, "entries": {}}
+        else:
+            with open(self.index_path) as file:
+                self.index = json.load(file)
+        self.index_mtime = mtime
+        self.arrays = {}
+        if self.index["capacity"]:
+            for name in face_array_shapes:
+                self.arrays[name] = np.load(self._array_path(name), mmap_mode="r+")
+
+    # Function to grow the memory-mapped arrays, doubling their capacity
+    def _grow(self, needed_rows):
+        capacity = max(self.initial_capacity, self.index["capacity"])
+        while capacity < needed_rows:
+            capacity *= 2
+        if capacity == self.index["capacity"]:
+            return
+        for name, shape in face_array_shapes.items():
+            grown_path = self._array_path(name) + ".grow"
+            grown = np.lib.format.open_memmap(grown_path, mode="w+", dtype=np.float32, shape=(capacity,) + shape)
+            rows = self.index["rows"]
+            if rows:
+                grown[:rows] = self.arrays[name][:rows]
+            grown.flush()
+            del grown
+            os.replace(grown_path, self._array_path(name))
+            self.arrays[name] = np.load(self._array_path(name), mmap_mode="r+")
+        self.index["capacity"] = capacity
+
+    def _write_index(self):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.index, file)
+        os.replace(temp_path, self.index_path)
+        self.index_mtime = os.path.getmtime(self.index_path)
+
+    def get(self, key):
+        with self.lock:
+            self._load()
+            entry = self.index["entries"].get(key)
+            if entry is None:
+                return None
+            entry = dict(entry)
+            entry["faces"] = [self._read_face(row, meta) for row, meta in zip(entry["rows"], entry["meta"])]
+            return entry
+
+    # Function to get an entry's stored fields and face count without reading its arrays
+    def get_fields(self, key):
+        with self.lock:
+            self._load()
+            entry = self.index["entries"].get(key)
+            if entry is None:
+                return None
+            return dict(entry, face_count=len(entry["rows"]))
+
+    def keys(self):
+        with self.lock:
+            self._load()
+            return list(self.index["entries"])
+
+    def _read_face(self, row, meta):
+        face = {name: np.array(self.arrays[name][row]) for name in face_array_shapes}
+        face.update(meta)
+        return face
+
+    # Function to store the faces of one image under a key, replacing any previous entry
+    def put(self, key, faces, **fields):
+        with self.lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._load()
+            first_row = self.index["rows"]
+            self._grow(first_row + len(faces))
+            rows = []
+            meta = []
+            for offset, face in enumerate(faces):
+                row = first_row + offset
+                for name, shape in face_array_shapes.items():
+                    self.arrays[name][row] = np.asarray(face[name], dtype=np.float32).reshape(shape)
+                rows.append(row)
+                meta.append({field: face.get(field) for field in face_meta_fields})
+            for array in self.arrays.values():
+                array.flush()
+            # Rows of a replaced entry are simply orphaned; the store is append-only
+            self.index["rows"] = first_row + len(faces)
+            self.index["entries"][key] = dict(fields, rows=rows, meta=meta, updated_at=time.time())
+            self._write_index()
+
+
+_store = None
+_store_lock = threading.Lock()
+_hash_cache = {}
+# Sources downloaded by URL are analysed on one background thread, so no request waits for it;
+# the hashes queued there are registered once
+_registration_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="face-registration")
+_registering = set()
+_registering_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = FaceArrayStore(registry_path)
+    return _store
+
+
+# Function to hash a file's content, cached by path, size and modification time
+def content_hash(file_path):
+    stat = os.stat(file_path)
+    cache_key = (file_path, stat.st_size, stat.st_mtime_ns)
+    if cache_key not in _hash_cache:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        if len(_hash_cache) > 1024:
+            _hash_cache.clear()
+        _hash_cache[cache_key] = digest.hexdigest()
+    return _hash_cache[cache_key]
+
+
+def get(face_id):
+    if not face_id:
+        return None
+    return get_store().get(face_id)
+
+
+# Function to keep a copy of an image in the registry under its content hash; returns its path
+def _keep_image(face_id, file_path):
+    blob_path = os.path.join(registry_path, "images", face_id + os.path.splitext(file_path)[1])
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if not os.path.exists(blob_path):
+        shutil.copyfile(file_path, blob_path + ".tmp")
+        os.replace(blob_path + ".tmp", blob_path)
+    return blob_path
+
+
+# Function to detect the faces in an image on a warm worker and store them under its content hash
+def register_file(file_path):
+    face_id = content_hash(file_path)
+    entry = get(face_id)
+    if entry is not None:
+        return face_id, entry
+
+    blob_path = _keep_image(face_id, file_path)
+    faces = facefusion_pool.analyse_image(blob_path, detection_args)
+    get_store().put(face_id, faces, image_path=blob_path)
+    return face_id, get(face_id)
+
+
+def _register_in_background(face_id, blob_path):
+    try:
+        if get(face_id) is None:
+            get_store().put(face_id, facefusion_pool.analyse_image(blob_path, detection_args, "indexing"), image_path=blob_path)
+    except Exception as e:
+        print(f"Error registering source face: {e}")
+    finally:
+        with _registering_lock:
+            _registering.discard(face_id)
+
+
+# Function to get the local source image for a request, either from a registered face_id or by
+# downloading the URL. Downloads are registered separately, after the preflight check (see register_source).
+def resolve_source(source_url, face_id, file_path, download):
+    if face_id:
+        entry = get(face_id)
+        return entry["image_path"] if entry else None
+
+    if not download(source_url, file_path):
+        return None
+    return file_path
+
+
+# Function to register a downloaded source, so the next request with the same image skips
+# detection; face_id sources are registered already. Only the copy into the registry happens
+# here (the request's workspace goes away with it); the analysis runs in the background.
+def register_source(face_id, file_path):
+    if face_id:
+        return
+    try:
+        face_id = content_hash(file_path)
+        if get(face_id) is not None:
+            return
+        with _registering_lock:
+            if face_id in _registering:
+                return
+            _registering.add(face_id)
+        try:
+            blob_path = _keep_image(face_id, file_path)
+        except Exception:
+            with _registering_lock:
+                _registering.discard(face_id)
+            raise
+        _registration_executor.submit(_register_in_background, face_id, blob_path)
+    except Exception as e:
+        print(f"Error registering source face: {e}")
+
+
+# Function to get what the preflight check looks at for a source: the number of faces FaceFusion
+# found in it when it is registered (by face_id or by content), else its file
+def preflight_input(face_id, file_path):
+    fields = get_store().get_fields(face_id or content_hash(file_path))
+    return fields["face_count"] if fields else file_path
+
+
+# Function to collect the stored faces of the given source images
+def faces_for_paths(paths):
+    seeds = {}
+    for path in paths:
+        try:
+            entry = get(content_hash(path))
+        except OSError:
+            continue
+        if entry and entry["faces"]:
+            seeds[path] = entry["faces"]
+    return seeds
+
+
+# Function to collect the stored faces for every source image of a FaceFusion command
+def seed_faces(command):
+    if "--source-paths" not in command:
+        return {}
+    paths = []
+    for path in command[command.index("--source-paths") + 1:]:
+        if path.startswith("--"):
+            break
+        paths.append(path)
+    return faces_for_paths(paths)
+
+
+def _describe(face_id, entry):
+    return {
+        "face_id": face_id,
+        "faces": [
+            {
+                "bounding_box": [round(float(value), 2) for value in face["bounding_box"]],
+                "detector_score": round(float(face["scores"][0]), 4),
+                "angle": face["angle"],
+                "gender": face["gender"],
+                "age": face["age"]
+            }
+            for face in entry["faces"]
+        ]
+    }
+
+
+# Function to add the face registration endpoints to a service
+def register_routes(app):
+    @app.route('/faces', methods=['POST'])
+    def register_face():
+        data = request.json or {}
+        source_url = data.get('source_url')
+        if not source_url:
+            return jsonify({"error": "Source URL is required"}), 400
+
+        download_path = os.path.join(registry_path, "downloads", f"{os.getpid()}-{threading.get_ident()}.jpg")
+        os.makedirs(os.path.dirname(download_path), exist_ok=True)
+        try:
+            if download_cache.fetch(source_url, download_path) is None:
+                return jsonify({"error": "Failed to download source image"}), 500
+            face_id, entry = register_file(download_path)
+        except facefusion_pool.WorkerError as e:
+            return jsonify({"error": f"Face analysis is unavailable: {e}"}), 503
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        finally:
+            if os.path.exists(download_path):
+                os.remove(download_path)
+
+        if not entry["faces"]:
+            return jsonify({"error": "No face detected in source image", "face_id": face_id}), 422
+        return jsonify(_describe(face_id, entry)), 200
+
+    @app.route('/faces/<face_id>', methods=['GET'])
+    def get_face(face_id):
+        entry = get(face_id)
+        if not entry:
+            return jsonify({"error": "Unknown face_id"}), 404
+        return jsonify(_describe(face_id, entry)), 200
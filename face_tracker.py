@@ -0,0 +1,127 @@
+from collections import Counter
+import hashlib
+import cv2
+import numpy as np
+
+# Follows detected faces from frame to frame with pyramidal Lucas-Kanade optical flow, so a
+# video only pays for full detection and landmarking every few frames. The tracked 68 landmark
+# points give a similarity transform that moves the box and the other landmark sets; the
+# embeddings stay those of the last detection. Detection runs again on the interval, on a
+# scene cut, when the frame has no faces and whenever too few points track reliably.
+# Used inside the FaceFusion workers (see facefusion_engine); frames must arrive in order.
+
+lk_params = {
+    "winSize": (21, 21),
+    "maxLevel": 3,
+    "criteria": (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)
+}
+thumbnail_size = (64, 36)
+
+
+class FaceTracker:
+    def __init__(self, detect_every=10, min_confidence=0.8, scene_cut_threshold=40.0):
+        self.detect_every = max(1, int(detect_every))
+        self.min_confidence = min_confidence
+        self.scene_cut_threshold = scene_cut_threshold
+        self.faces = []
+        self.frames_since_detection = 0
+        self.previous_key = None
+        self.previous_gray = None
+        self.previous_thumbnail = None
+        self.stats = Counter()
+
+    # Function to get the faces of the next frame, running detect([frame]) only when tracking can't be trusted
+    def faces_for(self, vision_frame, detect):
+        key = hashlib.blake2b(vision_frame.tobytes(), digest_size=16).hexdigest()
+        # FaceFusion asks for the faces of the same frame more than once (reference, swap, mask)
+        if key == self.previous_key:
+            return self.faces
+
+        gray = cv2.cvtColor(vision_frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, thumbnail_size, interpolation=cv2.INTER_AREA).astype(np.int16)
+        reason = self._redetect_reason(thumbnail)
+        faces = None
+        if reason is None:
+            faces = self._track(gray)
+            if faces is None:
+                reason = "low_confidence"
+
+        if faces is None:
+            faces = list(detect([vision_frame]))
+            self.frames_since_detection = 0
+            self.stats["detected_frames"] += 1
+            self.stats[reason] += 1
+        else:
+            self.frames_since_detection += 1
+            self.stats["tracked_frames"] += 1
+
+        self.faces = faces
+        self.previous_key = key
+        self.previous_gray = gray
+        self.previous_thumbnail = thumbnail
+        return faces
+
+    def _redetect_reason(self, thumbnail):
+        if self.previous_gray is None:
+            return "first_frame"
+        if not self.faces:
+            return "no_faces"
+        if self.frames_since_detection + 1 >= self.detect_every:
+            return "interval"
+        if np.abs(thumbnail - self.previous_thumbnail).mean() > self.scene_cut_threshold:
+            return "scene_cut"
+        return None
+
+    # Function to move the previous faces onto the new frame; returns None when any face is lost
+    def _track(self, gray):
+        # Faces without 68 landmarks have nothing to track
+        if any(face.landmark_set.get("68") is None for face in self.faces):
+            return None
+        points = np.concatenate([face.landmark_set["68"] for face in self.faces]).astype(np.float32).reshape(-1, 1, 2)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, points, None, **lk_params)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous_gray, next_points, None, **lk_params)
+        # Forward-backward check: a reliable point tracks back to where it started
+        back_error = np.linalg.norm((points - back_points).reshape(-1, 2), axis=1)
+
+        tracked_faces = []
+        for index, face in enumerate(self.faces):
+            rows = slice(index * 68, (index + 1) * 68)
+            box_width, box_height = face.bounding_box[2] - face.bounding_box[0], face.bounding_box[3] - face.bounding_box[1]
+            max_error = max(1.0, 0.02 * float(np.hypot(box_width, box_height)))
+            good = (status[rows, 0] == 1) & (back_status[rows, 0] == 1) & (back_error[rows] < max_error)
+            if good.mean() < self.min_confidence:
+                return None
+            old_points = points[rows, 0][good]
+            new_points = next_points[rows, 0][good]
+            matrix, inliers = cv2.estimateAffinePartial2D(old_points, new_points, method=cv2.RANSAC, ransacReprojThreshold=3.0)
+            if matrix is None or inliers.mean() < self.min_confidence:
+                return None
+            tracked_faces.append(_move_face(face, matrix, next_points[rows, 0], good))
+        return tracked_faces
+
+    # Function to get the tracking counters, e.g. {"detected_frames": 12, "tracked_frames": 108, "interval": 11, ...}
+    def take_stats(self):
+        stats = dict(self.stats)
+        self.stats.clear()
+        return stats
+
+
+def _transform(points, matrix):
+    points = np.asarray(points, dtype=np.float32)
+    return (points @ matrix[:, :2].T + matrix[:, 2]).astype(np.float32)
+
+
+# Function to apply a frame-to-frame transform to a FaceFusion Face. The 68 landmarks use the
+# tracked points where they tracked and the transform elsewhere.
+def _move_face(face, matrix, tracked_points, good):
+    x1, y1, x2, y2 = face.bounding_box
+    corners = _transform([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], matrix)
+    landmark_68 = _transform(face.landmark_set["68"], matrix)
+    landmark_68[good] = tracked_points[good]
+    # FaceFusion leaves a landmark set it didn't compute as None
+    landmark_set = {name: None if points is None else _transform(points, matrix) for name, points in face.landmark_set.items() if name != "68"}
+    landmark_set["68"] = landmark_68
+    return face._replace(
+        bounding_box=np.array([*corners.min(axis=0), *corners.max(axis=0)], dtype=np.float32),
+        landmark_set=landmark_set
+    )
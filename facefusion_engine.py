@@ -0,0 +1,826 @@
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import runpy
+import sys
+import threading
+from collections import Counter
+import numpy as np
+import profiler
+import progress
+
+# Code in this module runs inside the long-lived FaceFusion worker processes
+# started by facefusion_pool. Nothing here is imported by the Flask services.
+
+
+_original_get_many_faces = None
+_original_read_image = None
+# Faces handed over by the API for the current job, keyed by the hash of the decoded frame. A
+# thumbnail of each seeded frame also matches copies FaceFusion re-encoded or resized on the way
+# (an image target is processed from its copy at the output path, not from the file we seeded).
+_seeded_faces = {}
+_seeded_shapes = set()
+_seeded_thumbnails = []
+seed_thumbnail_size = (64, 64)
+# Flat images (dark, blank) could look alike at thumbnail size; they only match exactly
+seed_thumbnail_min_contrast = 10.0
+seed_match_threshold = float(os.getenv("FACE_SEED_MATCH_THRESHOLD", "3"))
+
+# Adaptive detection: detect at 0° first and only try the other --face-detector-angles when nothing
+# clears --face-detector-score. Set per job from the pool's message.
+adaptive_angles = True
+# Detector runs and matched angles of the current job, reported back to the API
+_detector_calls = 0
+_matched_angles = Counter()
+_stats_lock = threading.Lock()
+# FaceFusion detects frames on several threads at once, so the angle an adaptive detection is
+# trying is kept per thread; the configured --face-detector-angles in state_manager stay untouched
+_local = threading.local()
+exif_orientation_tag = 0x0112
+# Face tracking between detections for videos: settings of the current job and one tracker per
+# frame size, so source images of another size don't break the video's sequence
+_tracker_settings = None
+_trackers = {}
+# Regions processed instead of whole frames in the current job (see _process_regions)
+_region_stats = Counter()
+
+
+# Function to preload the FaceFusion modules so the first job doesn't pay for the imports
+def warmup():
+    try:
+        import facefusion.core  # noqa: F401
+        _install_face_hooks()
+    except (Exception, SystemExit) as e:
+        print(f"FaceFusion warmup failed: {e}")
+
+
+# Function to swap a FaceFusion function for our own in every module that already imported it.
+# Modules imported later pick the replacement up from the defining module.
+def _replace_function(module_name, name, replacement):
+    module = sys.modules[module_name]
+    original = getattr(module, name)
+    for loaded_module in list(sys.modules.values()):
+        if getattr(loaded_module, "__name__", "").startswith("facefusion") and getattr(loaded_module, name, None) is original:
+            setattr(loaded_module, name, replacement)
+    return original
+
+
+def _install_face_hooks():
+    global _original_get_many_faces, _original_read_image
+    if _original_get_many_faces is None:
+        import facefusion.face_analyser  # noqa: F401
+        import facefusion.face_detector  # noqa: F401
+        import facefusion.vision  # noqa: F401
+        _original_get_many_faces = _replace_function("facefusion.face_analyser", "get_many_faces", _get_many_faces)
+        _original_read_image = _replace_function("facefusion.vision", "read_image", _read_image)
+        _replace_function("facefusion.face_detector", "detect_faces", _at_angle(facefusion.face_detector.detect_faces, False))
+        _replace_function("facefusion.face_detector", "detect_rotated_faces", _at_angle(facefusion.face_detector.detect_rotated_faces, True))
+
+
+# Function to wrap a FaceFusion detector so it only runs at the angle this thread's _detect_faces
+# is trying (see _local) and counts its runs
+def _at_angle(detect, rotated):
+    def detect_at_angle(vision_frame, *args, **kwargs):
+        global _detector_calls
+        # detect_rotated_faces runs detect_faces on the rotated frame
+        if getattr(_local, "detecting", False):
+            return detect(vision_frame, *args, **kwargs)
+        angle = (args[0] if args else kwargs.get("angle")) if rotated else 0
+        if getattr(_local, "angle", None) not in (None, angle):
+            return [], [], []
+        with _stats_lock:
+            _detector_calls += 1
+        _local.detecting = True
+        try:
+            return detect(vision_frame, *args, **kwargs)
+        finally:
+            _local.detecting = False
+    return detect_at_angle
+
+
+# Function to decode an image with its EXIF orientation applied; returns None when the image has no
+# rotation to apply (or Pillow isn't installed) so the caller can use the normal decoder
+def _decode_upright(source):
+    import cv2
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+    try:
+        with Image.open(source) as image:
+            if image.getexif().get(exif_orientation_tag, 1) == 1:
+                return None
+            upright = ImageOps.exif_transpose(image).convert("RGB")
+        return cv2.cvtColor(np.asarray(upright), cv2.COLOR_RGB2BGR)
+    except Exception:
+        return None
+
+
+# Replacement for vision.read_image that rotates photos by their EXIF orientation, so upright
+# faces are found by the first detection at 0°
+def _read_image(image_path):
+    vision_frame = _decode_upright(image_path)
+    if vision_frame is None:
+        return _original_read_image(image_path)
+    return vision_frame
+
+
+# Function to detect faces at 0° first and fall back to the other configured angles one at a time
+def _detect_faces(vision_frames):
+    from facefusion import state_manager
+    angles = state_manager.get_item("face_detector_angles") or [0]
+    if not adaptive_angles or len(angles) == 1:
+        return _original_get_many_faces(vision_frames)
+
+    faces = []
+    try:
+        for vision_frame in vision_frames:
+            for angle in [0] + [angle for angle in angles if angle != 0]:
+                _local.angle = angle
+                found = _original_get_many_faces([vision_frame])
+                if found:
+                    with _stats_lock:
+                        _matched_angles[angle] += 1
+                    faces.extend(found)
+                    break
+    finally:
+        _local.angle = None
+    return faces
+
+
+# Function to follow faces from the previous frame when tracking is on, detecting only when needed
+def _track_or_detect(vision_frames):
+    if not _tracker_settings:
+        return _detect_faces(vision_frames)
+    import face_tracker
+    faces = []
+    for vision_frame in vision_frames:
+        tracker = _trackers.get(vision_frame.shape)
+        if tracker is None:
+            tracker = _trackers[vision_frame.shape] = face_tracker.FaceTracker(**_tracker_settings)
+        faces.extend(tracker.faces_for(vision_frame, _detect_faces))
+    return faces
+
+
+# Function to get the faces of a sequence of frames, e.g. to compare tracking with full detection
+def analyse_frames(vision_frames, tracking=None):
+    global _tracker_settings
+    _install_face_hooks()
+    _tracker_settings = tracking
+    try:
+        return [_track_or_detect([vision_frame]) for vision_frame in vision_frames]
+    finally:
+        _tracker_settings = None
+
+
+# Function to summarize the detection work of the current job and reset the counters
+def take_detection_stats():
+    global _detector_calls
+    with _stats_lock:
+        stats = {
+            "adaptive": adaptive_angles,
+            "detector_calls": _detector_calls,
+            "matched_angles": {str(angle): count for angle, count in _matched_angles.items()}
+        }
+        _detector_calls = 0
+        _matched_angles.clear()
+    if _trackers:
+        tracking = Counter()
+        for tracker in _trackers.values():
+            tracking.update(tracker.take_stats())
+        stats["tracking"] = dict(tracking)
+        _trackers.clear()
+    if _region_stats:
+        stats["regions"] = dict(_region_stats)
+        _region_stats.clear()
+    return stats
+
+
+def _frame_key(vision_frame):
+    return hashlib.blake2b(vision_frame.tobytes(), digest_size=16).hexdigest()
+
+
+# Replacement for face_analyser.get_many_faces that answers seeded frames without running detection
+def _get_many_faces(vision_frames):
+    if not _seeded_faces:
+        return _track_or_detect(vision_frames)
+
+    faces = []
+    missing_frames = []
+    for vision_frame in vision_frames:
+        seeded = _lookup_seeded(vision_frame)
+        if seeded is None:
+            missing_frames.append(vision_frame)
+        else:
+            faces.extend(seeded)
+    if missing_frames:
+        faces.extend(_track_or_detect(missing_frames))
+    return faces
+
+
+def _thumbnail(vision_frame):
+    import cv2
+    gray = cv2.cvtColor(vision_frame, cv2.COLOR_BGR2GRAY) if vision_frame.ndim == 3 else vision_frame
+    return cv2.resize(gray, seed_thumbnail_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+# Function to find the seeded faces of a frame: the exact frame first, else a seeded frame with
+# the same aspect ratio and a near-identical thumbnail, with its faces scaled to this frame's size
+def _lookup_seeded(vision_frame):
+    if vision_frame.shape in _seeded_shapes:
+        seeded = _seeded_faces.get(_frame_key(vision_frame))
+        if seeded is not None:
+            return seeded
+
+    height, width = vision_frame.shape[:2]
+    thumbnail = None
+    for seeded_thumbnail, (seeded_height, seeded_width), faces in _seeded_thumbnails:
+        if abs(width / height - seeded_width / seeded_height) > 0.01:
+            continue
+        if thumbnail is None:
+            thumbnail = _thumbnail(vision_frame)
+        if np.abs(thumbnail - seeded_thumbnail).mean() < seed_match_threshold:
+            return _scale_faces(faces, width / seeded_width, height / seeded_height)
+    return None
+
+
+def _scale_faces(faces, scale_x, scale_y):
+    if scale_x == 1 and scale_y == 1:
+        return faces
+    scale = np.array([scale_x, scale_y], dtype=np.float32)
+    return [
+        face._replace(
+            bounding_box=(np.asarray(face.bounding_box) * np.tile(scale, 2)).astype(np.float32),
+            landmark_set={name: None if points is None else (np.asarray(points) * scale).astype(np.float32) for name, points in face.landmark_set.items()}
+        )
+        for face in faces
+    ]
+
+
+def _face_type():
+    try:
+        from facefusion.types import Face
+    except ImportError:
+        from facefusion.typing import Face
+    return Face
+
+
+# Function to flatten a FaceFusion Face into the arrays and fields stored by face_registry
+def face_to_dict(face):
+    landmark_set = face.landmark_set
+    age = face.age
+    return {
+        "bounding_box": np.asarray(face.bounding_box, dtype=np.float32),
+        "landmark_5": np.asarray(landmark_set.get("5"), dtype=np.float32),
+        "landmark_5_68": np.asarray(landmark_set.get("5/68"), dtype=np.float32),
+        "landmark_68": np.asarray(landmark_set.get("68"), dtype=np.float32),
+        "landmark_68_5": np.asarray(landmark_set.get("68/5"), dtype=np.float32),
+        "scores": np.asarray([face.score_set.get("detector", 0), face.score_set.get("landmarker", 0)], dtype=np.float32),
+        "embedding": np.asarray(face.embedding, dtype=np.float32),
+        "normed_embedding": np.asarray(face.normed_embedding, dtype=np.float32),
+        "angle": int(face.angle),
+        "gender": face.gender,
+        "age": [age.start, age.stop] if isinstance(age, range) else int(age),
+        "race": getattr(face, "race", None)
+    }
+
+
+# Function to rebuild a FaceFusion Face from its stored form
+def face_from_dict(data):
+    Face = _face_type()
+    age = data.get("age")
+    values = {
+        "bounding_box": np.asarray(data["bounding_box"], dtype=np.float32),
+        "score_set": {"detector": float(data["scores"][0]), "landmarker": float(data["scores"][1])},
+        "landmark_set": {
+            "5": np.asarray(data["landmark_5"], dtype=np.float32),
+            "5/68": np.asarray(data["landmark_5_68"], dtype=np.float32),
+            "68": np.asarray(data["landmark_68"], dtype=np.float32),
+            "68/5": np.asarray(data["landmark_68_5"], dtype=np.float32)
+        },
+        "angle": data.get("angle"),
+        "embedding": np.asarray(data["embedding"], dtype=np.float32),
+        "normed_embedding": np.asarray(data["normed_embedding"], dtype=np.float32),
+        "gender": data.get("gender"),
+        "age": range(*age) if isinstance(age, (list, tuple)) else age,
+        "race": data.get("race")
+    }
+    return Face(**{field: values.get(field) for field in Face._fields})
+
+
+# Function to register already detected faces for the images of the next job
+def seed_faces(faces_by_path):
+    from facefusion.vision import read_static_image
+    for image_path, faces in faces_by_path.items():
+        vision_frame = read_static_image(image_path)
+        if vision_frame is None:
+            continue
+        seeded = [face_from_dict(face) for face in faces]
+        _seeded_faces[_frame_key(vision_frame)] = seeded
+        _seeded_shapes.add(vision_frame.shape)
+        thumbnail = _thumbnail(vision_frame)
+        if thumbnail.std() >= seed_thumbnail_min_contrast:
+            _seeded_thumbnails.append((thumbnail, vision_frame.shape[:2], seeded))
+
+
+def clear_seeded_faces():
+    _seeded_faces.clear()
+    _seeded_shapes.clear()
+    _seeded_thumbnails.clear()
+
+
+# Function to apply FaceFusion CLI arguments to its state without running a job
+def apply_program_args(args):
+    from facefusion import state_manager
+    from facefusion.args import apply_args
+    from facefusion.program import create_program
+    program = create_program()
+    apply_args(vars(program.parse_args(args)), state_manager.init_item)
+
+
+# Function to detect, landmark and embed every face of an image
+def analyse_image(image_path, args):
+    from facefusion.vision import read_static_image
+    _install_face_hooks()
+    apply_program_args(["headless-run", "--source-paths", image_path, "--target-path", image_path, "--output-path", image_path] + list(args))
+    vision_frame = read_static_image(image_path)
+    if vision_frame is None:
+        raise Exception(f"Could not read image {image_path}")
+    return [face_to_dict(face) for face in _detect_faces([vision_frame])]
+
+
+# Function to count the faces FaceFusion's detector finds in a decoded frame, without landmarks or
+# embeddings, trying the --face-detector-angles one at a time until wanted are found (see preflight)
+def count_faces(vision_frame, args, wanted=1):
+    import cv2
+    from facefusion import state_manager
+    from facefusion.face_detector import detect_faces, detect_rotated_faces
+    apply_program_args(["headless-run"] + list(args))
+    found = 0
+    for angle in state_manager.get_item("face_detector_angles") or [0]:
+        bounding_boxes, scores, _ = detect_faces(vision_frame) if angle == 0 else detect_rotated_faces(vision_frame, angle)
+        # The detector may return overlapping boxes for one face; get_many_faces merges them the same way
+        boxes = [[float(x1), float(y1), float(x2 - x1), float(y2 - y1)] for x1, y1, x2, y2 in bounding_boxes]
+        found = max(found, len(cv2.dnn.NMSBoxes(boxes, [float(score) for score in scores], 0, 0.4)) if boxes else 0)
+        if found >= wanted:
+            break
+    return found
+
+
+def _resolution_scale(vision_frame, resolution):
+    if not resolution:
+        return 1.0
+    max_width, max_height = (int(value) for value in resolution.split("x"))
+    height, width = vision_frame.shape[:2]
+    return min(max_width / width, max_height / height)
+
+
+# Function to shrink a frame to fit the output resolution, the way FaceFusion restricts image targets
+def _restrict_resolution(vision_frame, resolution):
+    import cv2
+    scale = _resolution_scale(vision_frame, resolution)
+    if scale >= 1:
+        return vision_frame
+    height, width = vision_frame.shape[:2]
+    return cv2.resize(vision_frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+# Face-region (ROI) processing of images larger than the output resolution. Instead of shrinking
+# the whole frame and processing all of it, faces are found on a copy scaled down to
+# detect_size, a region padded by padding x the face size is cut around each selected face from
+# the full-resolution frame, and only those regions are processed and blended back, so the
+# output keeps the native resolution and the pixel work follows the size of the faces. The
+# box and region masks are computed inside each region as usual; the padding keeps them away
+# from its edges and the edges are feathered by feather x the region size. Settings come with
+# each job (see facefusion_pool.face_region_settings).
+
+# Function to find the faces of a frame on a copy scaled down to detect_size; boxes and
+# landmarks are returned in the frame's own coordinates
+def _detect_scaled_down(vision_frame, detect_size):
+    import cv2
+    height, width = vision_frame.shape[:2]
+    _region_stats["frames"] += 1
+    _region_stats["frame_pixels"] += height * width
+    scale = detect_size / max(height, width)
+    if scale >= 1:
+        return list(_get_many_faces([vision_frame]))
+    small_frame = cv2.resize(vision_frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    return _scale_faces(list(_get_many_faces([small_frame])), width / small_frame.shape[1], height / small_frame.shape[0])
+
+
+def _shift_faces(faces, offset_x, offset_y):
+    offset = np.array([offset_x, offset_y], dtype=np.float32)
+    return [
+        face._replace(
+            bounding_box=(np.asarray(face.bounding_box) - np.tile(offset, 2)).astype(np.float32),
+            landmark_set={name: None if points is None else (np.asarray(points) - offset).astype(np.float32) for name, points in face.landmark_set.items()}
+        )
+        for face in faces
+    ]
+
+
+def _overlaps(region, other):
+    return region[0] < other[2] and other[0] < region[2] and region[1] < other[3] and other[1] < region[3]
+
+
+def _box_overlap(box, other):
+    width = min(box[2], other[2]) - max(box[0], other[0])
+    height = min(box[3], other[3]) - max(box[1], other[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    union = (box[2] - box[0]) * (box[3] - box[1]) + (other[2] - other[0]) * (other[3] - other[1]) - width * height
+    return float(width * height / union)
+
+
+# Function to get the padded regions (x1, y1, x2, y2) around faces, merging regions that overlap
+def _face_regions(faces, shape, padding):
+    height, width = shape[:2]
+    regions = []
+    for face in faces:
+        x1, y1, x2, y2 = (float(value) for value in face.bounding_box)
+        margin = padding * max(x2 - x1, y2 - y1)
+        regions.append((max(0, int(x1 - margin)), max(0, int(y1 - margin)), min(width, int(np.ceil(x2 + margin))), min(height, int(np.ceil(y2 + margin)))))
+
+    merged = True
+    while merged:
+        merged = False
+        for index, region in enumerate(regions):
+            other_index = next((other_index for other_index in range(index + 1, len(regions)) if _overlaps(region, regions[other_index])), None)
+            if other_index is not None:
+                other = regions.pop(other_index)
+                regions[index] = (min(region[0], other[0]), min(region[1], other[1]), max(region[2], other[2]), max(region[3], other[3]))
+                merged = True
+                break
+    return regions
+
+
+# Function to get the blend weights of a region: 1 inside, falling to 0 towards every edge that
+# lies inside the frame, so a region never shows a seam
+def _region_weights(region, shape, feather):
+    x1, y1, x2, y2 = region
+    height, width = y2 - y1, x2 - x1
+    border = max(1.0, feather * min(height, width))
+    rows = np.arange(height, dtype=np.float32)
+    columns = np.arange(width, dtype=np.float32)
+    top = np.minimum((rows + 1) / border, 1) if y1 > 0 else np.ones(height, np.float32)
+    bottom = np.minimum((height - rows) / border, 1) if y2 < shape[0] else np.ones(height, np.float32)
+    left = np.minimum((columns + 1) / border, 1) if x1 > 0 else np.ones(width, np.float32)
+    right = np.minimum((width - columns) / border, 1) if x2 < shape[1] else np.ones(width, np.float32)
+    return np.minimum.outer(np.minimum(top, bottom), np.minimum(left, right))[..., None]
+
+
+# Function to process the regions around faces of a full-resolution frame and blend them back;
+# process(region_frame, region) returns the processed region frame
+def _process_regions(vision_frame, faces, settings, process):
+    output_frame = vision_frame.copy()
+    for region in _face_regions(faces, vision_frame.shape, settings["padding"]):
+        x1, y1, x2, y2 = region
+        _region_stats["regions"] += 1
+        _region_stats["region_pixels"] += (x2 - x1) * (y2 - y1)
+        original = output_frame[y1:y2, x1:x2]
+        processed = process(original.copy(), region)
+        weights = _region_weights(region, vision_frame.shape, settings["feather"])
+        output_frame[y1:y2, x1:x2] = np.clip(processed * weights + original * (1 - weights) + 0.5, 0, 255).astype(np.uint8)
+    return output_frame
+
+
+# Function to find a face again inside its full-resolution region, for landmarks more precise than
+# the scaled-down detection gave: the detected face overlapping it most, else the face as it was
+def _region_face(region_frame, region, face):
+    shifted_face = _shift_faces([face], region[0], region[1])[0]
+    best_face, best_overlap = shifted_face, 0.3
+    for candidate in _get_many_faces([region_frame]):
+        overlap = _box_overlap(candidate.bounding_box, shifted_face.bounding_box)
+        if overlap > best_overlap:
+            best_face, best_overlap = candidate, overlap
+    return best_face
+
+
+# Function to order and filter faces the way the CLI does before it picks any of them
+# (--face-selector-order, --face-selector-gender, --face-selector-age-start/-end, --face-selector-race).
+# FaceFusion versions without face_selector already do this inside get_many_faces.
+def _sort_and_filter(faces):
+    try:
+        from facefusion.face_selector import sort_and_filter_faces
+    except ImportError:
+        return list(faces or [])
+    return list(sort_and_filter_faces(list(faces or [])) or [])
+
+
+# Function to pick the faces of a frame the processors will change, following --face-selector-mode
+def _select_faces(faces, reference_face):
+    from facefusion import state_manager
+    from facefusion.face_analyser import get_one_face
+    faces = _sort_and_filter(faces)
+    face_selector_mode = state_manager.get_item("face_selector_mode")
+    if "reference" in face_selector_mode:
+        if reference_face is None:
+            return []
+        distance = state_manager.get_item("reference_face_distance")
+        return [face for face in faces if 1 - np.dot(face.normed_embedding, reference_face.normed_embedding) < distance]
+    if face_selector_mode == "one":
+        face = get_one_face(faces)
+        return [face] if face else []
+    return faces
+
+
+# Function to tell whether a frame is processed region by region with these settings
+def _uses_regions(vision_frame, face_regions):
+    from facefusion import state_manager
+    return bool(face_regions) and _resolution_scale(vision_frame, state_manager.get_item("output_image_resolution")) < 1
+
+
+def _decode_bytes(image_bytes):
+    import cv2
+    vision_frame = _decode_upright(io.BytesIO(image_bytes))
+    if vision_frame is None:
+        vision_frame = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    return vision_frame
+
+
+# Function to run the configured processors on a target frame with the program args applied:
+# on the whole frame restricted to the output resolution, or region by region (see above)
+def _swap_frame(source_face, target_frame, face_regions=None):
+    from facefusion import state_manager
+    from facefusion.face_analyser import get_one_face
+    from facefusion.face_store import append_reference_face, clear_reference_faces, get_reference_faces
+    from facefusion.processors.core import get_processors_modules
+    if _uses_regions(target_frame, face_regions):
+        target_faces = _detect_scaled_down(target_frame, face_regions["detect_size"])
+    else:
+        face_regions = None
+        target_frame = _restrict_resolution(target_frame, state_manager.get_item("output_image_resolution"))
+
+    clear_reference_faces()
+    reference_face = None
+    reference_faces = None
+    if "reference" in state_manager.get_item("face_selector_mode"):
+        # Same pick as the CLI's conditional_append_reference_faces: the face at --reference-face-position
+        # among the sorted and filtered faces
+        candidate_faces = target_faces if face_regions else _get_many_faces([target_frame])
+        reference_face = get_one_face(_sort_and_filter(candidate_faces), state_manager.get_item("reference_face_position"))
+        if reference_face:
+            append_reference_face("origin", reference_face)
+        reference_faces = get_reference_faces()
+
+    processor_modules = get_processors_modules(state_manager.get_item("processors"))
+
+    def process(vision_frame, region=None):
+        for processor_module in processor_modules:
+            vision_frame = processor_module.process_frame({
+                "reference_faces": reference_faces,
+                "source_face": source_face,
+                "target_vision_frame": vision_frame
+            })
+        return vision_frame
+
+    if face_regions:
+        return _process_regions(target_frame, _select_faces(target_faces, reference_face), face_regions, process)
+    return process(target_frame)
+
+
+# Function to run the configured processors on decoded frames and return the encoded JPEG,
+# without FaceFusion reading or writing any file
+def swap_in_memory(args, source_bytes, target_bytes, source_faces=None, face_regions=None):
+    import cv2
+    from facefusion import state_manager
+    from facefusion.face_analyser import get_average_face
+    _install_face_hooks()
+    apply_program_args(args)
+
+    source_frame = _decode_bytes(source_bytes)
+    target_frame = _decode_bytes(target_bytes)
+    if source_frame is None or target_frame is None:
+        raise Exception("Could not decode the source or target image")
+
+    if source_faces:
+        source_face = get_average_face([face_from_dict(face) for face in source_faces])
+    else:
+        source_face = get_average_face(_get_many_faces([source_frame]))
+
+    target_frame = _swap_frame(source_face, target_frame, face_regions)
+
+    quality = state_manager.get_item("output_image_quality") or 100
+    encoded, output_bytes = cv2.imencode(".jpg", target_frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not encoded:
+        raise Exception("Could not encode the output image")
+    return output_bytes.tobytes()
+
+
+# Sort keys matching FaceFusion's --face-selector-order choices
+face_order_keys = {
+    "left-right": lambda face: face.bounding_box[0],
+    "right-left": lambda face: -face.bounding_box[0],
+    "top-bottom": lambda face: face.bounding_box[1],
+    "bottom-top": lambda face: -face.bounding_box[1],
+    "small-large": lambda face: (face.bounding_box[2] - face.bounding_box[0]) * (face.bounding_box[3] - face.bounding_box[1]),
+    "large-small": lambda face: -(face.bounding_box[2] - face.bounding_box[0]) * (face.bounding_box[3] - face.bounding_box[1]),
+    "best-worst": lambda face: -face.score_set.get("detector", 0),
+    "worst-best": lambda face: face.score_set.get("detector", 0)
+}
+
+
+# Function to swap the image target of a headless-run region by region in this process; returns
+# the same result as run_cli, or None when the run should go through the CLI as usual (video
+# targets and images that fit the output resolution)
+def swap_image_regions(args, face_regions):
+    import cv2
+    try:
+        from facefusion import state_manager
+        from facefusion.face_analyser import get_average_face
+        from facefusion.filesystem import is_image
+        from facefusion.vision import read_static_image
+        _install_face_hooks()
+        apply_program_args(args)
+        target_path = state_manager.get_item("target_path")
+        target_frame = read_static_image(target_path) if is_image(target_path) else None
+        if target_frame is None or not _uses_regions(target_frame, face_regions):
+            return None
+
+        source_frames = [read_static_image(source_path) for source_path in state_manager.get_item("source_paths") or []]
+        source_face = get_average_face(_get_many_faces([frame for frame in source_frames if frame is not None]))
+        if source_face is None:
+            raise Exception("No face detected in the source image")
+        output_frame = _swap_frame(source_face, target_frame, face_regions)
+        quality = state_manager.get_item("output_image_quality") or 100
+        if not cv2.imwrite(state_manager.get_item("output_path"), output_frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)]):
+            raise Exception("Could not write the output image")
+    except (Exception, SystemExit) as e:
+        return {"returncode": 1, "stdout": "", "stderr": f"FaceFusion run failed: {e}"}
+    return {"returncode": 0, "stdout": "", "stderr": ""}
+
+
+# Function to detect the target once and swap each source onto the face picked by its order; a
+# target larger than the output resolution is detected scaled down and swapped region by region
+def swap_by_position(args, target_path, output_path, assignments, face_regions=None):
+    import cv2
+    from facefusion import state_manager
+    from facefusion.face_analyser import get_average_face
+    from facefusion.processors.modules import face_swapper
+    from facefusion.vision import read_static_image
+    _install_face_hooks()
+    apply_program_args(args)
+
+    target_frame = read_static_image(target_path)
+    if target_frame is None:
+        raise Exception("Could not read the target image")
+    if _uses_regions(target_frame, face_regions):
+        remaining_faces = _detect_scaled_down(target_frame, face_regions["detect_size"])
+    else:
+        face_regions = None
+        target_frame = _restrict_resolution(target_frame, state_manager.get_item("output_image_resolution"))
+        remaining_faces = list(_get_many_faces([target_frame]))
+    # The command's gender, age and race filters apply before any source picks its face; the
+    # order comes from each assignment instead of --face-selector-order
+    remaining_faces = _sort_and_filter(remaining_faces)
+    if not remaining_faces:
+        raise Exception("No face detected in the target image")
+    reference_mode = "reference" in state_manager.get_item("face_selector_mode")
+    distance = state_manager.get_item("reference_face_distance")
+
+    for index, (source_path, order) in enumerate(assignments):
+        if not remaining_faces:
+            break
+        source_face = get_average_face(_get_many_faces([read_static_image(source_path)]))
+        if source_face is None:
+            raise Exception(f"No face detected in source image {index + 1}")
+        target_face = min(remaining_faces, key=face_order_keys[order])
+        # In reference mode the picked face is the reference and the source goes to every face
+        # within --reference-face-distance of it, as a reference run of the CLI does
+        if reference_mode:
+            target_faces = [face for face in remaining_faces if 1 - np.dot(face.normed_embedding, target_face.normed_embedding) < distance]
+        else:
+            target_faces = [target_face]
+        # A face is only assigned once, so two sources never land on the same person
+        remaining_faces = [face for face in remaining_faces if not any(face is target for target in target_faces)]
+        if face_regions:
+            def swap_region(region_frame, region):
+                for face in target_faces:
+                    if _overlaps(region, face.bounding_box):
+                        region_frame = face_swapper.swap_face(source_face, _region_face(region_frame, region, face), region_frame)
+                return region_frame
+            target_frame = _process_regions(target_frame, target_faces, face_regions, swap_region)
+        else:
+            for face in target_faces:
+                target_frame = face_swapper.swap_face(source_face, face, target_frame)
+
+    quality = state_manager.get_item("output_image_quality") or 100
+    if not cv2.imwrite(output_path, target_frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)]):
+        raise Exception("Could not write the output image")
+
+
+# Function to run one FaceFusion CLI invocation inside this process. Its output is parsed for
+# progress while it is written and only the tails are returned (see progress.py).
+def run_cli(script_path, args, on_progress=None):
+    args = list(args)
+    # Keep the ONNX inference sessions loaded between jobs instead of clearing them after each run
+    if "--video-memory-strategy" not in args:
+        args += ["--video-memory-strategy", "tolerant"]
+
+    stdout = progress.OutputTail(on_progress)
+    stderr = progress.OutputTail(on_progress)
+    log_handler = logging.StreamHandler(stderr)
+    logging.getLogger().addHandler(log_handler)
+    saved_argv = sys.argv
+    sys.argv = [script_path] + args
+    returncode = 0
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            runpy.run_path(script_path, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            stderr.write(f"{e.code}\n")
+            returncode = 1
+    except Exception as e:
+        stderr.write(f"FaceFusion run failed: {e}\n")
+        returncode = 1
+    finally:
+        sys.argv = saved_argv
+        logging.getLogger().removeHandler(log_handler)
+        stdout.close()
+        stderr.close()
+
+    return {"returncode": returncode, "stdout": stdout.tail(), "stderr": stderr.tail()}
+
+
+# Function to serve jobs sent by the pool over the pipe until asked to stop
+def serve(conn, script_path):
+    global adaptive_angles, _tracker_settings
+    warmup()
+    # FaceFusion may write progress from its own threads while the main thread replies
+    send_lock = threading.Lock()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        op = message.get("op")
+        adaptive_angles = message.get("adaptive_angles", True)
+        _tracker_settings = message.get("tracking")
+        # A profiled request's job is sampled here and the stacks go back with the reply
+        sampler = profiler.Sampler(message["profile"]).start() if message.get("profile") else None
+
+        def send(reply):
+            if sampler:
+                reply["profile"] = sampler.stop()
+            with send_lock:
+                conn.send(reply)
+
+        def send_progress(fields):
+            with send_lock:
+                conn.send({"event": "progress", "fields": fields})
+
+        if op == "stop":
+            break
+        elif op == "ping":
+            conn.send({"ok": True, "pid": os.getpid()})
+        elif op == "run":
+            try:
+                seed_faces(message.get("faces") or {})
+            except Exception as e:
+                print(f"Could not seed faces, detecting them again: {e}")
+            try:
+                # Large image targets are swapped region by region here instead of by the CLI
+                result = swap_image_regions(message["args"], message["roi"]) if message.get("roi") else None
+                if result is None:
+                    result = run_cli(script_path, message["args"], send_progress if message.get("progress") else None)
+                result["detection"] = take_detection_stats()
+                send(result)
+            finally:
+                clear_seeded_faces()
+        elif op == "swap_in_memory":
+            try:
+                image = swap_in_memory(message["args"], message["source_bytes"], message["target_bytes"], message.get("source_faces"), message.get("roi"))
+                send({"ok": True, "image": image, "detection": take_detection_stats()})
+            except (Exception, SystemExit) as e:
+                send({"ok": False, "error": str(e)})
+        elif op == "swap_by_position":
+            try:
+                seed_faces(message.get("faces") or {})
+                swap_by_position(message["args"], message["target_path"], message["output_path"], message["assignments"], message.get("roi"))
+                send({"ok": True, "detection": take_detection_stats()})
+            except (Exception, SystemExit) as e:
+                send({"ok": False, "error": str(e)})
+            finally:
+                clear_seeded_faces()
+        elif op == "count_faces":
+            try:
+                send({"ok": True, "faces": count_faces(message["frame"], message["args"], message.get("wanted", 1))})
+            except (Exception, SystemExit) as e:
+                send({"ok": False, "error": str(e)})
+        elif op == "analyse":
+            try:
+                send({"ok": True, "faces": analyse_image(message["image_path"], message["args"])})
+            except (Exception, SystemExit) as e:
+                send({"ok": False, "error": str(e)})
+        else:
+            send({"ok": False, "error": f"Unknown op: {op}"})
+        # Counters of a failed job must not leak into the next one
+        take_detection_stats()
@@ -0,0 +1,499 @@
+import contextlib
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import autotune
+import metrics
+import profiler
+import progress
+import scheduler
+import tracing
+
+# Pool of long-lived FaceFusion worker processes. Each worker imports FaceFusion and
+# loads the ONNX models once, then accepts the same headless-run arguments we pass as
+# CLI flags. When the pool is disabled or a worker breaks, jobs fall back to running
+# facefusion.py in a fresh subprocess as before. Either way the engine's output is read as a
+# stream: progress goes to the request's listeners and only the tail of the output is kept
+# (see progress.py).
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+script_path = os.path.join(base_path, "facefusion.py")
+
+# Pool configuration from environment variables (FACEFUSION_POOL_SIZE=0 disables the pool).
+# Without a size the autotune profile decides, else one worker per 4 cores.
+pool_size = int(os.getenv("FACEFUSION_POOL_SIZE", str(autotune.pool_size() or max(1, (os.cpu_count() or 4) // 4))))
+max_jobs_per_worker = int(os.getenv("FACEFUSION_WORKER_MAX_JOBS", "50"))
+health_check_interval = float(os.getenv("FACEFUSION_HEALTH_CHECK_INTERVAL", "30"))
+startup_timeout = float(os.getenv("FACEFUSION_WORKER_STARTUP_TIMEOUT", "120"))
+job_timeout = float(os.getenv("FACEFUSION_JOB_TIMEOUT", "0")) or None
+# Longest a scheduled job waits for an idle worker (e.g. while a recycled one restarts) before it
+# gives up on the pool
+worker_wait_timeout = float(os.getenv("FACEFUSION_WORKER_WAIT_TIMEOUT", str(startup_timeout)))
+# Detect at 0° first and only try the other --face-detector-angles when nothing is found there
+adaptive_detector_angles = os.getenv("ADAPTIVE_DETECTOR_ANGLES", "1") == "1"
+# Video face tracking: full detection every N frames (and on scene cuts or lost faces), optical
+# flow in between. Requests opt in with "tracking": true unless FACE_TRACKING_DEFAULT=1.
+face_tracking_by_default = os.getenv("FACE_TRACKING_DEFAULT", "0") == "1"
+face_tracking_settings = {
+    "detect_every": int(os.getenv("FACE_TRACKING_DETECT_EVERY", "10")),
+    "min_confidence": float(os.getenv("FACE_TRACKING_MIN_CONFIDENCE", "0.8")),
+    "scene_cut_threshold": float(os.getenv("FACE_TRACKING_SCENE_CUT_THRESHOLD", "40"))
+}
+# Face-region processing of image targets larger than --output-image-resolution: faces are found
+# on a copy scaled down to IMAGE_ROI_DETECT_SIZE and only padded regions around them are swapped
+# at full resolution and blended back, so the output keeps the target's native resolution (see
+# facefusion_engine). Requests opt in with "roi": true unless IMAGE_ROI_DEFAULT=1; runs outside
+# the worker pool process the whole frame as before.
+face_regions_by_default = os.getenv("IMAGE_ROI_DEFAULT", "0") == "1"
+face_region_settings = {
+    "detect_size": int(os.getenv("IMAGE_ROI_DETECT_SIZE", "1920")),
+    "padding": float(os.getenv("IMAGE_ROI_PADDING", "0.75")),
+    "feather": float(os.getenv("IMAGE_ROI_FEATHER", "0.1"))
+}
+
+
+class WorkerError(Exception):
+    pass
+
+
+class WorkerTimeout(WorkerError):
+    pass
+
+
+# Entry point of a worker process
+def _worker_main(conn, worker_base_path):
+    os.chdir(worker_base_path)
+    sys.path.insert(0, worker_base_path)
+    import facefusion_engine
+    facefusion_engine.serve(conn, os.path.join(worker_base_path, "facefusion.py"))
+
+
+class FaceFusionWorker:
+    def __init__(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, base_path), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs_done = 0
+
+    def request(self, message, timeout=None, on_progress=None):
+        try:
+            self.conn.send(message)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                if not self.conn.poll(None if deadline is None else max(0, deadline - time.monotonic())):
+                    raise WorkerTimeout(f"FaceFusion worker {self.process.pid} did not answer within {timeout}s")
+                reply = self.conn.recv()
+                # A streaming run sends its progress before the result
+                if reply.get("event") == "progress":
+                    if on_progress:
+                        on_progress(reply["fields"])
+                    continue
+                return reply
+        except (EOFError, OSError, BrokenPipeError) as e:
+            raise WorkerError(f"FaceFusion worker {self.process.pid} died: {e}")
+
+    def ping(self, timeout=5):
+        try:
+            return self.request({"op": "ping"}, timeout).get("ok", False)
+        except WorkerError:
+            return False
+
+    def call(self, message, timeout=None, on_progress=None):
+        result = self.request(message, timeout, on_progress)
+        self.jobs_done += 1
+        return result
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        try:
+            self.conn.send({"op": "stop"})
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class FaceFusionPool:
+    def __init__(self, size, max_jobs):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.idle = queue.Queue()
+        self.broken = False
+        self.closed = False
+        # Workers load in parallel in the background; callers wait for the first one that is ready
+        for _ in range(size):
+            self._replace_in_background(None)
+        self.health_thread = threading.Thread(target=self._health_check_loop, daemon=True)
+        self.health_thread.start()
+
+    def _start_worker(self):
+        worker = FaceFusionWorker()
+        # A worker that can't even answer the first ping means FaceFusion can't be imported
+        # here; stop starting new ones and let every job take the subprocess path.
+        if not worker.ping(timeout=startup_timeout):
+            worker.stop()
+            self.broken = True
+            return None
+        return worker
+
+    # Function to stop a worker (if any) and add a fresh one to the pool
+    def _replace(self, worker):
+        if worker is not None:
+            worker.stop()
+        try:
+            replacement = None if self.broken or self.closed else self._start_worker()
+        except Exception as e:
+            # Callers wait on the idle queue, so a start that fails must still leave an entry there
+            print(f"FaceFusion worker failed to start: {e}")
+            self.broken = True
+            replacement = None
+        if replacement is not None and self.closed:
+            replacement.stop()
+            replacement = None
+        self.idle.put(replacement)
+
+    # Replacements start on their own thread so no request waits for a worker's cold start
+    def _replace_in_background(self, worker):
+        threading.Thread(target=self._replace, args=(worker,), daemon=True).start()
+
+    def _release(self, worker, failed=False):
+        if not failed and worker.is_alive() and worker.jobs_done < self.max_jobs:
+            self.idle.put(worker)
+            return
+        # Recycle workers that failed, died or reached their job limit
+        self._replace_in_background(worker)
+
+    # Function to wait until the first worker has started; returns False when none did within
+    # timeout or the pool broke
+    def wait_ready(self, timeout):
+        try:
+            worker = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        self.idle.put(worker)
+        return worker is not None
+
+    # Context manager holding the next idle worker; with wait set, raises WorkerError when no
+    # worker becomes idle within wait seconds
+    @contextlib.contextmanager
+    def worker(self, wait=None):
+        if self.broken:
+            raise WorkerError("FaceFusion worker pool is unavailable")
+        try:
+            worker = self.idle.get(timeout=wait)
+        except queue.Empty:
+            raise WorkerError(f"No FaceFusion worker became idle within {wait}s")
+        if worker is None:
+            self.idle.put(None)
+            raise WorkerError("FaceFusion worker pool is unavailable")
+        failed = False
+        try:
+            yield worker
+        except WorkerError:
+            failed = True
+            raise
+        finally:
+            self._release(worker, failed)
+
+    def call(self, message, timeout=None, on_progress=None, wait=None):
+        with self.worker(wait) as worker:
+            return worker.call(message, timeout, on_progress)
+
+    def _health_check_loop(self):
+        while not self.closed and not self.broken:
+            time.sleep(health_check_interval)
+            checked = []
+            # Only idle workers are pinged; busy workers are checked when they finish their job
+            while True:
+                try:
+                    checked.append(self.idle.get_nowait())
+                except queue.Empty:
+                    break
+            for worker in checked:
+                if worker is not None and not worker.ping():
+                    print(f"FaceFusion worker {worker.process.pid} failed its health check, restarting it")
+                    self._replace_in_background(worker)
+                else:
+                    self.idle.put(worker)
+
+    def close(self):
+        self.closed = True
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker is not None:
+                worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Function to get the process-wide worker pool, starting it on first use
+def get_pool():
+    global _pool
+    if pool_size <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = FaceFusionPool(pool_size, max_jobs_per_worker)
+            # Jobs for the pool are only admitted while a worker is left for them
+            scheduler.limit_workers(pool_size)
+    return None if _pool.broken else _pool
+
+
+# Function to start the worker pool when a service starts instead of on its first request. Under
+# Flask's reloader only the child process that serves requests starts one.
+def prestart(reloader=False):
+    if reloader and os.environ.get("WERKZEUG_RUN_MAIN") != "true":
+        return
+    get_pool()
+
+
+# Function to run a FaceFusion command on a warm worker, falling back to a fresh subprocess.
+# faces maps source image paths to already detected faces (see face_registry) so the worker
+# can skip detecting them again. tracking follows video faces between detections (see face_tracker),
+# roi swaps large image targets region by region.
+def run_facefusion(command, faces=None, tracking=False, roi=False):
+    job_type = scheduler.command_job_type(command)
+    command = _tuned(command, job_type)
+    # Tracked runs use a single thread (see below), so they hold a single core
+    cores = 1 if tracking else scheduler.command_cores(command)
+    report = progress.reporter(job_type)
+    report({"status": "queued"})
+    with _engine_run(job_type, "run", cores, pooled=get_pool() is not None) as run:
+        report({"status": "running"})
+        process = _run_facefusion(command, faces, tracking, report, roi, run)
+        run["exit_code"] = process.returncode
+    report({"status": "succeeded" if process.returncode == 0 else "failed"})
+    return process
+
+
+# Context manager for one engine run: waits for a scheduler slot, then times the run for the
+# metrics and the request's trace. Runs on the pool (pooled) also wait for a free worker.
+@contextlib.contextmanager
+def _engine_run(job_type, op, cores, pooled=True):
+    with tracing.span("facefusion", job_type=job_type, op=op, cores=cores) as run_span:
+        started = time.perf_counter()
+        with scheduler.slot(job_type, cores, pooled), metrics.facefusion_run(job_type, op) as run:
+            run_span.set(queue_seconds=round(time.perf_counter() - started, 6))
+            yield run
+        run_span.set(exit_code=run["exit_code"])
+
+
+# Function to send a job to a worker; when the request is being profiled the worker samples
+# itself while it runs the job (see tracing.py). The run's timer starts once a worker has it.
+def _call_pool(pool, message, on_progress=None, run=None):
+    profile = tracing.current_profile()
+    if profile:
+        message["profile"] = profile.interval
+    with pool.worker(wait=worker_wait_timeout) as worker:
+        if run is not None:
+            run["started"] = time.perf_counter()
+        result = worker.call(message, job_timeout, on_progress)
+    if profile and result.get("profile"):
+        profile.add_worker_stacks(result.pop("profile"))
+    return result
+
+
+# Function to run a command, reading its output as it is written; returns a CompletedProcess
+# with the tails of stdout and stderr
+def _stream_process(command, report):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace")
+    stdout = progress.OutputTail(report)
+    stderr = progress.OutputTail(report)
+    stderr_reader = threading.Thread(target=progress.pump, args=(process.stderr, stderr), daemon=True)
+    stderr_reader.start()
+    progress.pump(process.stdout, stdout)
+    stderr_reader.join()
+    return subprocess.CompletedProcess(command, process.wait(), stdout.tail(), stderr.tail())
+
+
+# Function to run facefusion.py in a subprocess, under the sampling profiler when the request is profiled
+def _run_subprocess(command, report):
+    profile = tracing.current_profile()
+    if not profile:
+        return _stream_process(command, report)
+
+    profile_file = os.path.join(tracing.profile_path, f".{uuid.uuid4().hex}.folded")
+    os.makedirs(tracing.profile_path, exist_ok=True)
+    try:
+        process = _stream_process([command[0], profiler.__file__, "--output", profile_file, "--interval", str(profile.interval)] + list(command[1:]), report)
+        if os.path.exists(profile_file):
+            profile.add_worker_stacks(profiler.read_folded(profile_file))
+    finally:
+        if os.path.exists(profile_file):
+            os.remove(profile_file)
+    process.args = command
+    return process
+
+
+def _run_facefusion(command, faces, tracking, report=None, roi=False, run=None):
+    pool = get_pool()
+    if pool is not None:
+        try:
+            # The command is the usual ["python3", script_path, "headless-run", ...] list
+            message = {
+                "op": "run",
+                "args": command[2:],
+                "faces": faces or {},
+                "adaptive_angles": adaptive_detector_angles
+            }
+            if tracking:
+                # The tracker needs the frames in order, so they are processed on one thread
+                message["args"] = _with_option(message["args"], "--execution-thread-count", "1")
+                message["tracking"] = face_tracking_settings
+            if roi:
+                message["roi"] = face_region_settings
+            # The worker only streams its progress when someone listens
+            message["progress"] = progress.listening_now()
+            result = _call_pool(pool, message, report, run)
+            process = subprocess.CompletedProcess(command, result["returncode"], result["stdout"], result["stderr"])
+            process.face_detection = result.get("detection")
+            return process
+        except WorkerTimeout as e:
+            process = subprocess.CompletedProcess(command, -1, "", str(e))
+            process.face_detection = None
+            return process
+        except WorkerError as e:
+            print(f"FaceFusion worker failed, falling back to subprocess: {e}")
+
+    process = _run_subprocess(command, report)
+    # The plain CLI scans every configured angle and doesn't report what it found
+    process.face_detection = None
+    return process
+
+
+def _with_option(args, option, value):
+    args = list(args)
+    if option in args:
+        args[args.index(option) + 1] = value
+    else:
+        args += [option, value]
+    return args
+
+
+# Function to apply this host's tuned thread and queue counts for a job type (see autotune)
+def _tuned(command, job_type):
+    for option, value in autotune.overrides(job_type).items():
+        command = _with_option(command, option, value)
+    return command
+
+
+def _add_counts(total, counts):
+    for key, count in counts.items():
+        total[key] = total.get(key, 0) + count
+
+
+# Function to add up the detection reports of several runs of one request
+def combine_detection(*detections):
+    detections = [detection for detection in detections if detection]
+    if not detections:
+        return None
+    combined = {
+        "adaptive": all(detection["adaptive"] for detection in detections),
+        "detector_calls": sum(detection["detector_calls"] for detection in detections),
+        "matched_angles": {}
+    }
+    for detection in detections:
+        _add_counts(combined["matched_angles"], detection["matched_angles"])
+        if "tracking" in detection:
+            _add_counts(combined.setdefault("tracking", {}), detection["tracking"])
+        if "regions" in detection:
+            _add_counts(combined.setdefault("regions", {}), detection["regions"])
+    return combined
+
+
+# Function to detect and embed the faces of an image on a warm worker; background work passes
+# job_type "indexing" so it waits behind requests
+def analyse_image(image_path, args, job_type="analysis"):
+    pool = get_pool()
+    if pool is None:
+        raise WorkerError("FaceFusion worker pool is unavailable")
+    with _engine_run(job_type, "analyse", scheduler.command_cores(args)) as run:
+        result = _call_pool(pool, {
+            "op": "analyse",
+            "image_path": image_path,
+            "args": args,
+            "adaptive_angles": adaptive_detector_angles
+        }, run=run)
+        run["exit_code"] = 0 if result.get("ok") else 1
+    if not result.get("ok"):
+        raise Exception(result.get("error", "Face analysis failed"))
+    return result["faces"]
+
+
+# Function to count the faces of a decoded frame with FaceFusion's detector on a worker that is
+# idle right now; returns None when there is none, so the preflight check never queues for an engine
+def count_faces(vision_frame, args, wanted=1):
+    pool = get_pool()
+    if pool is None:
+        return None
+    try:
+        result = pool.call({"op": "count_faces", "frame": vision_frame, "args": args, "wanted": wanted}, timeout=job_timeout, wait=0)
+    except WorkerError:
+        return None
+    return result["faces"] if result.get("ok") else None
+
+
+# Function to swap faces between two encoded images entirely in a worker's memory; returns the
+# encoded output and the detection report
+def swap_in_memory(command, source_bytes, target_bytes, source_faces=None, roi=False):
+    pool = get_pool()
+    if pool is None:
+        raise WorkerError("FaceFusion worker pool is unavailable")
+    command = _tuned(command, "image")
+    with _engine_run("image", "swap_in_memory", scheduler.command_cores(command)) as run:
+        result = _call_pool(pool, {
+            "op": "swap_in_memory",
+            "args": command[2:],
+            "source_bytes": source_bytes,
+            "target_bytes": target_bytes,
+            "source_faces": source_faces,
+            "roi": face_region_settings if roi else None,
+            "adaptive_angles": adaptive_detector_angles
+        }, run=run)
+        run["exit_code"] = 0 if result.get("ok") else 1
+    if not result.get("ok"):
+        raise Exception(result.get("error", "In-memory face swap failed"))
+    return result["image"], result.get("detection")
+
+
+# Function to swap several sources onto the faces of one target in a single pass. assignments is a
+# list of (source_path, face order) pairs, e.g. [(source_1, "left-right"), (source_2, "right-left")]:
+# the target is detected once and each source replaces the first remaining face in its order.
+# Returns the detection report.
+def swap_by_position(command, target_path, output_path, assignments, faces=None, roi=False):
+    pool = get_pool()
+    if pool is None:
+        raise WorkerError("FaceFusion worker pool is unavailable")
+    command = _tuned(command, "image")
+    with _engine_run("image", "swap_by_position", scheduler.command_cores(command)) as run:
+        result = _call_pool(pool, {
+            "op": "swap_by_position",
+            "args": command[2:],
+            "target_path": target_path,
+            "output_path": output_path,
+            "assignments": assignments,
+            "faces": faces or {},
+            "roi": face_region_settings if roi else None,
+            "adaptive_angles": adaptive_detector_angles
+        }, run=run)
+        run["exit_code"] = 0 if result.get("ok") else 1
+    if not result.get("ok"):
+        raise Exception(result.get("error", "Single-pass face swap failed"))
+    return result.get("detection")
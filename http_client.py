@@ -0,0 +1,152 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import contextvars
+import io
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import metrics
+import tracing
+
+# Process-wide pooled HTTP client for input downloads. Connections are reused across requests,
+# each host gets a bounded connection pool, every request has connect/read timeouts, and
+# gather() fetches all inputs of a request concurrently under one total deadline.
+
+connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+connections_per_host = int(os.getenv("HTTP_CONNECTIONS_PER_HOST", "8"))
+pool_timeout = float(os.getenv("HTTP_POOL_TIMEOUT", "30"))
+download_deadline = float(os.getenv("HTTP_DOWNLOAD_DEADLINE", "120"))
+download_workers = int(os.getenv("HTTP_DOWNLOAD_WORKERS", "16"))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+# Function to get how long a caller may wait for a free pooled connection: pool_timeout, cut short
+# by the current request's download deadline
+def pool_wait():
+    remaining = time_left()
+    return pool_timeout if remaining is None else min(pool_timeout, remaining)
+
+
+# requests never passes a pool timeout to urllib3, so a blocking pool would wait for a free
+# connection forever; these pools bound the wait with pool_wait()
+class _HTTPConnectionPool(HTTPConnectionPool):
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(pool_wait() if timeout is None else timeout)
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(pool_wait() if timeout is None else timeout)
+
+
+class _BoundedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+
+def _create_session():
+    http_session = requests.Session()
+    # pool_block makes callers wait (see pool_wait()) for a free connection instead of opening
+    # more than the per-host limit
+    adapter = _BoundedAdapter(
+        pool_connections=32,
+        pool_maxsize=connections_per_host,
+        pool_block=True,
+        max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.2, allowed_methods=["GET", "HEAD"])
+    )
+    http_session.mount("http://", adapter)
+    http_session.mount("https://", adapter)
+    return http_session
+
+
+session = _create_session()
+executor = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="download")
+_deadline = contextvars.ContextVar("download_deadline", default=None)
+
+
+# Function to get the seconds left before the current request's download deadline
+def time_left():
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Download deadline exceeded")
+    return remaining
+
+
+def check_deadline():
+    time_left()
+
+
+# Function to GET a URL on the shared session, never waiting past the request's deadline
+def get(url, headers=None, stream=True):
+    remaining = time_left()
+    timeout = (connect_timeout, read_timeout if remaining is None else min(read_timeout, remaining))
+    return session.get(url, headers=headers, stream=stream, timeout=timeout)
+
+
+# Function to download a URL into memory; returns the body or None when the server didn't answer 200
+def fetch_bytes(url, max_bytes=None):
+    started = time.perf_counter()
+    body = None
+    try:
+        with tracing.span("download", url=tracing.safe_url(url), path="memory") as download_span:
+            body = _fetch_bytes(url, max_bytes)
+            download_span.set(ok=body is not None, bytes=len(body) if body is not None else 0)
+        return body
+    finally:
+        metrics.observe_download("memory", started, body is not None)
+
+
+def _fetch_bytes(url, max_bytes):
+    response = get(url)
+    try:
+        if response.status_code != 200:
+            return None
+        buffer = io.BytesIO()
+        for chunk in response.iter_content(1024 * 1024):
+            check_deadline()
+            buffer.write(chunk)
+            if max_bytes and buffer.tell() > max_bytes:
+                raise Exception(f"Download of {url} is larger than {max_bytes} bytes")
+        metrics.downloaded_bytes.inc(buffer.tell(), source="network")
+        return buffer.getvalue()
+    finally:
+        response.close()
+
+
+def _run_with_deadline(deadline, function, args):
+    token = _deadline.set(deadline)
+    try:
+        return function(*args)
+    finally:
+        _deadline.reset(token)
+
+
+# Function to run a request's downloads concurrently; tasks maps a name to (function, *args).
+# Returns the same names mapped to each function's result, or None for tasks that failed.
+# The deadline bounds the HTTP work of all tasks together (see get() and check_deadline()).
+def gather(tasks, deadline_seconds=None):
+    deadline = time.monotonic() + (deadline_seconds or download_deadline)
+    futures = {
+        name: executor.submit(tracing.bind(_run_with_deadline), deadline, task[0], task[1:])
+        for name, task in tasks.items()
+    }
+    wait(futures.values())
+
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            print(f"Error downloading {name}: {e}")
+            results[name] = None
+    return results
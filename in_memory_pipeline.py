@@ -0,0 +1,33 @@
+import os
+import face_registry
+
+# Zero-disk path for single-image swaps: both inputs are downloaded into memory, a warm worker
+# decodes them, runs the swap and encodes the result, and the JPEG bytes are uploaded straight
+# from memory. The disk path remains the fallback when no worker is available. The swap's steps
+# are in single_image.py; this module holds the pipeline's settings and helpers.
+
+in_memory_enabled = os.getenv("IN_MEMORY_PIPELINE", "1") == "1"
+max_image_bytes = int(os.getenv("IN_MEMORY_MAX_IMAGE_BYTES", str(64 * 1024 * 1024)))
+
+
+def read_file(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+
+# Function to get the stored faces of a source, by face_id or by the hash of its downloaded bytes
+def stored_source_faces(face_id, source_hash):
+    entry = face_registry.get(face_id or source_hash)
+    return entry["faces"] if entry else None
+
+
+def response_body(output_s3_url, face_detection, source_bytes, target_bytes, output_bytes, timings):
+    return {
+        "message": "Face swap completed successfully",
+        "output_s3_url": output_s3_url,
+        "pipeline": "in-memory",
+        "face_detection": face_detection,
+        # Each of these would otherwise have been written to disk once and read back once
+        "disk_io_avoided_bytes": 2 * (len(source_bytes) + len(target_bytes) + len(output_bytes)),
+        "timings": timings
+    }
@@ -0,0 +1,226 @@
+from flask import Response, request, jsonify, current_app
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+import http_client
+import metrics
+import progress
+import tracing
+
+# Background job subsystem. Any swap route decorated with @async_job accepts its usual JSON
+# payload with "async": true (or ?async=1) and answers 202 with a job id straight away; the
+# route itself then runs on the job executor and its response becomes the job's result.
+# While it runs, the progress of its FaceFusion runs is kept in the job's "progress" field and
+# pushed to clients following GET /jobs/<job_id>/events (server-sent events).
+
+job_workers = int(os.getenv("JOB_WORKERS", str(os.cpu_count() or 4)))
+job_ttl = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+webhook_timeout = float(os.getenv("JOB_WEBHOOK_TIMEOUT", "10"))
+events_keepalive = float(os.getenv("JOB_EVENTS_KEEPALIVE", "15"))
+
+executor = ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix="job")
+_jobs = {}
+_jobs_lock = threading.Lock()
+# Notified whenever a job changes; every change bumps the job's version
+_jobs_changed = threading.Condition(_jobs_lock)
+
+
+# Function to drop finished jobs older than the TTL
+def _prune_jobs():
+    cutoff = time.time() - job_ttl
+    with _jobs_lock:
+        for job_id in [job_id for job_id, job in _jobs.items() if job["finished_at"] and job["finished_at"] < cutoff]:
+            del _jobs[job_id]
+
+
+def _update_job(job_id, **fields):
+    with _jobs_lock:
+        _jobs[job_id].update(fields, version=_jobs[job_id]["version"] + 1)
+        _jobs_changed.notify_all()
+        return dict(_jobs[job_id])
+
+
+def _run_percent(run):
+    if run.get("status") == "succeeded":
+        return 100
+    if "percent" in run:
+        return run["percent"]
+    if run.get("steps"):
+        return round(100 * (run["step"] - 1) / run["steps"])
+    return 0
+
+
+# Function to record the progress of one FaceFusion run of a job. The progress dict is replaced
+# rather than changed, so readers can serialize the one they got without holding the lock.
+def _record_progress(job_id, run_id, label, fields):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if not job:
+            return
+        runs = dict(job["progress"]["runs"])
+        runs[str(run_id)] = dict(runs.get(str(run_id), {"type": label}), **fields)
+        # Runs that haven't started yet aren't known, so this is the average of the runs so far
+        percent = round(sum(_run_percent(run) for run in runs.values()) / len(runs), 1)
+        job["progress"] = {"percent": percent, "runs": runs}
+        job["version"] += 1
+        _jobs_changed.notify_all()
+
+
+# Function to wait until a job changes from the given version (or the timeout passes); returns the job
+def wait_for_change(job_id, version, timeout):
+    with _jobs_lock:
+        _jobs_changed.wait_for(lambda: job_id not in _jobs or _jobs[job_id]["version"] != version, timeout)
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+# Function to POST the finished job to the caller's webhook
+def _notify_webhook(job):
+    try:
+        http_client.session.post(job["webhook_url"], json=_public_job(job), timeout=webhook_timeout)
+    except Exception as e:
+        print(f"Error calling webhook for job {job['job_id']}: {e}")
+
+
+# Function to run a route in the background with the submitted payload
+def _run_job(app, job_id, path, payload, view, view_args):
+    _update_job(job_id, status="running", started_at=time.time())
+    metrics.jobs_in_flight.dec(status="queued")
+    metrics.jobs_in_flight.inc(status="running")
+    try:
+        # The job is its own trace; the request that submitted it ended with the 202
+        with tracing.trace("job", path, job_id=job_id), progress.listening(functools.partial(_record_progress, job_id)), \
+                app.test_request_context(path, method="POST", json=payload):
+            response = app.make_response(view(**view_args))
+        body = response.get_json(silent=True)
+        if response.status_code < 400:
+            job = _update_job(job_id, status="succeeded", result=body, status_code=response.status_code, finished_at=time.time())
+        else:
+            job = _update_job(job_id, status="failed", error=body, status_code=response.status_code, finished_at=time.time())
+    except Exception as e:
+        job = _update_job(job_id, status="failed", error={"error": str(e)}, status_code=500, finished_at=time.time())
+    finally:
+        metrics.jobs_in_flight.dec(status="running")
+
+    if job["webhook_url"]:
+        _notify_webhook(job)
+
+
+# Function to queue a route call as a background job and return its id
+def submit(app, path, payload, view, view_args=None):
+    _prune_jobs()
+    job_id = uuid.uuid4().hex
+    with _jobs_lock:
+        _jobs[job_id] = {
+            "job_id": job_id,
+            "route": path,
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "status_code": None,
+            "progress": {"percent": 0, "runs": {}},
+            "webhook_url": payload.get("webhook_url"),
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "version": 0
+        }
+    metrics.jobs_in_flight.inc(status="queued")
+    executor.submit(_run_job, app, job_id, path, payload, view, view_args or {})
+    return job_id
+
+
+def _public_job(job):
+    return {key: value for key, value in job.items() if key not in ("webhook_url", "version")}
+
+
+def _event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+# Generator of a job's server-sent events: "progress" on every change while it runs, then one
+# "done" with the finished job; comments keep idle connections open
+def events(job_id):
+    job = get_job(job_id)
+    version = None
+    while job:
+        if job["version"] != version:
+            version = job["version"]
+            if job["finished_at"]:
+                yield _event("done", _public_job(job))
+                return
+            yield _event("progress", {"job_id": job_id, "status": job["status"], "progress": job["progress"]})
+        else:
+            yield ": keepalive\n\n"
+        job = wait_for_change(job_id, version, events_keepalive)
+
+
+def _wants_async(data):
+    return request.args.get("async", "").lower() in ("1", "true") or data.get("async") is True
+
+
+# Decorator letting a swap route run as a background job when the caller asks for it
+def async_job(view):
+    @functools.wraps(view)
+    def wrapper(**view_args):
+        data = request.get_json(silent=True) or {}
+        if not _wants_async(data):
+            return view(**view_args)
+
+        job_id = submit(current_app._get_current_object(), request.path, data, view, view_args)
+        return jsonify({
+            "message": "Job accepted",
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/jobs/{job_id}",
+            "events_url": f"/jobs/{job_id}/events",
+            "result_url": f"/jobs/{job_id}/result",
+            "error_url": f"/jobs/{job_id}/error"
+        }), 202
+    return wrapper
+
+
+# Function to add the job status, result and error endpoints to a service
+def register_routes(app):
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = get_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        return jsonify(_public_job(job)), 200
+
+    @app.route('/jobs/<job_id>/result', methods=['GET'])
+    def job_result(job_id):
+        job = get_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        if job["status"] == "succeeded":
+            return jsonify(job["result"]), job["status_code"]
+        if job["status"] == "failed":
+            return jsonify({"error": "Job failed", "job_id": job_id, "error_url": f"/jobs/{job_id}/error"}), 409
+        return jsonify({"job_id": job_id, "status": job["status"]}), 202
+
+    @app.route('/jobs/<job_id>/events', methods=['GET'])
+    def job_events(job_id):
+        if not get_job(job_id):
+            return jsonify({"error": "Job not found"}), 404
+        return Response(events(job_id), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.route('/jobs/<job_id>/error', methods=['GET'])
+    def job_error(job_id):
+        job = get_job(job_id)
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+        if job["status"] != "failed":
+            return jsonify({"error": "Job has not failed", "status": job["status"]}), 404
+        return jsonify(job["error"]), job["status_code"]
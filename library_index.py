@@ -0,0 +1,163 @@
+from flask import jsonify
+import os
+import random
+import threading
+import time
+import face_registry
+import facefusion_pool
+
+# Persistent index of the faceswap-images target library. Every library image is analysed once
+# on a warm worker (detection, landmarks, embedding, gender and age) and its faces are kept in
+# a memory-mapped FaceArrayStore keyed by "<gender>/<file name>" together with the file's size
+# and mtime. A background thread rescans the folders and only analyses images that are new or
+# changed. Requests sample targets from the in-memory catalog instead of listing the folder,
+# and swaps hand the stored faces to the worker so the target isn't detected again.
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+library_path = os.getenv("FACESWAP_IMAGES_PATH", os.path.join(base_path, "faceswap-images"))
+index_path = os.getenv("LIBRARY_INDEX_PATH", os.path.join(base_path, ".library-index"))
+refresh_interval = float(os.getenv("LIBRARY_REFRESH_INTERVAL", "300"))
+image_extensions = ('.png', '.jpg', '.jpeg')
+
+_store = None
+_catalog = None
+_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_refresh_requested = threading.Event()
+_refresh_thread = None
+_last_refresh = {}
+
+
+def get_store():
+    global _store
+    with _lock:
+        if _store is None:
+            _store = face_registry.FaceArrayStore(index_path)
+    return _store
+
+
+# Function to list the library images per gender folder with their size and mtime
+def _scan():
+    library = {}
+    if not os.path.isdir(library_path):
+        return library
+    for folder in os.scandir(library_path):
+        if not folder.is_dir():
+            continue
+        library[folder.name] = {
+            image.name: (image.stat().st_size, image.stat().st_mtime_ns)
+            for image in os.scandir(folder.path)
+            if image.is_file() and image.name.lower().endswith(image_extensions)
+        }
+    return library
+
+
+def _is_current(fields, size, mtime_ns):
+    return fields is not None and fields.get("size") == size and fields.get("mtime_ns") == mtime_ns
+
+
+# Function to rescan the library, analyse new or changed images and rebuild the catalog.
+# Without analyse the catalog is rebuilt from the stored index only.
+def refresh(analyse=True):
+    global _catalog
+    with _refresh_lock:
+        started = time.perf_counter()
+        store = get_store()
+        counts = {"analysed": 0, "failed": 0, "without_faces": 0, "pending": 0}
+        catalog = {}
+        for gender, images in _scan().items():
+            names = []
+            for name, (size, mtime_ns) in images.items():
+                key = f"{gender}/{name}"
+                fields = store.get_fields(key)
+                if not _is_current(fields, size, mtime_ns):
+                    fields = None
+                    if analyse:
+                        try:
+                            faces = facefusion_pool.analyse_image(os.path.join(library_path, gender, name), face_registry.detection_args, "indexing")
+                            store.put(key, faces, size=size, mtime_ns=mtime_ns)
+                            fields = store.get_fields(key)
+                            counts["analysed"] += 1
+                        except facefusion_pool.WorkerError as e:
+                            # No workers: keep listing the remaining images and analyse them next time
+                            print(f"Library analysis unavailable: {e}")
+                            analyse = False
+                        except Exception as e:
+                            print(f"Error analysing library image {key}: {e}")
+                            counts["failed"] += 1
+                if fields is None:
+                    # Not analysed yet; still a valid target, FaceFusion detects it as before
+                    counts["pending"] += 1
+                elif fields["face_count"] == 0:
+                    counts["without_faces"] += 1
+                    continue
+                names.append(name)
+            catalog[gender] = sorted(names)
+
+        with _lock:
+            _catalog = catalog
+            _last_refresh.update(counts, finished_at=time.time(), seconds=round(time.perf_counter() - started, 3))
+        return catalog
+
+
+def _refresh_loop():
+    while True:
+        try:
+            refresh()
+        except Exception as e:
+            print(f"Error refreshing the library index: {e}")
+        _refresh_requested.wait(refresh_interval)
+        _refresh_requested.clear()
+
+
+# Function to build the catalog on first use and start the background refresh
+def _ensure_started():
+    global _refresh_thread
+    if _catalog is None:
+        refresh(analyse=False)
+    with _lock:
+        if _refresh_thread is None:
+            _refresh_thread = threading.Thread(target=_refresh_loop, name="library-index", daemon=True)
+            _refresh_thread.start()
+
+
+# Function to pick random, non-repeating library images of one gender
+def sample(gender, count):
+    _ensure_started()
+    images = _catalog.get(gender)
+    if images is None:
+        raise Exception(f"No folder found for gender: {gender}")
+    if len(images) < count:
+        raise Exception(f"Not enough images in {os.path.join(library_path, gender)} for {count} face swaps")
+    return [os.path.join(library_path, gender, name) for name in random.sample(images, count)]
+
+
+# Function to get the stored faces of a library image, or None when it isn't analysed or has changed
+def target_faces(image_path):
+    key = os.path.relpath(image_path, library_path)
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    entry = get_store().get(key)
+    if entry is None or not _is_current(entry, stat.st_size, stat.st_mtime_ns) or not entry["faces"]:
+        return None
+    return entry["faces"]
+
+
+# Function to add the library index endpoints to a service
+def register_routes(app):
+    @app.route('/library', methods=['GET'])
+    def library_status():
+        _ensure_started()
+        with _lock:
+            return jsonify({
+                "images": {gender: len(images) for gender, images in _catalog.items()},
+                "last_refresh": dict(_last_refresh)
+            }), 200
+
+    @app.route('/library/refresh', methods=['POST'])
+    def library_refresh():
+        _ensure_started()
+        _refresh_requested.set()
+        return jsonify({"message": "Library refresh started"}), 202
@@ -0,0 +1,211 @@
+from flask import g, request
+import bisect
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# Process-wide metrics in the Prometheus text format, shared by every service: request counts
+# and latency by route and status code, download, FaceFusion run and S3 upload durations,
+# bytes moved, in-flight requests, jobs and runs, and FaceFusion exit codes. Recording is a
+# dict lookup and an addition under a per-metric lock, so it stays on in the hot path.
+# register_routes(app) adds the request hooks and GET /metrics to a Flask app.
+#
+# Each process keeps its own numbers; when a service runs with several worker processes,
+# scrape each of them.
+
+# Seconds; from a cached download up to a long video run
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # Label values -> [per-bucket counts (the last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+requests_total = Counter("http_requests_total", "HTTP requests by service, route, method and status code", ("service", "route", "method", "status"))
+request_seconds = Histogram("http_request_duration_seconds", "HTTP request duration by service and route", ("service", "route"))
+requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests being served", ("service",))
+download_seconds = Histogram("download_duration_seconds", "Input download duration by path (cache or memory) and outcome", ("path", "outcome"))
+downloaded_bytes = Counter("download_bytes_total", "Input bytes fetched from the network or served from the download cache", ("source",))
+facefusion_seconds = Histogram("facefusion_run_duration_seconds", "FaceFusion run duration by job type and operation, excluding the scheduler queue", ("job_type", "op"))
+facefusion_runs_in_flight = Gauge("facefusion_runs_in_flight", "FaceFusion runs holding cores", ("job_type",))
+facefusion_exit_codes = Counter("facefusion_exit_codes_total", "FaceFusion runs by job type, operation and exit code", ("job_type", "op", "exit_code"))
+upload_seconds = Histogram("s3_upload_duration_seconds", "S3 upload duration by outcome", ("outcome",))
+uploads_total = Counter("s3_uploads_total", "S3 uploads by outcome (ok, error or skipped because the object existed)", ("outcome",))
+uploaded_bytes = Counter("s3_upload_bytes_total", "Bytes uploaded to S3")
+jobs_in_flight = Gauge("jobs_in_flight", "Background jobs by status", ("status",))
+preflight_seconds = Histogram("preflight_duration_seconds", "Input checks before inference by outcome (ok, unchecked, unreadable, no_face, too_few_faces)", ("outcome",))
+
+
+# Function to render every metric in the Prometheus text exposition format
+def render():
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Function to get the service label of a Flask app: the script name, or "service" for the consolidated app
+def service_name(app):
+    name = app.import_name
+    if name == "__main__":
+        name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    return name.replace("_", "-")
+
+
+def observe_request(service, route, method, status_code, seconds):
+    requests_total.inc(service=service, route=route, method=method, status=status_code)
+    request_seconds.observe(seconds, service=service, route=route)
+
+
+def observe_download(path, started, ok):
+    download_seconds.observe(time.perf_counter() - started, path=path, outcome="ok" if ok else "error")
+
+
+def observe_upload(seconds, size, outcome):
+    uploads_total.inc(outcome=outcome)
+    if outcome != "skipped":
+        upload_seconds.observe(seconds, outcome=outcome)
+    if size:
+        uploaded_bytes.inc(size)
+
+
+# Context manager timing one FaceFusion run; set run["exit_code"] inside it ("error" when it raises)
+# and run["started"] when the engine only starts later than the block (after waiting for a worker)
+@contextlib.contextmanager
+def facefusion_run(job_type, op):
+    run = {"exit_code": "error"}
+    facefusion_runs_in_flight.inc(job_type=job_type)
+    run["started"] = time.perf_counter()
+    try:
+        yield run
+    finally:
+        facefusion_seconds.observe(time.perf_counter() - run["started"], job_type=job_type, op=op)
+        facefusion_runs_in_flight.dec(job_type=job_type)
+        facefusion_exit_codes.inc(job_type=job_type, op=op, exit_code=run["exit_code"])
+
+
+# Function to add the request hooks and the metrics endpoint to a service
+def register_routes(app):
+    service = service_name(app)
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        requests_in_flight.inc(service=service)
+
+    @app.after_request
+    def record_request(response):
+        if "metrics_started" in g:
+            # The URL rule rather than the path, so the labels don't grow with ids in URLs
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            observe_request(service, route, request.method, response.status_code, time.perf_counter() - g.metrics_started)
+            g.metrics_recorded = True
+        return response
+
+    @app.teardown_request
+    def finish_request(error=None):
+        if "metrics_started" not in g:
+            return
+        requests_in_flight.dec(service=service)
+        # Unhandled exceptions skip after_request and end as 500s
+        if "metrics_recorded" not in g:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            observe_request(service, route, request.method, 500, time.perf_counter() - g.metrics_started)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
@@ -1,83 +1,101 @@
 from flask import Flask, request, jsonify
 import os
-import subprocess
-import requests
-import boto3
-from botocore.exceptions import NoCredentialsError
-import uuid
+import download_cache
+import face_registry
+import facefusion_pool
+import http_client
+import jobs
+import metrics
+import preflight
+import result_cache
+import s3_uploader
+import scheduler
+import tracing
+import workspace
 
 app = Flask(__name__)
+jobs.register_routes(app)
+face_registry.register_routes(app)
+download_cache.register_routes(app)
+result_cache.register_routes(app)
+scheduler.register_routes(app)
+metrics.register_routes(app)
+tracing.register_routes(app)
 
 # Define paths
 base_path = "/home/azureuser/facefusion/"
-source_path_1 = os.path.join(base_path, "source1.jpg")
-source_path_2 = os.path.join(base_path, "source2.jpg")
-target_path = os.path.join(base_path, "target.jpg")
-output_path = os.path.join(base_path, "output.jpg")
-secondary_output_path = os.path.join(base_path, "output_secondary.jpg")
 script_path = os.path.join(base_path, "facefusion.py")
 
 # AWS configuration from environment variables
-aws_access_key = os.getenv("AWS_ACCESS_KEY")
-aws_secret_key = os.getenv("AWS_SECRET_KEY")
 s3_bucket_name = os.getenv("S3_BUCKET_NAME")
-aws_region = os.getenv("AWS_REGION")
 
-# Function to download images from URLs
+# Function to download images from URLs, reusing the local download cache when they haven't changed
 def download_image(url, file_path):
-    try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(file_path, 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            return True
-        else:
-            return False
-    except Exception as e:
-        print(f"Error downloading image: {e}")
-        return False
+    return download_cache.fetch(url, file_path) is not None
 
-# Function to upload file to S3
-def upload_to_s3(file_path, bucket_name):
-    try:
-        # Generate a unique object name using UUID
-        unique_filename = f"{uuid.uuid4()}.jpg"
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
-            region_name=aws_region
-        )
-        s3_client.upload_file(file_path, bucket_name, unique_filename)
-        s3_url = f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{unique_filename}"
-        return s3_url
-    except NoCredentialsError:
-        raise Exception("AWS credentials not found")
-    except Exception as e:
-        raise Exception(f"Failed to upload to S3: {str(e)}")
+# Function to start uploading a file to S3 on the shared client; returns a future resolving to its URL.
+# With a result key the object name is deterministic and an object stored before isn't uploaded again.
+def upload_to_s3(file_path, bucket_name, key=None):
+    return s3_uploader.upload_file(file_path, bucket_name, ".jpg", key=key, skip_existing=key is not None)
 
 @app.route('/multiple-image-faceswap', methods=['POST'])
+@scheduler.admit("image")
+@jobs.async_job
 def face_swap():
+    request_workspace = workspace.Workspace()
     try:
+        # Per-request paths so concurrent requests don't overwrite each other's files
+        source_path_1 = request_workspace.file("source1.jpg")
+        source_path_2 = request_workspace.file("source2.jpg")
+        target_path = request_workspace.file("target.jpg")
+        output_path = request_workspace.file("output.jpg")
+        secondary_output_path = request_workspace.file("output_secondary.jpg")
         data = request.json
         source_url_1 = data.get('source_url_1')
+        face_id_1 = data.get('face_id_1')
         source_url_2 = data.get('source_url_2')
+        face_id_2 = data.get('face_id_2')
         target_url = data.get('target_url')
         source_gender_1 = data.get('source_gender_1')
         source_gender_2 = data.get('source_gender_2')
 
-        if not source_url_1 or not source_url_2 or not target_url or not source_gender_1 or not source_gender_2:
-            return jsonify({"error": "Two source URLs, two genders, and a target URL are required"}), 400
+        if not (source_url_1 or face_id_1) or not (source_url_2 or face_id_2) or not target_url or not source_gender_1 or not source_gender_2:
+            return jsonify({"error": "Two source URLs (or face_ids), two genders, and a target URL are required"}), 400
 
-        # Download images
-        if not download_image(source_url_1, source_path_1):
+        if face_id_1 and not face_registry.get(face_id_1):
+            return jsonify({"error": "Unknown face_id_1"}), 404
+        if face_id_2 and not face_registry.get(face_id_2):
+            return jsonify({"error": "Unknown face_id_2"}), 404
+
+        # Download all inputs concurrently through the shared HTTP client
+        downloads = http_client.gather({
+            "source_1": (face_registry.resolve_source, source_url_1, face_id_1, source_path_1, download_image),
+            "source_2": (face_registry.resolve_source, source_url_2, face_id_2, source_path_2, download_image),
+            "target": (download_image, target_url, target_path)
+        })
+        source_path_1 = downloads["source_1"]
+        if not source_path_1:
             return jsonify({"error": "Failed to download first source image"}), 500
-        if not download_image(source_url_2, source_path_2):
+        source_path_2 = downloads["source_2"]
+        if not source_path_2:
             return jsonify({"error": "Failed to download second source image"}), 500
-        if not download_image(target_url, target_path):
+        if not downloads["target"]:
             return jsonify({"error": "Failed to download target image"}), 500
 
+        # Inputs without the faces the swap needs are answered before they reach FaceFusion
+        rejected = preflight.rejection([
+            (face_registry.preflight_input(face_id_1, source_path_1), "first source image", 1),
+            (face_registry.preflight_input(face_id_2, source_path_2), "second source image", 1),
+            (target_path, "target image", 2)
+        ], data.get('preflight', True))
+        if rejected:
+            body, status_code = rejected
+            return jsonify(body), status_code
+
+        # Sources downloaded by URL are registered once they passed, so the next request with the same image skips detection
+        face_registry.register_source(face_id_1, source_path_1)
+        face_registry.register_source(face_id_2, source_path_2)
+
         # First run with "large-small" and the first source image
         command_first_run = [
             "python3", script_path, "headless-run",
@@ -109,56 +127,94 @@ def face_swap():
             "--log-level", "info"
         ]
 
-        process_first = subprocess.run(command_first_run, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if process_first.returncode != 0:
-            return jsonify({"error": "Facefusion script failed on first run", "details": process_first.stderr}), 500
+        # Large targets can be swapped region by region at their native resolution
+        roi = data.get('roi', facefusion_pool.face_regions_by_default)
+        # Identical requests (same inputs and options) share one run and its stored result
+        result_key = result_cache.result_key(result_cache.script_route(__file__), result_cache.file_hashes(source_path_1, source_path_2, target_path), command_first_run, single_pass=data.get('single_pass', True), roi=roi) if data.get('cache', True) else None
+        with result_cache.coalesce(result_key) as result:
+            if result.body:
+                return jsonify(result.body), 200
 
-        # Second run with "small-large" and the second source image, using the first output as the target
-        command_second_run = [
-            "python3", script_path, "headless-run",
-            "--source-paths", source_path_2,
-            "--target-path", output_path,  # Output of the first run is now the target
-            "--output-path", secondary_output_path,
-            "--processor", "face_swapper",
-            "--face-detector-model", "yoloface",
-            "--face-detector-size", "640x640",
-            "--face-detector-angles", "0", "90", "180", "270",
-            "--face-detector-score", "0.5",
-            "--face-landmarker-model", "2dfan4",
-            "--face-landmarker-score", "0.5",
-            "--face-selector-mode", "one",
-            "--face-selector-order", "right-left",
-            #"--face-selector-gender", source_gender_2,
-            "--face-selector-age-start", "0",
-            "--face-selector-age-end", "100",
-            "--reference-face-distance", "0.6",
-            "--face-mask-types", "box", "region",
-            "--face-mask-blur", "0.3",
-            "--face-mask-padding", "0", "0", "0", "0",
-            "--execution-providers", "cpu",
-            "--execution-thread-count", "4",
-            "--execution-queue-count", "1",
-            "--face-swapper-pixel-boost", "256x256",
-            "--output-image-quality", "100",
-            "--output-image-resolution", "1920x1080",
-            "--log-level", "info"
-        ]
+            # Single pass: detect the target once, give the first source to the left-most face and the second to the right-most,
+            # then write one output. The two-run path below stays as the fallback.
+            if data.get('single_pass', True):
+                try:
+                    face_detection = facefusion_pool.swap_by_position(
+                        command_first_run, target_path, output_path,
+                        [(source_path_1, "left-right"), (source_path_2, "right-left")],
+                        faces=face_registry.faces_for_paths([source_path_1, source_path_2]),
+                        roi=roi
+                    )
+                    output_s3_url = upload_to_s3(output_path, s3_bucket_name, result_cache.output_key(result_key)).result()
+                    # Both legacy keys point at the single output for clients that still read them
+                    return jsonify(result.store({
+                        "message": "Face swap completed successfully",
+                        "output_s3_url": output_s3_url,
+                        "first_output_s3_url": output_s3_url,
+                        "second_output_s3_url": output_s3_url,
+                        "face_detection": face_detection
+                    })), 200
+                except facefusion_pool.WorkerError as e:
+                    print(f"Single-pass swap unavailable, running two passes: {e}")
+                except Exception as e:
+                    return jsonify({"error": "Facefusion single-pass swap failed", "details": str(e)}), 500
+
+            process_first = facefusion_pool.run_facefusion(command_first_run, faces=face_registry.seed_faces(command_first_run), roi=roi)
+            if process_first.returncode != 0:
+                return jsonify({"error": "Facefusion script failed on first run", "details": process_first.stderr}), 500
+
+            # Second run with "small-large" and the second source image, using the first output as the target
+            command_second_run = [
+                "python3", script_path, "headless-run",
+                "--source-paths", source_path_2,
+                "--target-path", output_path,  # Output of the first run is now the target
+                "--output-path", secondary_output_path,
+                "--processor", "face_swapper",
+                "--face-detector-model", "yoloface",
+                "--face-detector-size", "640x640",
+                "--face-detector-angles", "0", "90", "180", "270",
+                "--face-detector-score", "0.5",
+                "--face-landmarker-model", "2dfan4",
+                "--face-landmarker-score", "0.5",
+                "--face-selector-mode", "one",
+                "--face-selector-order", "right-left",
+                #"--face-selector-gender", source_gender_2,
+                "--face-selector-age-start", "0",
+                "--face-selector-age-end", "100",
+                "--reference-face-distance", "0.6",
+                "--face-mask-types", "box", "region",
+                "--face-mask-blur", "0.3",
+                "--face-mask-padding", "0", "0", "0", "0",
+                "--execution-providers", "cpu",
+                "--execution-thread-count", "4",
+                "--execution-queue-count", "1",
+                "--face-swapper-pixel-boost", "256x256",
+                "--output-image-quality", "100",
+                "--output-image-resolution", "1920x1080",
+                "--log-level", "info"
+            ]
 
-        process_second = subprocess.run(command_second_run, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if process_second.returncode != 0:
-            return jsonify({"error": "Facefusion script failed on second run", "details": process_second.stderr}), 500
+            process_second = facefusion_pool.run_facefusion(command_second_run, faces=face_registry.seed_faces(command_second_run), roi=roi)
+            if process_second.returncode != 0:
+                return jsonify({"error": "Facefusion script failed on second run", "details": process_second.stderr}), 500
 
-        # Upload both outputs to S3
-        first_output_s3_url = upload_to_s3(output_path, s3_bucket_name)
-        second_output_s3_url = upload_to_s3(secondary_output_path, s3_bucket_name)
+            # Upload both outputs to S3 in parallel
+            first_upload = upload_to_s3(output_path, s3_bucket_name, result_cache.output_key(result_key))
+            second_upload = upload_to_s3(secondary_output_path, s3_bucket_name, result_cache.output_key(result_key, "-2"))
+            first_output_s3_url = first_upload.result()
+            second_output_s3_url = second_upload.result()
 
-        return jsonify({
-            "message": "Face swap completed successfully",
-            "first_output_s3_url": first_output_s3_url,
-            "second_output_s3_url": second_output_s3_url
-        }), 200
+            return jsonify(result.store({
+                "message": "Face swap completed successfully",
+                "first_output_s3_url": first_output_s3_url,
+                "second_output_s3_url": second_output_s3_url,
+                "face_detection": facefusion_pool.combine_detection(process_first.face_detection, process_second.face_detection)
+            })), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        request_workspace.cleanup()
 
 if __name__ == '__main__':
+    facefusion_pool.prestart(reloader=True)
     app.run(debug=True, host='0.0.0.0', port=6099)
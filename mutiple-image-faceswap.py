@@ -1,85 +1,99 @@
 from flask import Flask, request, jsonify
 import os
-import subprocess
-import requests
-import boto3
-from botocore.exceptions import NoCredentialsError
-import uuid
+import download_cache
+import face_registry
+import facefusion_pool
+import http_client
+import jobs
+import metrics
+import preflight
+import result_cache
+import s3_uploader
+import scheduler
+import tracing
+import workspace
 
 app = Flask(__name__)
+jobs.register_routes(app)
+face_registry.register_routes(app)
+download_cache.register_routes(app)
+result_cache.register_routes(app)
+scheduler.register_routes(app)
+metrics.register_routes(app)
+tracing.register_routes(app)
 
 # Define paths
 base_path = "/home/azureuser/facefusion/"
-temp_path = os.path.join(base_path, ".temp")
-source_path1 = os.path.join(temp_path, "source1.jpg")
-source_path2 = os.path.join(temp_path, "source2.jpg")
-target_path = os.path.join(temp_path, "target.mp4")
-output_path = os.path.join(temp_path, "output.mp4")
 script_path = os.path.join(base_path, "facefusion.py")
 
 # AWS configuration from environment variables
-aws_access_key = os.getenv("AWS_ACCESS_KEY")
-aws_secret_key = os.getenv("AWS_SECRET_KEY")
 s3_bucket_name = os.getenv("S3_BUCKET_NAME")
-aws_region = os.getenv("AWS_REGION")
 
-# Function to download images or videos from URLs
+# Function to download images or videos from URLs, reusing the local download cache when they haven't changed
 def download_file(url, file_path):
-    try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(file_path, 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            return True
-        else:
-            return False
-    except Exception as e:
-        print(f"Error downloading file: {e}")
-        return False
+    return download_cache.fetch(url, file_path) is not None
 
-# Function to upload file to S3
-def upload_to_s3(file_path, bucket_name):
-    try:
-        # Generate a unique object name using UUID
-        unique_filename = f"{uuid.uuid4()}.mp4"
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
-            region_name=aws_region
-        )
-        s3_client.upload_file(file_path, bucket_name, unique_filename)
-        s3_url = f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{unique_filename}"
-        return s3_url
-    except NoCredentialsError:
-        raise Exception("AWS credentials not found")
-    except Exception as e:
-        raise Exception(f"Failed to upload to S3: {str(e)}")
+# Function to start uploading a file to S3 on the shared client; returns a future resolving to its URL.
+# With a result key the object name is deterministic and an object stored before isn't uploaded again.
+def upload_to_s3(file_path, bucket_name, key=None):
+    return s3_uploader.upload_file(file_path, bucket_name, ".mp4", key=key, skip_existing=key is not None)
 
 @app.route('/multiple-image-faceswap', methods=['POST'])
+@scheduler.admit("video")
+@jobs.async_job
 def face_swap():
+    request_workspace = workspace.Workspace()
     try:
+        # Per-request paths so concurrent requests don't overwrite each other's files
+        source_path1 = request_workspace.file("source1.jpg")
+        source_path2 = request_workspace.file("source2.jpg")
+        target_path = request_workspace.file("target.mp4")
+        output_path = request_workspace.file("output.mp4")
         data = request.json
         source_url1 = data.get('source_url1')
+        face_id1 = data.get('face_id1')
         source_url2 = data.get('source_url2')
+        face_id2 = data.get('face_id2')
         target_url = data.get('target_url')
 
-        if not source_url1 or not source_url2 or not target_url:
-            return jsonify({"error": "Source URLs and target URL are required"}), 400
+        if not (source_url1 or face_id1) or not (source_url2 or face_id2) or not target_url:
+            return jsonify({"error": "Source URLs (or face_ids) and target URL are required"}), 400
 
-        # Create temporary directory if it doesn't exist
-        if not os.path.exists(temp_path):
-            os.makedirs(temp_path)
+        # Tracking mode: full face detection every few frames, optical flow in between
+        tracking = data.get('tracking', facefusion_pool.face_tracking_by_default)
+        if not isinstance(tracking, bool):
+            return jsonify({"error": "tracking must be true or false"}), 400
 
-        # Download files
-        if not download_file(source_url1, source_path1):
+        if face_id1 and not face_registry.get(face_id1):
+            return jsonify({"error": "Unknown face_id1"}), 404
+        if face_id2 and not face_registry.get(face_id2):
+            return jsonify({"error": "Unknown face_id2"}), 404
+
+        # Download all inputs concurrently through the shared HTTP client
+        downloads = http_client.gather({
+            "source1": (face_registry.resolve_source, source_url1, face_id1, source_path1, download_file),
+            "source2": (face_registry.resolve_source, source_url2, face_id2, source_path2, download_file),
+            "target": (download_file, target_url, target_path)
+        })
+        source_path1 = downloads["source1"]
+        if not source_path1:
             return jsonify({"error": "Failed to download source image 1"}), 500
-        if not download_file(source_url2, source_path2):
+        source_path2 = downloads["source2"]
+        if not source_path2:
             return jsonify({"error": "Failed to download source image 2"}), 500
-        if not download_file(target_url, target_path):
+        if not downloads["target"]:
             return jsonify({"error": "Failed to download target video"}), 500
 
+        # Inputs without the faces the swap needs are answered before they reach FaceFusion
+        rejected = preflight.rejection([(face_registry.preflight_input(face_id1, source_path1), "first source image", 1), (face_registry.preflight_input(face_id2, source_path2), "second source image", 1)], data.get('preflight', True))
+        if rejected:
+            body, status_code = rejected
+            return jsonify(body), status_code
+
+        # Sources downloaded by URL are registered once they passed, so the next request with the same image skips detection
+        face_registry.register_source(face_id1, source_path1)
+        face_registry.register_source(face_id2, source_path2)
+
         # Construct the command
         command = [
             "python3", script_path, "batch-run",
@@ -101,17 +115,26 @@ def face_swap():
             "--log-level", "info"
         ]
 
-        # Run the script
-        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if process.returncode != 0:
-            return jsonify({"error": "Facefusion script failed", "details": process.stderr}), 500
+        # Identical requests (same inputs and options) share one run and its stored result
+        result_key = result_cache.result_key(result_cache.script_route(__file__), result_cache.file_hashes(source_path1, source_path2, target_path), command, tracking=data.get('tracking')) if data.get('cache', True) else None
+        with result_cache.coalesce(result_key) as result:
+            if result.body:
+                return jsonify(result.body), 200
+
+            # Run the script
+            process = facefusion_pool.run_facefusion(command, faces=face_registry.seed_faces(command), tracking=tracking)
+            if process.returncode != 0:
+                return jsonify({"error": "Facefusion script failed", "details": process.stderr}), 500
 
-        # Upload the output video to S3 with a unique filename
-        output_s3_url = upload_to_s3(output_path, s3_bucket_name)
+            # Upload the output video to S3 under its result key (a unique name when caching is off)
+            output_s3_url = upload_to_s3(output_path, s3_bucket_name, result_cache.output_key(result_key)).result()
 
-        return jsonify({"message": "Face swap completed successfully", "output_s3_url": output_s3_url}), 200
+            return jsonify(result.store({"message": "Face swap completed successfully", "output_s3_url": output_s3_url, "face_detection": process.face_detection})), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        request_workspace.cleanup()
 
 if __name__ == '__main__':
+    facefusion_pool.prestart(reloader=True)
     app.run(debug=True, host='0.0.0.0', port=7869)
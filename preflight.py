@@ -0,0 +1,167 @@
+import io
+import os
+import threading
+import time
+import cv2
+import numpy as np
+import metrics
+import tracing
+
+# Cheap checks on the input images before any FaceFusion work. Each image is decoded straight
+# to a working size (JPEG draft mode scales by 1/2, 1/4 or 1/8 inside the decoder, so a 48 MP
+# photo costs about as much as a thumbnail); images that can't be decoded are answered with a 422
+# before they wait for an engine slot. With PREFLIGHT_DETECTOR_MODEL pointing at OpenCV's YuNet
+# ONNX model, faces are also counted at 0°, 90°, 180° and 270°, the angles the swap commands
+# detect at, and inputs with fewer faces than the endpoint needs are rejected too. Without YuNet
+# the faces are counted by FaceFusion's own detector (no landmarks or embeddings) on a warm worker,
+# but only when one is idle right now; the check never queues for an engine. A detector that
+# misses faces FaceFusion would find turns valid requests away, so weaker detectors (e.g. Haar
+# cascades) aren't used and YuNet's thresholds lean towards finding faces. Registered sources
+# are judged by the face count FaceFusion stored for them. Inputs no detector could count pass
+# as "unchecked" and are logged. Requests can skip the check with "preflight": false.
+
+enabled = os.getenv("PREFLIGHT", "1") == "1"
+working_size = int(os.getenv("PREFLIGHT_WORKING_SIZE", "640"))
+detector_model = os.getenv("PREFLIGHT_DETECTOR_MODEL", "")
+min_score = float(os.getenv("PREFLIGHT_MIN_SCORE", "0.5"))
+min_face_size = int(os.getenv("PREFLIGHT_MIN_FACE_SIZE", "0"))
+# Count faces with FaceFusion's detector on an idle worker when YuNet isn't configured
+engine_fallback = os.getenv("PREFLIGHT_ENGINE_FALLBACK", "1") == "1"
+
+rotations = (None, cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_90_COUNTERCLOCKWISE, cv2.ROTATE_180)
+exif_orientation_tag = 0x0112
+
+# Detectors aren't safe to share between threads, so each thread loads its own
+_local = threading.local()
+_missing_reported = False
+
+
+class PreflightError(Exception):
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+def _yunet():
+    if not hasattr(cv2, "FaceDetectorYN") or not os.path.exists(detector_model):
+        return None
+    model = cv2.FaceDetectorYN.create(detector_model, "", (working_size, working_size), min_score)
+
+    def detect(frame):
+        model.setInputSize((frame.shape[1], frame.shape[0]))
+        _, faces = model.detect(frame)
+        return 0 if faces is None else int(sum(1 for face in faces if min(face[2], face[3]) >= min_face_size))
+    return detect
+
+
+# Function to get this thread's face counter, detect(frame) -> number of faces, or None
+def _detector():
+    global _missing_reported
+    if not detector_model:
+        return None
+    detect = getattr(_local, "detect", None)
+    if detect is None:
+        detect = _yunet() or False
+        if not detect and not _missing_reported:
+            _missing_reported = True
+            print(f"Preflight face check disabled: cannot load {detector_model}")
+        _local.detect = detect
+    return detect or None
+
+
+# Function to decode an image (a path or bytes) upright and at most working_size on its longer
+# side; returns None when it isn't a readable image
+def decode_small(source):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        Image = None
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+                # Only JPEG decoders implement draft; other formats decode in full
+                image.draft("RGB", (working_size, working_size))
+                if image.getexif().get(exif_orientation_tag, 1) != 1:
+                    image = ImageOps.exif_transpose(image)
+                image = image.convert("RGB")
+                image.thumbnail((working_size, working_size))
+                return cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR)
+        except Exception:
+            pass
+
+    if isinstance(source, bytes):
+        frame = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        frame = cv2.imread(source, cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    scale = working_size / max(frame.shape[:2])
+    if scale < 1:
+        frame = cv2.resize(frame, (round(frame.shape[1] * scale), round(frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    return frame
+
+
+# Function to count the faces in a decoded image with FaceFusion's detector on an idle worker;
+# returns None when the fallback is off or no worker is idle
+def _engine_count(frame, wanted):
+    if not engine_fallback:
+        return None
+    import face_registry
+    import facefusion_pool
+    return facefusion_pool.count_faces(frame, face_registry.detection_args, wanted)
+
+
+# Function to count the faces in a decoded image, turning it a quarter at a time until at least
+# wanted are found; returns None when no detector is available
+def count_faces(frame, wanted=1):
+    detect = _detector()
+    if detect is None:
+        return _engine_count(frame, wanted)
+    found = 0
+    for rotation in rotations:
+        found = max(found, detect(frame if rotation is None else cv2.rotate(frame, rotation)))
+        if found >= wanted:
+            break
+    return found
+
+
+# Function to check one input image, given as a path, bytes, or the number of faces FaceFusion
+# found in it; raises PreflightError when it can't be swapped
+def check(source, label, min_faces=1):
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        with tracing.span("preflight", input=label) as preflight_span:
+            if isinstance(source, int):
+                found = source
+            else:
+                frame = decode_small(source)
+                if frame is None:
+                    outcome = "unreadable"
+                    raise PreflightError(f"The {label} is not a readable image", {"input": label})
+                found = count_faces(frame, min_faces)
+            if found is None:
+                outcome = "unchecked"
+                preflight_span.set(outcome=outcome)
+                print(f"Preflight did not count the faces in the {label}: no YuNet model (PREFLIGHT_DETECTOR_MODEL) and no idle FaceFusion worker")
+            elif found < min_faces:
+                outcome = "no_face" if found == 0 else "too_few_faces"
+                message = f"No face detected in the {label}" if found == 0 else f"The {label} needs at least {min_faces} faces, found {found}"
+                raise PreflightError(message, {"input": label, "faces_found": found, "faces_required": min_faces})
+    finally:
+        metrics.preflight_seconds.observe(time.perf_counter() - started, outcome=outcome)
+
+
+# Function to check a request's input images, given as (path, bytes or face count, label,
+# minimum faces); inputs given as None are skipped. Returns None when the request may go on,
+# else the (response body, status code) to answer with.
+def rejection(inputs, requested=True):
+    if not enabled or not requested:
+        return None
+    try:
+        for source, label, min_faces in inputs:
+            if source is not None:
+                check(source, label, min_faces)
+    except PreflightError as e:
+        return {"error": str(e), "details": e.details}, 422
+    return None
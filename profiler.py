@@ -0,0 +1,105 @@
+import argparse
+import os
+import runpy
+import sys
+import threading
+import time
+from collections import Counter
+
+# Sampling profiler with no dependencies beyond the standard library. A background thread
+# wakes every interval, reads the current frame of every thread (sys._current_frames) and
+# counts the stacks of the threads it was asked to watch. Stacks come out in the collapsed
+# format ("outer;inner;innermost count") that flamegraph.pl and speedscope read.
+#
+# The API samples the threads working on a profiled request (see tracing.py), the FaceFusion
+# workers sample themselves while they run its job (see facefusion_engine.serve), and a
+# FaceFusion subprocess runs under this module's command line:
+#
+#   python3 profiler.py --output run.folded --interval 0.005 facefusion.py headless-run ...
+
+default_interval = 0.005
+max_depth = 128
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+# Function to turn a frame into a collapsed stack, outermost call first
+def collapse(frame):
+    names = []
+    while frame is not None and len(names) < max_depth:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler:
+    # watch(thread_ident) tells which threads to sample; all others but the sampler's by default
+    def __init__(self, interval=default_interval, watch=None):
+        self.interval = interval
+        self.watch = watch
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or (self.watch is not None and not self.watch(ident)):
+                    continue
+                self.stacks[collapse(frame)] += 1
+            self.samples += 1
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+        return self
+
+    # Function to stop sampling; returns the counted stacks
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.seconds = time.perf_counter() - self.started
+        return dict(self.stacks)
+
+
+def write_folded(stacks, path):
+    with open(path, 'w') as file:
+        for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            file.write(f"{stack} {count}\n")
+
+
+def read_folded(path):
+    stacks = {}
+    with open(path) as file:
+        for line in file:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+
+# Function to run a Python script under the sampler, e.g. facefusion.py in a subprocess
+def main():
+    parser = argparse.ArgumentParser(description="Run a Python script and write a sampling profile of it")
+    parser.add_argument("--output", required=True, help="Collapsed stacks file to write")
+    parser.add_argument("--interval", type=float, default=default_interval)
+    parser.add_argument("script")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.argv = [args.script] + args.args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    sampler = Sampler(args.interval).start()
+    try:
+        runpy.run_path(args.script, run_name="__main__")
+    finally:
+        write_folded(sampler.stop(), args.output)
+
+
+if __name__ == '__main__':
+    main()
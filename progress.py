@@ -0,0 +1,132 @@
+import collections
+import contextlib
+import contextvars
+import itertools
+import os
+import re
+import threading
+import time
+
+# Streaming FaceFusion output. The engine's stdout and stderr are read line by line as they are
+# written (tqdm's carriage-return refreshes count as lines), progress is parsed out of them,
+# and only a bounded tail of each is kept: the last lines are what a failure reports. Progress
+# goes to whoever listens in the current context, e.g. a background job (see jobs.py), with
+# one entry per FaceFusion run of the request.
+
+tail_lines = int(os.getenv("FACEFUSION_OUTPUT_TAIL_LINES", "200"))
+max_line_length = 2000
+# Progress updates are passed on at most this often per run (plus the final one)
+report_interval = float(os.getenv("PROGRESS_REPORT_INTERVAL", "0.5"))
+
+# tqdm bars as FaceFusion prints them, e.g. "processing:  45%|####      | 120/266 [00:10<00:12, 11.52frame/s]"
+_bar_pattern = re.compile(r"(?:^|\s)(?:(?P<stage>[A-Za-z][\w .-]*?):\s*)?(?P<percent>\d{1,3})%\|[^|]*\|\s*(?P<done>\d+)/(?P<total>\d+)")
+# Step messages such as "Processing step 1 of 2"
+_step_pattern = re.compile(r"step (?P<step>\d+) of (?P<steps>\d+)", re.IGNORECASE)
+
+_listener = contextvars.ContextVar("progress_listener", default=None)
+_run_ids = itertools.count(1)
+
+
+# Function to read progress from one line of output; returns a dict or None
+def parse(line):
+    match = _bar_pattern.search(line)
+    if match:
+        fields = {"percent": min(100, int(match["percent"])), "done": int(match["done"]), "total": int(match["total"])}
+        if match["stage"]:
+            fields["stage"] = match["stage"].strip().lower()
+        return fields
+    match = _step_pattern.search(line)
+    if match:
+        return {"step": int(match["step"]), "steps": int(match["steps"])}
+    return None
+
+
+# File-like sink for a process's output: keeps the last lines and passes progress on
+class OutputTail:
+    def __init__(self, on_progress=None):
+        self.lines = collections.deque(maxlen=tail_lines)
+        self.partial = ""
+        self.on_progress = on_progress
+        self.progress = {}
+        self.progress_line = None
+        self.last_report = 0.0
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            pieces = (self.partial + text).replace("\r\n", "\n").replace("\r", "\n").split("\n")
+            self.partial = pieces.pop()[-max_line_length:]
+            for line in pieces:
+                self._line(line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def _line(self, line):
+        if not line.strip():
+            return
+        fields = parse(line)
+        if fields is None:
+            self.lines.append(line[:max_line_length])
+            return
+        # Bars redraw many times a second; only the latest one is kept
+        self.progress_line = line[:max_line_length]
+        self.progress.update(fields)
+        now = time.monotonic()
+        if self.on_progress and now - self.last_report >= report_interval:
+            self.last_report = now
+            self.on_progress(dict(self.progress))
+
+    # Function to end the stream, passing on the final progress
+    def close(self):
+        with self.lock:
+            if self.partial:
+                self._line(self.partial)
+                self.partial = ""
+            if self.on_progress and self.progress:
+                self.on_progress(dict(self.progress))
+
+    def tail(self):
+        with self.lock:
+            lines = list(self.lines)
+            if self.progress_line:
+                lines.append(self.progress_line)
+            if self.partial:
+                lines.append(self.partial)
+        return "\n".join(lines)
+
+
+# Function to pump a text stream into an OutputTail until it ends, e.g. on a reader thread
+def pump(stream, output):
+    for line in stream:
+        output.write(line)
+    output.close()
+
+
+# Context manager sending the progress of every FaceFusion run in this context to
+# callback(run_id, label, fields)
+@contextlib.contextmanager
+def listening(callback):
+    token = _listener.set(callback)
+    try:
+        yield
+    finally:
+        _listener.reset(token)
+
+
+def _ignore(fields):
+    pass
+
+
+# Function to get a progress reporter for one FaceFusion run; a no-op when nobody listens
+def reporter(label):
+    callback = _listener.get()
+    if callback is None:
+        return _ignore
+    run_id = next(_run_ids)
+    return lambda fields: callback(run_id, label, fields)
+
+
+def listening_now():
+    return _listener.get() is not None
@@ -0,0 +1,159 @@
+from flask import jsonify
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import face_registry
+
+# Result deduplication. A finished swap is remembered under the hash of (endpoint, content
+# hashes of its inputs, FaceFusion options without file paths, output-relevant request
+# options) together with the response it produced, so a resubmitted identical request is
+# answered from the cache. Identical requests that arrive while the first one is still running
+# wait for it instead of starting their own run; if it fails they run themselves. Outputs are
+# uploaded under the same deterministic key, so a duplicate upload is skipped (see s3_uploader).
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+cache_path = os.getenv("RESULT_CACHE_PATH", os.path.join(base_path, ".result-cache"))
+cache_enabled = os.getenv("RESULT_CACHE", "1") == "1"
+cache_ttl = float(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+
+# Options whose value is a file path of the current request rather than a setting
+path_options = ("--source-paths", "--target-path", "--output-path")
+
+_lock = threading.Lock()
+_db = None
+_inflight = {}
+_stats = {"hits": 0, "coalesced": 0, "misses": 0, "stored": 0}
+
+
+def _connect():
+    global _db
+    if _db is None:
+        os.makedirs(cache_path, exist_ok=True)
+        _db = sqlite3.connect(os.path.join(cache_path, "results.sqlite3"), check_same_thread=False, timeout=30)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, body TEXT, created_at REAL)")
+        _db.commit()
+    return _db
+
+
+# Function to drop the file paths from a FaceFusion command, keeping every setting in order
+def normalize_options(command):
+    options = []
+    skipping = False
+    for arg in command[2:]:
+        if arg.startswith("--"):
+            skipping = arg in path_options
+        if not skipping:
+            options.append(arg)
+    return options
+
+
+# Function to name a script's results in the cache keys by its file name, so its routes on a
+# legacy port, under its prefix in the consolidated service and on the asyncio service share them
+def script_route(script_file):
+    return os.path.splitext(os.path.basename(script_file))[0]
+
+
+# Function to build the cache key of a request; input_hashes are the content hashes of its
+# inputs in order, options the request fields that change the output. Returns None when the
+# cache is disabled.
+def result_key(route, input_hashes, command, **options):
+    if not cache_enabled or not all(input_hashes):
+        return None
+    material = json.dumps({
+        "route": route,
+        "inputs": list(input_hashes),
+        "command": normalize_options(command),
+        "options": options
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+# Function to get the content hashes of input files
+def file_hashes(*file_paths):
+    return [face_registry.content_hash(file_path) for file_path in file_paths]
+
+
+def _lookup(key):
+    db = _connect()
+    row = db.execute("SELECT body, created_at FROM results WHERE key = ?", (key,)).fetchone()
+    if row is None or time.time() - row[1] > cache_ttl:
+        return None
+    return json.loads(row[0])
+
+
+class _Result:
+    def __init__(self, key):
+        self.key = key
+        self.body = None
+
+    # Function to remember a successful response body for this key; returns it unchanged
+    def store(self, body):
+        if self.key is None:
+            return body
+        with _lock:
+            db = _connect()
+            db.execute("INSERT OR REPLACE INTO results (key, body, created_at) VALUES (?, ?, ?)", (self.key, json.dumps(body), time.time()))
+            db.commit()
+            _stats["stored"] += 1
+        return body
+
+
+# Context manager around one request's swap. result.body is the cached response body when an
+# identical request already finished (or finished while this one waited); otherwise this
+# request runs the swap and calls result.store(body) on success.
+@contextlib.contextmanager
+def coalesce(key):
+    result = _Result(key)
+    if key is None:
+        yield result
+        return
+
+    leader = False
+    waited = False
+    while True:
+        with _lock:
+            body = _lookup(key)
+            if body is not None:
+                result.body = dict(body, cached=True)
+                _stats["coalesced" if waited else "hits"] += 1
+                break
+            running = _inflight.get(key)
+            if running is None:
+                _inflight[key] = threading.Event()
+                leader = True
+                _stats["misses"] += 1
+                break
+        running.wait()
+        waited = True
+
+    try:
+        yield result
+    finally:
+        if leader:
+            with _lock:
+                _inflight.pop(key).set()
+
+
+# Function to get the S3 object key of an output, e.g. output_key(key, "-2") -> "<key>-2"
+def output_key(key, suffix=""):
+    return None if key is None else f"{key}{suffix}"
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+        result["in_flight"] = len(_inflight)
+        result["stored_results"] = _connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    return result
+
+
+# Function to add the result cache counters endpoint to a service
+def register_routes(app):
+    @app.route('/results/stats', methods=['GET'])
+    def result_stats():
+        return jsonify(stats()), 200
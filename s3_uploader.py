@@ -0,0 +1,133 @@
+from concurrent.futures import Future
+import io
+import os
+import threading
+import time
+import uuid
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, NoCredentialsError
+from s3transfer.manager import TransferConfig, TransferManager
+from s3transfer.subscribers import BaseSubscriber
+import metrics
+import tracing
+
+# One process-wide S3 client and transfer manager. Credentials are resolved and TLS
+# connections opened once, and uploads run on the transfer manager's threads so a request
+# can upload all of its outputs in parallel. Point S3_ENDPOINT_URL at a local S3-compatible
+# server (MinIO, moto_server, ...) to run the same code path offline.
+
+aws_access_key = os.getenv("AWS_ACCESS_KEY")
+aws_secret_key = os.getenv("AWS_SECRET_KEY")
+aws_region = os.getenv("AWS_REGION")
+s3_endpoint_url = os.getenv("S3_ENDPOINT_URL")
+max_pool_connections = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+max_concurrent_uploads = int(os.getenv("S3_MAX_CONCURRENT_UPLOADS", "16"))
+
+_client = None
+_transfer_manager = None
+_lock = threading.Lock()
+
+
+def get_client():
+    global _client, _transfer_manager
+    with _lock:
+        if _client is None:
+            config = Config(
+                max_pool_connections=max_pool_connections,
+                retries={"max_attempts": 3, "mode": "standard"},
+                s3={"addressing_style": "path"} if s3_endpoint_url else {}
+            )
+            _client = boto3.session.Session().client(
+                's3',
+                aws_access_key_id=aws_access_key,
+                aws_secret_access_key=aws_secret_key,
+                region_name=aws_region,
+                endpoint_url=s3_endpoint_url,
+                config=config
+            )
+            _transfer_manager = TransferManager(_client, TransferConfig(
+                max_request_concurrency=max_concurrent_uploads,
+                max_submission_concurrency=max_concurrent_uploads
+            ))
+    return _client
+
+
+def get_transfer_manager():
+    get_client()
+    return _transfer_manager
+
+
+# Function to build the public URL of an uploaded object
+def object_url(bucket_name, key):
+    if s3_endpoint_url:
+        return f"{s3_endpoint_url.rstrip('/')}/{bucket_name}/{key}"
+    return f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{key}"
+
+
+class _ResultSubscriber(BaseSubscriber):
+    def __init__(self, result, url, upload_span):
+        self.result = result
+        self.url = url
+        self.upload_span = upload_span
+        self.started = time.perf_counter()
+
+    def on_done(self, future, **kwargs):
+        seconds = time.perf_counter() - self.started
+        # Exposed on the returned future so callers can report how long the upload took
+        self.result.upload_seconds = round(seconds, 3)
+        try:
+            future.result()
+            metrics.observe_upload(seconds, future.meta.size, "ok")
+            self.upload_span.set(bytes=future.meta.size)
+            self.upload_span.end()
+            self.result.set_result(self.url)
+        except NoCredentialsError:
+            metrics.observe_upload(seconds, 0, "error")
+            self.upload_span.end("AWS credentials not found")
+            self.result.set_exception(Exception("AWS credentials not found"))
+        except Exception as e:
+            metrics.observe_upload(seconds, 0, "error")
+            self.upload_span.end(e)
+            self.result.set_exception(Exception(f"Failed to upload to S3: {str(e)}"))
+
+
+# Function to check whether an object already exists, e.g. a deterministic result key uploaded before
+def object_exists(bucket_name, key):
+    try:
+        get_client().head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+# Function to start uploading a file (a path or file object) under a unique name, or under
+# key + extension when a key is given; returns a future resolving to its URL. With
+# skip_existing an object that is already stored under that key isn't uploaded again.
+def upload_file(file_path, bucket_name, extension, key=None, skip_existing=False):
+    key = f"{key}{extension}" if key else f"{uuid.uuid4()}{extension}"
+    result = Future()
+    result.set_running_or_notify_cancel()
+    # Ends when the transfer does, on the transfer manager's thread
+    upload_span = tracing.start_span("s3.upload", bucket=bucket_name, key=key)
+    try:
+        if skip_existing and object_exists(bucket_name, key):
+            result.upload_seconds = 0
+            result.upload_skipped = True
+            metrics.observe_upload(0, 0, "skipped")
+            upload_span.set(skipped=True)
+            upload_span.end()
+            result.set_result(object_url(bucket_name, key))
+            return result
+        get_transfer_manager().upload(file_path, bucket_name, key, subscribers=[_ResultSubscriber(result, object_url(bucket_name, key), upload_span)])
+    except Exception as e:
+        upload_span.end(e)
+        result.set_exception(Exception(f"Failed to upload to S3: {str(e)}"))
+    return result
+
+
+# Function to start uploading an in-memory object; returns a future resolving to its URL
+def upload_bytes(data, bucket_name, extension, key=None, skip_existing=False):
+    return upload_file(io.BytesIO(data), bucket_name, extension, key, skip_existing)
@@ -0,0 +1,233 @@
+from flask import jsonify
+import contextlib
+import functools
+import math
+import os
+import threading
+import time
+import autotune
+
+# Process-wide admission control for FaceFusion work. Every run asks for a number of cores
+# (its --execution-thread-count) and only starts while the runs in progress fit in the core
+# budget; the rest wait in a queue ordered by job type, so cheap single-image work goes ahead
+# of video. A queued job moves up one priority class for every priority_aging_seconds it waits,
+# so video still gets through under a steady stream of images. Routes check the queue before
+# they start: past the queue depth or the predicted wait they answer 429 with Retry-After. Runs
+# on the FaceFusion worker pool are also capped at the number of workers, so an admitted run never
+# waits for a worker while it holds its cores.
+
+core_budget = int(os.getenv("SCHEDULER_CORES", str(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 4)))
+max_queue_depth = int(os.getenv("SCHEDULER_MAX_QUEUE_DEPTH", "32"))
+max_wait_seconds = float(os.getenv("SCHEDULER_MAX_WAIT_SECONDS", "300"))
+priority_aging_seconds = float(os.getenv("SCHEDULER_PRIORITY_AGING_SECONDS", "60"))
+
+# Lower runs first; the seconds are the starting estimate of one run until real runs are timed.
+# Background indexing (library refresh, sources registered after a request) goes last and runs
+# one at a time, so it never takes more than one worker from requests.
+job_types = {
+    "analysis": {"priority": 0, "seconds": 2.0},
+    "image": {"priority": 1, "seconds": 10.0},
+    "video": {"priority": 2, "seconds": 120.0},
+    "indexing": {"priority": 3, "seconds": 2.0, "max_running": 1}
+}
+video_extensions = ('.mp4', '.mov', '.avi', '.mkv', '.webm', '.m4v')
+default_thread_count = 4
+# Weight of the latest run in the moving averages of run and wait times
+smoothing = 0.2
+
+
+class SchedulerBusy(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Job:
+    def __init__(self, job_type, cores, sequence, pooled=False):
+        self.job_type = job_type
+        self.cores = cores
+        self.pooled = pooled
+        self.sequence = sequence
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+
+    def priority(self, now):
+        aged = int((now - self.enqueued_at) / priority_aging_seconds) if priority_aging_seconds > 0 else 0
+        return (job_types[self.job_type]["priority"] - aged, self.sequence)
+
+
+class Scheduler:
+    def __init__(self, cores):
+        self.cores = max(1, cores)
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = []
+        self.sequence = 0
+        # Number of pool workers, or None without a pool
+        self.workers = None
+        self.run_seconds = {job_type: settings["seconds"] for job_type, settings in job_types.items()}
+        self.wait_seconds = {job_type: 0.0 for job_type in job_types}
+        self.counts = {job_type: {"completed": 0, "rejected": 0} for job_type in job_types}
+
+    def _cores_in_use(self):
+        return sum(job.cores for job in self.running)
+
+    def _at_limit(self, job_type):
+        limit = autotune.concurrency(job_type) or job_types[job_type].get("max_running")
+        return limit is not None and sum(1 for job in self.running if job.job_type == job_type) >= limit
+
+    def _no_worker_for(self, job):
+        return job.pooled and self.workers is not None and sum(1 for running in self.running if running.pooled) >= self.workers
+
+    # A job starts when it is first in line among the job types below their tuned concurrency
+    # (and, for pool runs, with a worker left) and fits next to the running jobs; a job asking
+    # for more cores than the budget runs alone
+    def _can_start(self, job, now):
+        startable = [waiting for waiting in self.waiting if not self._at_limit(waiting.job_type) and not self._no_worker_for(waiting)]
+        if not startable or min(startable, key=lambda waiting: waiting.priority(now)) is not job:
+            return False
+        return not self.running or self._cores_in_use() + job.cores <= self.cores
+
+    def acquire(self, job_type, cores, pooled=False):
+        with self.condition:
+            self.sequence += 1
+            job = _Job(job_type, min(cores, self.cores), self.sequence, pooled)
+            self.waiting.append(job)
+            # Waiting jobs age, so the order is rechecked now and then even without a release
+            while not self._can_start(job, time.monotonic()):
+                self.condition.wait(timeout=priority_aging_seconds or None)
+            self.waiting.remove(job)
+            job.started_at = time.monotonic()
+            self.running.append(job)
+            waited = job.started_at - job.enqueued_at
+            self.wait_seconds[job_type] += smoothing * (waited - self.wait_seconds[job_type])
+            self.condition.notify_all()
+            return job
+
+    def release(self, job):
+        with self.condition:
+            self.running.remove(job)
+            seconds = time.monotonic() - job.started_at
+            self.run_seconds[job.job_type] += smoothing * (seconds - self.run_seconds[job.job_type])
+            self.counts[job.job_type]["completed"] += 1
+            self.condition.notify_all()
+
+    # Function to estimate how long a new job of a type would wait: the remaining core-seconds of
+    # the running jobs and of the queued jobs that go before it, spread over the core budget
+    def predicted_wait(self, job_type, cores=default_thread_count):
+        with self.condition:
+            now = time.monotonic()
+            priority = job_types[job_type]["priority"]
+            ahead = [job for job in self.waiting if job.priority(now)[0] <= priority]
+            if not ahead and (not self.running or self._cores_in_use() + min(cores, self.cores) <= self.cores):
+                return 0.0
+            work = sum(max(0.0, self.run_seconds[job.job_type] - (now - job.started_at)) * job.cores for job in self.running)
+            work += sum(self.run_seconds[job.job_type] * job.cores for job in ahead)
+            return work / self.cores
+
+    # Function to refuse a new request when the queue is too deep or its wait too long
+    def check(self, job_type):
+        with self.condition:
+            depth = len(self.waiting)
+            wait = self.predicted_wait(job_type)
+            if depth < max_queue_depth and wait <= max_wait_seconds:
+                return
+            self.counts[job_type]["rejected"] += 1
+        raise SchedulerBusy(f"Server is busy: {depth} jobs queued, predicted wait {round(wait)} seconds", max(1, math.ceil(wait)))
+
+    def stats(self):
+        with self.condition:
+            now = time.monotonic()
+            stats = {
+                "cores": self.cores,
+                "cores_in_use": self._cores_in_use(),
+                "workers": self.workers,
+                "workers_in_use": sum(1 for job in self.running if job.pooled),
+                "queue_depth": len(self.waiting),
+                "max_queue_depth": max_queue_depth,
+                "max_wait_seconds": max_wait_seconds,
+                "oldest_queued_seconds": round(max((now - job.enqueued_at for job in self.waiting), default=0.0), 3),
+                "job_types": {}
+            }
+            for job_type in job_types:
+                stats["job_types"][job_type] = {
+                    "running": sum(1 for job in self.running if job.job_type == job_type),
+                    "queued": sum(1 for job in self.waiting if job.job_type == job_type),
+                    "max_running": autotune.concurrency(job_type) or job_types[job_type].get("max_running"),
+                    "average_run_seconds": round(self.run_seconds[job_type], 3),
+                    "average_wait_seconds": round(self.wait_seconds[job_type], 3),
+                    "predicted_wait_seconds": round(self.predicted_wait(job_type), 3),
+                    **self.counts[job_type]
+                }
+        return stats
+
+
+_scheduler = Scheduler(core_budget)
+
+
+# Function to get the cores a FaceFusion command asks for
+def command_cores(args):
+    if "--execution-thread-count" in args:
+        try:
+            return int(args[args.index("--execution-thread-count") + 1])
+        except (IndexError, ValueError):
+            pass
+    return default_thread_count
+
+
+# Function to tell the job type of a FaceFusion command from its target
+def command_job_type(args):
+    if "--target-path" in args and args[args.index("--target-path") + 1].lower().endswith(video_extensions):
+        return "video"
+    return "image"
+
+
+# Function to cap the runs on the worker pool at its number of workers
+def limit_workers(count):
+    with _scheduler.condition:
+        _scheduler.workers = count
+        _scheduler.condition.notify_all()
+
+
+# Context manager holding cores (and, for a pooled run, a worker) for one FaceFusion run, waiting
+# in the queue for them
+@contextlib.contextmanager
+def slot(job_type, cores, pooled=False):
+    job = _scheduler.acquire(job_type, cores, pooled)
+    try:
+        yield job
+    finally:
+        _scheduler.release(job)
+
+
+def check(job_type):
+    _scheduler.check(job_type)
+
+
+def stats():
+    return _scheduler.stats()
+
+
+def busy_response(error):
+    return jsonify({"error": str(error), "retry_after": error.retry_after}), 429, {"Retry-After": str(error.retry_after)}
+
+
+# Decorator answering 429 before a route downloads anything when the queue is full
+def admit(job_type):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            try:
+                check(job_type)
+            except SchedulerBusy as e:
+                return busy_response(e)
+            return view(**view_args)
+        return wrapper
+    return decorator
+
+
+# Function to add the scheduler queue endpoint to a service
+def register_routes(app):
+    @app.route('/scheduler', methods=['GET'])
+    def scheduler_stats():
+        return jsonify(stats()), 200
@@ -0,0 +1,132 @@
+from flask import Flask, jsonify
+import importlib.util
+import os
+import sys
+import threading
+from werkzeug.serving import make_server
+import download_cache
+import face_registry
+import facefusion_pool
+import jobs
+import library_index
+import metrics
+import result_cache
+import scheduler
+import tracing
+
+# One process hosting every swap endpoint. The existing scripts are loaded as modules, so
+# their routes keep their exact request and response contracts while sharing this process's
+# FaceFusion worker pool, job executor, HTTP/S3 clients and caches instead of each script
+# starting its own and competing for the same cores.
+#
+# The main app serves every script under its own prefix, e.g. /image-swap-api/faceswap or
+# /v6/five-images-faceswap, next to one copy of the shared endpoints (/jobs, /faces, ...).
+# The legacy ports serve one script each on its original paths; several scripts used to share
+# a port, so which one answers there is configurable:
+#
+#   SERVICE_LEGACY_PORTS="7860=image-swap-api,7869=mutiple-image-faceswap,8011=new-api-v4,8013=v6,6099=multiple-image-faceswap-api-v4"
+#
+# Run it directly (python3 service.py) to listen on SERVICE_PORT and every legacy port, or
+# under a WSGI server with service:application, binding the same ports. async_service.py
+# serves the same ports and routes on asyncio event loops.
+
+script_names = (
+    "image-swap-api",
+    "new-api-v3",
+    "new-api-v4",
+    "v6",
+    "video-faceswap-api-v1",
+    "video-faceswap-api-v2",
+    "mulitiple-image-faceswap-v2",
+    "multiple-image-faceswap-v3",
+    "multiple-image-faceswap-api-v4",
+    "mutiple-image-faceswap"
+)
+service_host = os.getenv("SERVICE_HOST", "0.0.0.0")
+service_port = int(os.getenv("SERVICE_PORT", "8000"))
+legacy_ports = {
+    int(port): name
+    for port, name in (
+        mapping.split("=") for mapping in os.getenv(
+            "SERVICE_LEGACY_PORTS",
+            "7860=image-swap-api,7869=mutiple-image-faceswap,8011=new-api-v4,8013=v6,6099=multiple-image-faceswap-api-v4"
+        ).split(",") if mapping
+    )
+}
+script_directory = os.path.dirname(os.path.abspath(__file__))
+
+
+# Function to import a script by file name, e.g. "new-api-v4" -> module "new_api_v4"
+def load_script(name):
+    module_name = name.replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(script_directory, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_scripts():
+    scripts = {}
+    for name in script_names:
+        try:
+            scripts[name] = load_script(name)
+        except Exception as e:
+            print(f"Error loading {name}: {e}")
+    return scripts
+
+
+# Function to build the main app: each script's own routes under /<script name>, shared routes once
+def create_app(scripts):
+    app = Flask(__name__)
+    jobs.register_routes(app)
+    face_registry.register_routes(app)
+    download_cache.register_routes(app)
+    result_cache.register_routes(app)
+    library_index.register_routes(app)
+    scheduler.register_routes(app)
+    metrics.register_routes(app)
+    tracing.register_routes(app)
+
+    routes = {}
+    for name, module in scripts.items():
+        for rule in module.app.url_map.iter_rules():
+            view = module.app.view_functions[rule.endpoint]
+            # Shared endpoints are defined in the shared modules and are already registered above
+            if view.__module__ != module.__name__:
+                continue
+            path = f"/{name}{rule.rule}"
+            app.add_url_rule(path, endpoint=f"{name}.{rule.endpoint}", view_func=view, methods=rule.methods)
+            routes.setdefault(name, []).append(path)
+
+    @app.route('/routes', methods=['GET'])
+    def list_routes():
+        return jsonify({
+            "routes": routes,
+            "legacy_ports": {str(port): name for port, name in legacy_ports.items() if name in scripts},
+            "worker_pool_size": facefusion_pool.pool_size
+        }), 200
+
+    return app
+
+
+scripts = load_scripts()
+app = create_app(scripts)
+_port_apps = {port: scripts[name].app for port, name in legacy_ports.items() if name in scripts}
+# The workers load while the servers start rather than on the first request
+facefusion_pool.prestart()
+
+
+# WSGI entry point: requests arriving on a legacy port go to that port's script, all others to the main app
+def application(environ, start_response):
+    port_app = _port_apps.get(int(environ.get("SERVER_PORT") or 0))
+    return (port_app or app)(environ, start_response)
+
+
+if __name__ == '__main__':
+    servers = [make_server(service_host, service_port, app, threaded=True)]
+    servers += [make_server(service_host, port, port_app, threaded=True) for port, port_app in _port_apps.items()]
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving on port {service_port} and legacy ports {sorted(_port_apps)}")
+    servers[0].serve_forever()
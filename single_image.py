@@ -0,0 +1,225 @@
+import hashlib
+import time
+import download_cache
+import face_registry
+import facefusion_pool
+import http_client
+import in_memory_pipeline
+import preflight
+import result_cache
+import s3_uploader
+import workspace
+
+# Single-image swap (one source face onto one target image) shared by the Flask views of
+# image-swap-api, new-api-v3 and new-api-v4 and by async_service. The swap is split into the
+# steps between its network waits: swap() runs them in order on the request thread, while
+# async_service awaits the downloads and uploads on its event loop and runs the other steps on
+# its executors. Both take the in-memory path (see in_memory_pipeline) when a warm worker is
+# available and fall back to files otherwise.
+
+
+class SwapError(Exception):
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+class SingleImageSwap:
+    def __init__(self, data, route, build_command, bucket_name, request_workspace):
+        self.data = data if isinstance(data, dict) else {}
+        self.route = route
+        self.build_command = build_command
+        self.bucket_name = bucket_name
+        self.source_url = self.data.get('source_url')
+        self.face_id = self.data.get('face_id')
+        self.target_url = self.data.get('target_url')
+        # Large targets can be swapped region by region at their native resolution
+        self.roi = self.data.get('roi', facefusion_pool.face_regions_by_default)
+        self.check_faces = self.data.get('preflight', True)
+        self.cache_route = route if self.data.get('cache', True) else None
+        # Per-request paths so concurrent requests don't overwrite each other's files
+        self.source_path = request_workspace.file("source.jpg")
+        self.target_path = request_workspace.file("target.jpg")
+        self.output_path = request_workspace.file("output.jpg")
+        self.command = build_command(self.source_path, self.target_path, self.output_path)
+        self.result_key = None
+        self.face_detection = None
+        self.timings = {}
+        self.lap_started = time.perf_counter()
+
+    # Function to record the seconds since the previous lap under a timing name
+    def lap(self, name=None):
+        now = time.perf_counter()
+        if name:
+            self.timings[name] = round(now - self.lap_started, 3)
+        self.lap_started = now
+
+    # Function to check the request's fields; returns (body, status code) when it can't be served
+    def invalid(self, check_gender=False):
+        if not (self.source_url or self.face_id) or not self.target_url:
+            return {"error": "Source URL (or face_id) and target URL are required"}, 400
+        if check_gender and self.data.get('gender', 'male') not in ['male', 'female']:
+            return {"error": "Invalid gender. Only 'male' or 'female' are accepted."}, 400
+        if self.face_id and not face_registry.get(self.face_id):
+            return {"error": "Unknown face_id"}, 404
+        return None
+
+    # Function to tell whether to swap in memory: requested, enabled and a warm worker pool is up
+    def in_memory(self):
+        return self.data.get('in_memory', True) and in_memory_pipeline.in_memory_enabled and facefusion_pool.get_pool() is not None
+
+    # Function to get the stored image of a face_id source, which is read instead of downloaded
+    def registered_source_path(self):
+        return face_registry.get(self.face_id)["image_path"] if self.face_id else None
+
+    # Function to check the downloaded inputs of an in-memory swap; returns (body, status code)
+    # when the request is answered without swapping
+    def check_bytes(self, source_bytes, target_bytes):
+        if source_bytes is None:
+            return {"error": "Failed to download source image"}, 500
+        if target_bytes is None:
+            return {"error": "Failed to download target image"}, 500
+        self.source_bytes = source_bytes
+        self.target_bytes = target_bytes
+        source_hash = hashlib.sha256(source_bytes).hexdigest()
+        # Sources registered earlier (by URL or face_id) skip detection here as well
+        self.source_faces = in_memory_pipeline.stored_source_faces(self.face_id, source_hash)
+        self.lap("download_seconds")
+
+        # Registered sources are judged by the faces FaceFusion found in them
+        rejected = preflight.rejection([(source_bytes if self.source_faces is None else len(self.source_faces), "source image", 1), (target_bytes, "target image", 1)], self.check_faces)
+        if rejected:
+            return rejected
+
+        # Identical requests (same inputs and options) share one run and its stored result
+        if self.cache_route:
+            self.result_key = result_cache.result_key(self.cache_route, [source_hash, hashlib.sha256(target_bytes).hexdigest()], self.command, roi=self.roi)
+        return None
+
+    # Function to swap the downloaded inputs on a warm worker. Raises facefusion_pool.WorkerError
+    # when the request should take the disk path instead.
+    def swap_bytes(self):
+        self.lap()
+        try:
+            self.output_bytes, self.face_detection = facefusion_pool.swap_in_memory(self.command, self.source_bytes, self.target_bytes, self.source_faces, self.roi)
+        except facefusion_pool.WorkerError:
+            raise
+        except Exception as e:
+            raise SwapError("Facefusion script failed", str(e))
+        self.lap("swap_seconds")
+
+    # Function to start uploading the in-memory output to S3 under its result key (a unique name
+    # when caching is off); returns a future resolving to its URL
+    def upload_bytes(self):
+        return s3_uploader.upload_bytes(self.output_bytes, self.bucket_name, ".jpg", result_cache.output_key(self.result_key), skip_existing=self.result_key is not None)
+
+    def in_memory_body(self, output_s3_url):
+        self.lap("upload_seconds")
+        return in_memory_pipeline.response_body(output_s3_url, self.face_detection, self.source_bytes, self.target_bytes, self.output_bytes, self.timings)
+
+    # Function to check the downloaded files of a disk swap; returns (body, status code) when the
+    # request is answered without swapping
+    def check_files(self, source_path, target_downloaded):
+        if not source_path:
+            return {"error": "Failed to download source image"}, 500
+        if not target_downloaded:
+            return {"error": "Failed to download target image"}, 500
+        self.source_path = source_path
+
+        # Inputs without the faces the swap needs are answered before they reach FaceFusion
+        rejected = preflight.rejection([(face_registry.preflight_input(self.face_id, source_path), "source image", 1), (self.target_path, "target image", 1)], self.check_faces)
+        if rejected:
+            return rejected
+
+        self.command = self.build_command(source_path, self.target_path, self.output_path)
+        # Identical requests (same inputs and options) share one run and its stored result
+        if self.cache_route:
+            self.result_key = result_cache.result_key(self.cache_route, result_cache.file_hashes(source_path, self.target_path), self.command, roi=self.roi)
+        return None
+
+    # Function to register a source downloaded by URL once it passed the preflight check, so the
+    # next request with the same image skips detection (the analysis runs in the background)
+    def register_source(self):
+        face_registry.register_source(self.face_id, self.source_path)
+
+    def run(self):
+        process = facefusion_pool.run_facefusion(self.command, faces=face_registry.seed_faces(self.command), roi=self.roi)
+        if process.returncode != 0:
+            raise SwapError("Facefusion script failed", process.stderr)
+        self.face_detection = process.face_detection
+
+    # Function to start uploading the output file to S3; returns a future resolving to its URL
+    def upload_file(self):
+        return s3_uploader.upload_file(self.output_path, self.bucket_name, ".jpg", key=result_cache.output_key(self.result_key), skip_existing=self.result_key is not None)
+
+    def body(self, output_s3_url):
+        return {"message": "Face swap completed successfully", "output_s3_url": output_s3_url, "face_detection": self.face_detection}
+
+
+# Function to turn an error raised by a swap step into (body, status code)
+def error_response(e):
+    if isinstance(e, SwapError):
+        return {"error": str(e), "details": e.details}, 500
+    return {"error": str(e)}, 500
+
+
+# Function to run a single-image swap on the calling thread; returns (body, status code)
+def swap(data, route, build_command, bucket_name, check_gender=False):
+    request_workspace = workspace.Workspace()
+    try:
+        job = SingleImageSwap(data, route, build_command, bucket_name, request_workspace)
+        invalid = job.invalid(check_gender)
+        if invalid:
+            return invalid
+
+        # Swap in memory when a warm worker is available, otherwise fall back to the files below
+        if job.in_memory():
+            answered = _swap_in_memory(job)
+            if answered:
+                return answered
+        return _swap_files(job)
+    except Exception as e:
+        return error_response(e)
+    finally:
+        request_workspace.cleanup()
+
+
+# Function to swap in memory; returns (body, status code), or None to take the disk path
+def _swap_in_memory(job):
+    job.lap()
+    source_path = job.registered_source_path()
+    downloads = http_client.gather({
+        "source": (in_memory_pipeline.read_file, source_path) if source_path else (http_client.fetch_bytes, job.source_url, in_memory_pipeline.max_image_bytes),
+        "target": (http_client.fetch_bytes, job.target_url, in_memory_pipeline.max_image_bytes)
+    })
+    answered = job.check_bytes(downloads["source"], downloads["target"])
+    if answered:
+        return answered
+
+    with result_cache.coalesce(job.result_key) as result:
+        if result.body:
+            return result.body, 200
+        try:
+            job.swap_bytes()
+        except facefusion_pool.WorkerError as e:
+            print(f"In-memory swap unavailable, using the disk path: {e}")
+            return None
+        return result.store(job.in_memory_body(job.upload_bytes().result())), 200
+
+
+def _swap_files(job):
+    # Download all inputs concurrently through the shared HTTP client
+    downloads = http_client.gather({
+        "source": (face_registry.resolve_source, job.source_url, job.face_id, job.source_path, download_cache.fetch),
+        "target": (download_cache.fetch, job.target_url, job.target_path)
+    })
+    answered = job.check_files(downloads["source"], downloads["target"])
+    if answered:
+        return answered
+    job.register_source()
+
+    with result_cache.coalesce(job.result_key) as result:
+        if result.body:
+            return result.body, 200
+        job.run()
+        return result.store(job.body(job.upload_file().result())), 200
@@ -0,0 +1,55 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# The service modules read their settings at import, so the tests point them at a scratch
+# checkout before anything imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("FACEFUSION_PATH", tempfile.mkdtemp(prefix="faceswap-tests-"))
+os.environ["AUTOTUNE_PROFILE"] = "0"
+os.environ["FACEFUSION_POOL_SIZE"] = "0"
+
+
+# Fixture serving files from a dict (path -> bytes) with ETags, answering 304 to a matching
+# If-None-Match; yields (base URL, files, request log)
+@pytest.fixture
+def http_files():
+    files = {}
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append((self.path, self.headers.get("If-None-Match")))
+            body = files.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}", files, requests_seen
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import time
+import pytest
+import download_cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(download_cache, "cache_path", str(tmp_path / "cache"))
+    monkeypatch.setattr(download_cache, "cache_max_bytes", 10 ** 9)
+    monkeypatch.setattr(download_cache, "_db", None)
+    monkeypatch.setattr(download_cache, "_stats", {name: 0 for name in download_cache._stats})
+
+
+def _blobs():
+    return download_cache._connect().execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+
+def _pins():
+    return download_cache._connect().execute("SELECT COALESCE(SUM(pins), 0) FROM blobs").fetchone()[0]
+
+
+def test_revalidated_download_is_a_cache_hit(http_files, tmp_path):
+    url, files, requests_seen = http_files
+    files["/face.jpg"] = b"x" * 3000
+    first = download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "first.jpg"))
+    second = download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "second.jpg"))
+
+    assert first == second
+    assert (tmp_path / "second.jpg").read_bytes() == files["/face.jpg"]
+    assert requests_seen[1][1] is not None
+    assert download_cache._stats["hits"] == 1
+    assert download_cache._stats["misses"] == 1
+
+
+def test_a_file_larger_than_the_budget_is_placed_before_it_is_evicted(monkeypatch, http_files, tmp_path):
+    monkeypatch.setattr(download_cache, "cache_max_bytes", 1000)
+    url, files, _ = http_files
+    files["/large.jpg"] = os.urandom(5000)
+
+    assert download_cache.fetch(f"{url}/large.jpg", str(tmp_path / "large.jpg"))
+    assert (tmp_path / "large.jpg").read_bytes() == files["/large.jpg"]
+    # Once placed, the blob no longer fits the budget and nothing keeps it
+    assert _blobs() == 0
+    assert _pins() == 0
+    assert download_cache._stats["evictions"] == 1
+
+
+def test_eviction_skips_pinned_blobs(monkeypatch, http_files, tmp_path):
+    url, files, _ = http_files
+    files["/old.jpg"] = os.urandom(600)
+    files["/new.jpg"] = os.urandom(600)
+    old_hash = download_cache.fetch(f"{url}/old.jpg", str(tmp_path / "old.jpg"))
+
+    monkeypatch.setattr(download_cache, "cache_max_bytes", 1000)
+    with download_cache._transaction() as db:
+        download_cache._pin(db, old_hash)
+    new_hash = download_cache.fetch(f"{url}/new.jpg", str(tmp_path / "new.jpg"))
+    # The least recently used blob is pinned, so the new one goes instead, after it was placed
+    assert os.path.exists(download_cache._blob_path(old_hash))
+    assert not os.path.exists(download_cache._blob_path(new_hash))
+    assert (tmp_path / "new.jpg").read_bytes() == files["/new.jpg"]
+
+    download_cache._release(old_hash)
+    assert _pins() == 0
+
+
+def test_pins_of_another_process_are_respected_until_their_lease_ends(monkeypatch, http_files, tmp_path):
+    url, files, _ = http_files
+    files["/old.jpg"] = os.urandom(600)
+    files["/new.jpg"] = os.urandom(600)
+    old_hash = download_cache.fetch(f"{url}/old.jpg", str(tmp_path / "old.jpg"))
+    # Another process sharing the cache pins the blob through its own connection
+    other = sqlite3.connect(os.path.join(download_cache.cache_path, "index.sqlite3"))
+    other.execute("UPDATE blobs SET pins = pins + 1, pinned_until = ? WHERE hash = ?", (time.time() + 60, old_hash))
+    other.commit()
+
+    monkeypatch.setattr(download_cache, "cache_max_bytes", 1000)
+    download_cache.fetch(f"{url}/new.jpg", str(tmp_path / "new.jpg"))
+    assert os.path.exists(download_cache._blob_path(old_hash))
+
+    # A process that died holding the pin only keeps the blob until the lease ends
+    other.execute("UPDATE blobs SET pinned_until = ? WHERE hash = ?", (time.time() - 1, old_hash))
+    other.commit()
+    other.close()
+    download_cache.fetch(f"{url}/new.jpg", str(tmp_path / "new.jpg"))
+    assert not os.path.exists(download_cache._blob_path(old_hash))
+
+
+def test_placed_files_are_read_only_and_modified_blobs_are_dropped(http_files, tmp_path):
+    url, files, requests_seen = http_files
+    files["/face.jpg"] = os.urandom(2000)
+    blob_hash = download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "first.jpg"))
+    assert not os.stat(tmp_path / "first.jpg").st_mode & 0o222
+
+    # A writer that ignores the permissions (e.g. root) changes the shared blob through its link
+    os.chmod(tmp_path / "first.jpg", 0o644)
+    with open(tmp_path / "first.jpg", "r+b") as file:
+        file.write(b"changed")
+    os.utime(tmp_path / "first.jpg", ns=(0, 0))
+
+    assert download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "second.jpg")) == blob_hash
+    assert (tmp_path / "second.jpg").read_bytes() == files["/face.jpg"]
+    # The changed blob was not trusted, so the file was downloaded in full again
+    assert requests_seen[-1][1] is None
+
+
+def test_a_missing_blob_is_downloaded_again(http_files, tmp_path):
+    url, files, _ = http_files
+    files["/face.jpg"] = os.urandom(2000)
+    blob_hash = download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "first.jpg"))
+    os.remove(download_cache._blob_path(blob_hash))
+
+    assert download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "second.jpg")) == blob_hash
+    assert (tmp_path / "second.jpg").read_bytes() == files["/face.jpg"]
+
+
+def test_a_blob_lost_after_revalidation_is_downloaded_again(monkeypatch, http_files, tmp_path):
+    url, files, requests_seen = http_files
+    files["/face.jpg"] = os.urandom(2000)
+    blob_hash = download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "first.jpg"))
+
+    # The blob disappears between the lookup and the 304
+    lookup = download_cache._lookup
+
+    def lookup_then_lose(fetched_url):
+        row = lookup(fetched_url)
+        os.remove(download_cache._blob_path(blob_hash))
+        return row
+    monkeypatch.setattr(download_cache, "_lookup", lookup_then_lose)
+
+    assert download_cache.fetch(f"{url}/face.jpg", str(tmp_path / "second.jpg")) == blob_hash
+    assert (tmp_path / "second.jpg").read_bytes() == files["/face.jpg"]
+    assert [etag is not None for _, etag in requests_seen] == [False, True, False]
+    assert _pins() == 0
+
+
+def test_failed_downloads_return_none(http_files, tmp_path):
+    url, _, _ = http_files
+    assert download_cache.fetch(f"{url}/missing.jpg", str(tmp_path / "missing.jpg")) is None
+    assert download_cache._stats["errors"] == 1
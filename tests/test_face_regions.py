@@ -0,0 +1,49 @@
+from collections import namedtuple
+import numpy as np
+import facefusion_engine
+
+Face = namedtuple("Face", ["bounding_box"])
+
+
+def test_regions_are_padded_and_clipped_to_the_frame():
+    faces = [Face((100, 100, 200, 150)), Face((1960, 960, 2000, 1000))]
+    regions = facefusion_engine._face_regions(faces, (1000, 2000, 3), 0.5)
+    # Padding is half the larger side of the face on every side
+    assert sorted(regions) == [(50, 50, 250, 200), (1940, 940, 2000, 1000)]
+
+
+def test_overlapping_regions_are_merged():
+    faces = [Face((100, 100, 200, 200)), Face((180, 100, 280, 200)), Face((900, 900, 950, 950))]
+    regions = facefusion_engine._face_regions(faces, (1000, 1000, 3), 0.0)
+    assert sorted(regions) == [(100, 100, 280, 200), (900, 900, 950, 950)]
+
+
+def test_regions_merged_through_a_chain_become_one():
+    # a and c only overlap once b has been merged into a
+    faces = [Face((0, 0, 100, 100)), Face((90, 0, 190, 100)), Face((180, 0, 280, 100))]
+    assert facefusion_engine._face_regions(faces, (500, 500, 3), 0.0) == [(0, 0, 280, 100)]
+
+
+def test_weights_feather_only_the_edges_inside_the_frame():
+    shape = (1000, 1000, 3)
+    weights = facefusion_engine._region_weights((100, 100, 300, 300), shape, 0.1)
+    assert weights.shape == (200, 200, 1)
+    assert weights.min() > 0 and weights.max() == 1
+    assert weights[100, 100, 0] == 1
+    assert weights[0, 100, 0] < 1 and weights[-1, 100, 0] < 1
+    assert weights[100, 0, 0] < 1 and weights[100, -1, 0] < 1
+
+    # A region touching the frame's corner has no seam there, so no feathering either
+    corner = facefusion_engine._region_weights((0, 0, 200, 200), shape, 0.1)
+    assert corner[0, 100, 0] == 1 and corner[100, 0, 0] == 1
+    assert corner[-1, 100, 0] < 1 and corner[100, -1, 0] < 1
+
+
+def test_processing_blends_only_the_face_regions():
+    frame = np.full((400, 400, 3), 10, np.uint8)
+    output = facefusion_engine._process_regions(frame, [Face((100, 100, 200, 200))], {"padding": 0.2, "feather": 0.1}, lambda region_frame, region: np.full_like(region_frame, 250))
+    assert output[150, 150, 0] == 250
+    assert output[10, 10, 0] == 10
+    assert output[300, 300, 0] == 10
+    # The feathered edge lands between the two values
+    assert 10 < output[80, 150, 0] < 250
@@ -0,0 +1,49 @@
+import threading
+import time
+import numpy as np
+import face_registry
+import facefusion_pool
+
+
+def _face():
+    return {
+        "bounding_box": [10, 10, 50, 50],
+        "landmark_5": np.zeros((5, 2)),
+        "landmark_5_68": np.zeros((5, 2)),
+        "landmark_68": np.zeros((68, 2)),
+        "landmark_68_5": np.zeros((68, 2)),
+        "scores": [0.9, 0.9],
+        "embedding": np.ones(512),
+        "normed_embedding": np.ones(512) / np.sqrt(512),
+        "angle": 0,
+        "gender": "male",
+        "age": [25, 32],
+        "race": "white"
+    }
+
+
+def test_sources_are_analysed_after_the_request_returns(monkeypatch, tmp_path):
+    analysed = threading.Event()
+    release = threading.Event()
+
+    def analyse_image(image_path, args, job_type="analysis"):
+        analysed.set()
+        release.wait(5)
+        return [_face()]
+    monkeypatch.setattr(facefusion_pool, "analyse_image", analyse_image)
+    source_path = tmp_path / "source.jpg"
+    source_path.write_bytes(b"source image bytes")
+    face_id = face_registry.content_hash(str(source_path))
+
+    face_registry.register_source(None, str(source_path))
+    # The request may delete its workspace right away; the registry kept its own copy
+    source_path.unlink()
+    assert analysed.wait(5)
+    assert face_registry.get(face_id) is None
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while face_registry.get(face_id) is None:
+        assert time.monotonic() < deadline, "source was never registered"
+        time.sleep(0.01)
+    assert face_registry.get(face_id)["image_path"].endswith(face_id + ".jpg")
@@ -0,0 +1,79 @@
+import os
+import cv2
+import numpy as np
+import pytest
+
+stub_package_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "stub_package")
+
+
+# Fixture importing the engine against the stub FaceFusion package
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.syspath_prepend(stub_package_path)
+    monkeypatch.setenv("STUB_IMAGE_LATENCY", "0")
+    import facefusion_engine
+    from facefusion import state_manager
+    from facefusion.face_store import clear_reference_faces
+    state_manager._items.clear()
+    clear_reference_faces()
+    return facefusion_engine
+
+
+# A large woman on the left and a small man on the right
+def _faces():
+    from facefusion.face_analyser import _face
+    large = _face(np.array([40, 40, 240, 240], dtype=np.float32), 0.9, np.zeros((5, 2), np.float32), 0)._replace(gender="female", age=range(30, 35))
+    small = _face(np.array([400, 100, 460, 160], dtype=np.float32), 0.9, np.zeros((5, 2), np.float32), 0)._replace(gender="male", age=range(60, 65))
+    return large, small
+
+
+# Function to apply a command's options on a clean state, as a fresh CLI run would
+def _apply(engine, *options):
+    from facefusion import state_manager
+    state_manager._items.clear()
+    engine.apply_program_args(["headless-run", "--processors", "face_swapper", "--face-selector-order", "large-small"] + list(options))
+
+
+def test_reference_face_is_picked_from_sorted_and_filtered_faces(engine, monkeypatch):
+    from facefusion.face_store import get_reference_faces
+    large, small = _faces()
+    # Detector order deliberately puts the small face first
+    monkeypatch.setattr(engine, "_get_many_faces", lambda frames: [small, large])
+    frame = np.zeros((480, 640, 3), np.uint8)
+
+    _apply(engine, "--face-selector-mode", "reference")
+    engine._swap_frame(large, frame)
+    assert get_reference_faces()["origin"] == [large]
+
+    _apply(engine, "--face-selector-mode", "reference", "--face-selector-gender", "male")
+    engine._swap_frame(large, frame)
+    assert get_reference_faces()["origin"] == [small]
+
+
+def test_selected_faces_follow_order_gender_and_age(engine):
+    large, small = _faces()
+
+    _apply(engine, "--face-selector-mode", "one")
+    assert engine._select_faces([small, large], None) == [large]
+
+    _apply(engine, "--face-selector-mode", "one", "--face-selector-gender", "male")
+    assert engine._select_faces([small, large], None) == [small]
+
+    _apply(engine, "--face-selector-mode", "many", "--face-selector-age-start", "20", "--face-selector-age-end", "40")
+    assert engine._select_faces([small, large], None) == [large]
+
+
+def test_swap_by_position_applies_the_command_filters_before_the_order(engine, monkeypatch, tmp_path):
+    from facefusion.processors.modules import face_swapper
+    large, small = _faces()
+    monkeypatch.setattr(engine, "_install_face_hooks", lambda: None)
+    monkeypatch.setattr(engine, "_get_many_faces", lambda frames: [small, large])
+    swapped = []
+    monkeypatch.setattr(face_swapper, "swap_face", lambda source_face, target_face, vision_frame: swapped.append(target_face) or vision_frame)
+    image_path = str(tmp_path / "target.jpg")
+    cv2.imwrite(image_path, np.zeros((480, 640, 3), np.uint8))
+
+    args = ["headless-run", "--processors", "face_swapper", "--face-selector-mode", "one", "--face-selector-gender", "male"]
+    engine.swap_by_position(args, image_path, str(tmp_path / "output.jpg"), [(image_path, "large-small"), (image_path, "small-large")])
+    # The woman is filtered out, so the first source gets the man and the second source nothing
+    assert swapped == [small]
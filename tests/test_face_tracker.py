@@ -0,0 +1,65 @@
+from collections import namedtuple
+import cv2
+import numpy as np
+import face_tracker
+
+Face = namedtuple("Face", ["bounding_box", "landmark_set"])
+
+
+def _frame(offset_x):
+    frame = np.zeros((240, 320, 3), np.uint8)
+    rng = np.random.default_rng(7)
+    texture = rng.integers(0, 255, (80, 80, 3), dtype=np.uint8)
+    frame[80:160, 100 + offset_x:180 + offset_x] = cv2.GaussianBlur(texture, (5, 5), 0)
+    return frame
+
+
+def _face(landmark_5=True):
+    grid = np.stack(np.meshgrid(np.linspace(110, 170, 17), np.linspace(90, 150, 4)), axis=-1).reshape(-1, 2)[:68]
+    return Face(
+        bounding_box=np.array([100, 80, 180, 160], dtype=np.float32),
+        landmark_set={"5": grid[:5] if landmark_5 else None, "5/68": None, "68": grid.astype(np.float32), "68/5": None}
+    )
+
+
+def test_move_face_keeps_missing_landmark_sets():
+    matrix = np.array([[1, 0, 5], [0, 1, -2]], dtype=np.float32)
+    face = _face(landmark_5=False)
+    good = np.ones(68, bool)
+    moved = face_tracker._move_face(face, matrix, face.landmark_set["68"] + [5, -2], good)
+
+    assert moved.landmark_set["5"] is None and moved.landmark_set["68/5"] is None
+    assert np.allclose(moved.bounding_box, [105, 78, 185, 158])
+    assert np.allclose(moved.landmark_set["68"], face.landmark_set["68"] + [5, -2])
+
+
+def test_tracker_follows_a_face_between_detections():
+    detections = []
+
+    def detect(frames):
+        detections.append(len(frames))
+        return [_face()]
+
+    tracker = face_tracker.FaceTracker(detect_every=10, min_confidence=0.5)
+    tracker.faces_for(_frame(0), detect)
+    faces = tracker.faces_for(_frame(3), detect)
+
+    assert detections == [1]
+    assert abs(float(faces[0].bounding_box[0]) - 103) < 1.5
+    assert faces[0].landmark_set["5/68"] is None
+    assert tracker.take_stats() == {"detected_frames": 1, "first_frame": 1, "tracked_frames": 1}
+
+
+def test_faces_without_68_landmarks_are_detected_again():
+    face = _face()._replace(landmark_set={"5": None, "68": None})
+    detections = []
+
+    def detect(frames):
+        detections.append(len(frames))
+        return [face]
+
+    tracker = face_tracker.FaceTracker(detect_every=10)
+    tracker.faces_for(_frame(0), detect)
+    tracker.faces_for(_frame(3), detect)
+    assert detections == [1, 1]
+    assert tracker.take_stats()["low_confidence"] == 1
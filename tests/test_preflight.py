@@ -0,0 +1,30 @@
+import cv2
+import numpy as np
+import facefusion_pool
+import preflight
+
+
+def _image_bytes():
+    return cv2.imencode(".jpg", np.full((120, 160, 3), 128, np.uint8))[1].tobytes()
+
+
+def test_faces_are_counted_on_a_worker_without_yunet(monkeypatch):
+    counted = []
+    monkeypatch.setattr(preflight, "detector_model", "")
+    monkeypatch.setattr(facefusion_pool, "count_faces", lambda frame, args, wanted: counted.append(wanted) or 1)
+
+    assert preflight.rejection([(_image_bytes(), "target image", 2)]) == ({
+        "error": "The target image needs at least 2 faces, found 1",
+        "details": {"input": "target image", "faces_found": 1, "faces_required": 2}
+    }, 422)
+    assert counted == [2]
+
+
+def test_unchecked_inputs_pass_and_are_logged(monkeypatch, capsys):
+    monkeypatch.setattr(preflight, "detector_model", "")
+    monkeypatch.setattr(facefusion_pool, "count_faces", lambda frame, args, wanted: None)
+
+    assert preflight.rejection([(_image_bytes(), "source image", 1)]) is None
+    assert "Preflight did not count the faces in the source image" in capsys.readouterr().out
+    # Registered sources are judged by their stored face count without any detector
+    assert preflight.rejection([(0, "source image", 1)])[1] == 422
@@ -0,0 +1,49 @@
+import progress
+
+
+def test_parse_reads_tqdm_bars():
+    line = "processing:  45%|####      | 120/266 [00:10<00:12, 11.52frame/s]"
+    assert progress.parse(line) == {"percent": 45, "done": 120, "total": 266, "stage": "processing"}
+
+
+def test_parse_reads_bars_without_a_stage_and_caps_the_percent():
+    assert progress.parse("100%|##########| 10/10") == {"percent": 100, "done": 10, "total": 10}
+    assert progress.parse("extracting: 250%|#| 5/2")["percent"] == 100
+
+
+def test_parse_reads_step_messages():
+    assert progress.parse("[FACEFUSION.CORE] Processing step 1 of 2") == {"step": 1, "steps": 2}
+
+
+def test_parse_ignores_other_lines():
+    assert progress.parse("[FACEFUSION.CORE] Processing to image succeed in 1.2 seconds") is None
+    assert progress.parse("") is None
+
+
+def test_output_tail_keeps_the_latest_bar_and_the_other_lines():
+    reported = []
+    output = progress.OutputTail(reported.append)
+    output.write("starting\n")
+    output.write("processing:  10%|#         | 1/10\rprocessing:  50%|#####     | 5/10")
+    output.write("\rprocessing: 100%|##########| 10/10\nfinished\n")
+    output.close()
+
+    assert output.tail() == "starting\nfinished\nprocessing: 100%|##########| 10/10"
+    assert reported[-1] == {"percent": 100, "done": 10, "total": 10, "stage": "processing"}
+
+
+def test_output_tail_is_bounded(monkeypatch):
+    monkeypatch.setattr(progress, "tail_lines", 3)
+    output = progress.OutputTail()
+    output.write("".join(f"line {index}\n" for index in range(10)))
+    assert output.tail() == "line 7\nline 8\nline 9"
+
+
+def test_reporter_is_a_no_op_without_a_listener():
+    events = []
+    assert not progress.listening_now()
+    progress.reporter("image")({"percent": 1})
+    with progress.listening(lambda run_id, label, fields: events.append((label, fields))):
+        assert progress.listening_now()
+        progress.reporter("video")({"percent": 2})
+    assert events == [("video", {"percent": 2})]
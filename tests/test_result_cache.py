@@ -0,0 +1,105 @@
+import threading
+import pytest
+import result_cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(result_cache, "cache_path", str(tmp_path))
+    monkeypatch.setattr(result_cache, "cache_enabled", True)
+    monkeypatch.setattr(result_cache, "_db", None)
+    monkeypatch.setattr(result_cache, "_inflight", {})
+    monkeypatch.setattr(result_cache, "_stats", {"hits": 0, "coalesced": 0, "misses": 0, "stored": 0})
+
+
+# Function to enter coalesce(key) on a thread; the returned dict gets the result body once the
+# thread is past the wait
+def _follow(key):
+    seen = {}
+
+    def run():
+        with result_cache.coalesce(key) as result:
+            seen["body"] = result.body
+            if result.body is None:
+                seen["led"] = True
+                result.store({"output": "follower"})
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, seen
+
+
+# In-flight marker that tells when a follower started waiting on it
+class WatchedEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.waited = threading.Event()
+
+    def wait(self, timeout=None):
+        self.waited.set()
+        return super().wait(timeout)
+
+
+def _watch(key):
+    event = result_cache._inflight[key] = WatchedEvent()
+    return event
+
+
+def test_follower_gets_the_leaders_result():
+    key = result_cache.result_key("/swap", ["a", "b"], ["python3", "facefusion.py", "headless-run"])
+    with result_cache.coalesce(key) as result:
+        assert result.body is None
+        event = _watch(key)
+        thread, seen = _follow(key)
+        assert event.waited.wait(5)
+        assert "body" not in seen
+        result.store({"output": "leader"})
+    thread.join(5)
+
+    assert seen["body"] == {"output": "leader", "cached": True}
+    assert "led" not in seen
+    assert result_cache._stats["coalesced"] == 1
+    assert result_cache._inflight == {}
+
+
+def test_follower_runs_itself_when_the_leader_fails():
+    key = result_cache.result_key("/swap", ["a", "b"], ["python3", "facefusion.py", "headless-run"])
+    with pytest.raises(RuntimeError):
+        with result_cache.coalesce(key) as result:
+            event = _watch(key)
+            thread, seen = _follow(key)
+            assert event.waited.wait(5)
+            raise RuntimeError("swap failed")
+    thread.join(5)
+
+    assert seen["body"] is None
+    assert seen["led"]
+    assert result_cache._stats["misses"] == 2
+    assert result_cache._inflight == {}
+    # The follower's own result is what the next request gets
+    with result_cache.coalesce(key) as result:
+        assert result.body == {"output": "follower", "cached": True}
+
+
+def test_stored_results_are_hits():
+    key = result_cache.result_key("/swap", ["a"], ["python3", "facefusion.py", "headless-run"])
+    with result_cache.coalesce(key) as result:
+        result.store({"output": "first"})
+    with result_cache.coalesce(key) as result:
+        assert result.body == {"output": "first", "cached": True}
+    assert result_cache._stats["hits"] == 1
+
+
+def test_no_key_means_no_coalescing():
+    with result_cache.coalesce(None) as result:
+        assert result.store({"output": "x"}) == {"output": "x"}
+    assert result_cache._stats == {"hits": 0, "coalesced": 0, "misses": 0, "stored": 0}
+
+
+def test_result_key_ignores_file_paths_but_not_options():
+    command = ["python3", "facefusion.py", "headless-run", "--source-paths", "/a/source.jpg", "--target-path", "/a/target.jpg", "--face-detector-score", "0.5"]
+    moved = ["python3", "facefusion.py", "headless-run", "--source-paths", "/b/source.jpg", "--target-path", "/b/target.jpg", "--face-detector-score", "0.5"]
+    changed = moved[:-1] + ["0.6"]
+    assert result_cache.result_key("/swap", ["a"], command) == result_cache.result_key("/swap", ["a"], moved)
+    assert result_cache.result_key("/swap", ["a"], command) != result_cache.result_key("/swap", ["a"], changed)
+    assert result_cache.result_key("/swap", ["a"], command) != result_cache.result_key("/swap", ["a"], command, roi=True)
+    assert result_cache.result_key("/swap", ["a", None], command) is None
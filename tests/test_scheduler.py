@@ -0,0 +1,180 @@
+import threading
+import time
+from flask import Flask
+import pytest
+import scheduler
+
+
+@pytest.fixture
+def fresh_scheduler(monkeypatch):
+    monkeypatch.setattr(scheduler, "_scheduler", scheduler.Scheduler(4))
+    return scheduler._scheduler
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_queued_jobs_start_by_job_type_priority(fresh_scheduler):
+    blocker = fresh_scheduler.acquire("video", 4)
+    started = []
+
+    def run(job_type):
+        with scheduler.slot(job_type, 4):
+            started.append(job_type)
+
+    threads = []
+    for job_type in ("video", "image", "analysis"):
+        thread = threading.Thread(target=run, args=(job_type,))
+        thread.start()
+        threads.append(thread)
+        _wait_until(lambda: len(fresh_scheduler.waiting) == len(threads))
+
+    fresh_scheduler.release(blocker)
+    for thread in threads:
+        thread.join(5)
+    assert started == ["analysis", "image", "video"]
+
+
+def test_indexing_runs_last_and_one_at_a_time(fresh_scheduler):
+    indexing = fresh_scheduler.acquire("indexing", 1)
+    started = []
+
+    def run(job_type):
+        with scheduler.slot(job_type, 1):
+            started.append(job_type)
+
+    second_indexing = threading.Thread(target=run, args=("indexing",))
+    second_indexing.start()
+    _wait_until(lambda: len(fresh_scheduler.waiting) == 1)
+    # Cores are left, but a second indexing run waits while an image run goes ahead
+    run("image")
+    assert started == ["image"]
+
+    fresh_scheduler.release(indexing)
+    second_indexing.join(5)
+    assert started == ["image", "indexing"]
+
+
+def test_jobs_that_fit_the_core_budget_run_together(fresh_scheduler):
+    first = fresh_scheduler.acquire("image", 2)
+    second = fresh_scheduler.acquire("image", 2)
+    assert fresh_scheduler.stats()["cores_in_use"] == 4
+    fresh_scheduler.release(first)
+    fresh_scheduler.release(second)
+
+
+def test_a_job_asking_for_more_cores_than_the_budget_runs_alone(fresh_scheduler):
+    job = fresh_scheduler.acquire("video", 64)
+    assert job.cores == 4
+    fresh_scheduler.release(job)
+
+
+def test_pooled_jobs_wait_for_a_worker_even_with_cores_left(fresh_scheduler):
+    scheduler.limit_workers(1)
+    first = fresh_scheduler.acquire("image", 1, pooled=True)
+    started = threading.Event()
+
+    def run():
+        with scheduler.slot("image", 1, pooled=True):
+            started.set()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    _wait_until(lambda: len(fresh_scheduler.waiting) == 1)
+    # Runs outside the pool only need cores
+    fresh_scheduler.release(fresh_scheduler.acquire("image", 1))
+    assert not started.is_set()
+
+    fresh_scheduler.release(first)
+    thread.join(5)
+    assert started.is_set()
+
+
+def test_a_pool_without_an_idle_worker_raises_after_the_wait():
+    import facefusion_pool
+    pool = facefusion_pool.FaceFusionPool(0, 1)
+    try:
+        with pytest.raises(facefusion_pool.WorkerError):
+            pool.call({"op": "ping"}, wait=0.05)
+    finally:
+        pool.close()
+
+
+def test_a_pool_is_not_ready_until_a_worker_started():
+    import facefusion_pool
+    pool = facefusion_pool.FaceFusionPool(0, 1)
+    try:
+        assert not pool.wait_ready(0.05)
+        # A worker that failed to start leaves None behind
+        pool.idle.put(None)
+        assert not pool.wait_ready(0.05)
+    finally:
+        pool.close()
+
+
+def test_waiting_jobs_move_up_one_class_per_aging_period(monkeypatch, fresh_scheduler):
+    monkeypatch.setattr(scheduler, "priority_aging_seconds", 10.0)
+    video = scheduler._Job("video", 4, 1)
+    image = scheduler._Job("image", 4, 2)
+    now = time.monotonic()
+    assert video.priority(now) > image.priority(now)
+
+    # A video that waited two periods goes ahead of an image that just arrived
+    video.enqueued_at = now - 20.0
+    assert video.priority(now)[0] == 0
+    fresh_scheduler.waiting = [image, video]
+    assert fresh_scheduler._can_start(video, now)
+    assert not fresh_scheduler._can_start(image, now)
+
+
+def test_check_refuses_past_the_queue_depth(monkeypatch, fresh_scheduler):
+    monkeypatch.setattr(scheduler, "max_queue_depth", 0)
+    with pytest.raises(scheduler.SchedulerBusy) as error:
+        scheduler.check("image")
+    assert error.value.retry_after >= 1
+    assert fresh_scheduler.counts["image"]["rejected"] == 1
+
+
+def test_check_refuses_past_the_predicted_wait(monkeypatch, fresh_scheduler):
+    monkeypatch.setattr(scheduler, "max_wait_seconds", 5.0)
+    fresh_scheduler.run_seconds["video"] = 100.0
+    job = fresh_scheduler.acquire("video", 4)
+    try:
+        # 100 s of 4 cores left on a 4-core budget
+        assert fresh_scheduler.predicted_wait("image") == pytest.approx(100.0, abs=1.0)
+        with pytest.raises(scheduler.SchedulerBusy) as error:
+            scheduler.check("image")
+        assert 99 <= error.value.retry_after <= 101
+    finally:
+        fresh_scheduler.release(job)
+    scheduler.check("image")
+
+
+def test_admit_answers_429_with_retry_after(monkeypatch, fresh_scheduler):
+    monkeypatch.setattr(scheduler, "max_queue_depth", 0)
+    app = Flask(__name__)
+    calls = []
+
+    @app.route('/swap', methods=['POST'])
+    @scheduler.admit("image")
+    def swap():
+        calls.append(True)
+        return "ok", 200
+
+    response = app.test_client().post('/swap')
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.get_json()["retry_after"] == int(response.headers["Retry-After"])
+    assert calls == []
+
+
+def test_command_job_type_and_cores():
+    command = ["--target-path", "/tmp/clip.MP4", "--execution-thread-count", "2"]
+    assert scheduler.command_job_type(command) == "video"
+    assert scheduler.command_cores(command) == 2
+    assert scheduler.command_job_type(["--target-path", "/tmp/photo.jpg"]) == "image"
+    assert scheduler.command_cores(["--execution-thread-count", "x"]) == scheduler.default_thread_count
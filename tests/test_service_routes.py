@@ -0,0 +1,11 @@
+import service
+import single_image
+
+
+def test_prefixed_and_legacy_routes_share_result_keys(monkeypatch):
+    routes = []
+    monkeypatch.setattr(single_image, "swap", lambda data, route, *args, **kwargs: (routes.append(route) or {"message": "ok"}, 200))
+
+    assert service.app.test_client().post("/new-api-v4/single-image-faceswap", json={}).status_code == 200
+    assert service.scripts["new-api-v4"].app.test_client().post("/single-image-faceswap", json={}).status_code == 200
+    assert routes == ["new-api-v4", "new-api-v4"]
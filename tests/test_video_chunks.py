@@ -0,0 +1,23 @@
+import subprocess
+import facefusion_pool
+import video_chunks
+
+
+def test_swapped_segments_are_renamed_only_in_the_file_name(monkeypatch):
+    commands = []
+
+    def run_facefusion(command, faces=None, tracking=False, roi=False):
+        commands.append(command)
+        process = subprocess.CompletedProcess(command, 0, "", "")
+        process.face_detection = None
+        return process
+    monkeypatch.setattr(facefusion_pool, "run_facefusion", run_facefusion)
+
+    segment_path = "/work/segment-cache/segments/segment-ab12-0003.mp4"
+    command = ["python3", "facefusion.py", "headless-run", "--target-path", "target.mp4", "--output-path", "output.mp4"]
+    output_path, _, timing = video_chunks._swap_segment(3, command, {}, False, segment_path, 1.0, 3.5)
+
+    assert output_path == "/work/segment-cache/segments/swapped-ab12-0003.mp4"
+    assert commands[0][commands[0].index("--target-path") + 1] == segment_path
+    assert commands[0][commands[0].index("--output-path") + 1] == output_path
+    assert timing["duration_seconds"] == 2.5
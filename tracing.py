@@ -0,0 +1,475 @@
+from flask import g, jsonify, request
+import contextlib
+import contextvars
+import hmac
+import ipaddress
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+import requests
+import profiler
+
+# Request tracing and on-demand profiling. Every request (and every background job) becomes a
+# trace of spans: downloads, FaceFusion runs with their scheduler wait, S3 uploads and the
+# per-target swaps of v6. Spans follow the request onto worker threads through
+# contextvars.copy_context(). Finished spans are exported by a background thread, as JSON lines
+# to TRACE_FILE and/or in the OTLP/HTTP JSON format to a collector, e.g.
+#
+#   TRACE_FILE=/var/log/faceswap/traces.jsonl
+#   TRACE_COLLECTOR_URL=http://localhost:4318/v1/traces
+#
+# Tracing is off when neither is set. An incoming W3C traceparent header continues the
+# caller's trace, and responses carry the trace id in X-Trace-Id.
+#
+# Profiling is armed through the admin endpoint for the next request to a path:
+#
+#   curl -X POST localhost:8000/admin/profile -d '{"path": "/v6/five-images-faceswap"}' -H 'Content-Type: application/json'
+#
+# That request is traced even when tracing is off. The threads working on it in the API are
+# sampled (see profiler.py), and so is the FaceFusion worker or subprocess running its swaps.
+# The collapsed stacks are written to PROFILE_PATH and listed at GET /admin/profiles. The admin
+# endpoints only answer callers on this machine unless ADMIN_TOKEN is set; then they require it in
+# an X-Admin-Token header instead.
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+trace_file = os.getenv("TRACE_FILE", "")
+trace_collector_url = os.getenv("TRACE_COLLECTOR_URL", "")
+trace_sample_rate = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+trace_service_name = os.getenv("TRACE_SERVICE_NAME", "faceswap")
+trace_queue_size = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+trace_batch_size = 512
+profile_path = os.getenv("PROFILE_PATH", os.path.join(base_path, ".profiles"))
+profile_interval = float(os.getenv("PROFILE_INTERVAL", str(profiler.default_interval)))
+profiles_kept = int(os.getenv("PROFILES_KEPT", "20"))
+admin_token = os.getenv("ADMIN_TOKEN")
+exporting = bool(trace_file or trace_collector_url)
+
+_current = contextvars.ContextVar("trace_span", default=None)
+# Thread ident -> trace id of the span it is working in, for the profiler
+_thread_traces = {}
+_export_queue = queue.Queue(maxsize=trace_queue_size)
+_exporter = None
+_lock = threading.Lock()
+_stats = {"exported": 0, "dropped": 0, "export_errors": 0}
+_armed = None
+_profiles = {}
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, attributes, exported, profile=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.exported = exported
+        self.profile = profile
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        self.error = None
+        self.ended = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        if self.ended:
+            return
+        self.ended = True
+        self.duration = time.perf_counter() - self.started
+        if error is not None:
+            self.error = str(error)
+        if self.exported:
+            _export(self)
+
+
+# Stand-in for spans of requests that aren't traced; every call is a no-op
+class _NoSpan:
+    trace_id = None
+    profile = None
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+# Function to start a span under the current one without making it current, e.g. for work that
+# finishes on another thread (an S3 upload); the caller ends it
+def start_span(name, **attributes):
+    parent = _current.get()
+    if parent is None:
+        return _no_span
+    return Span(name, parent.trace_id, parent.span_id, attributes, parent.exported, parent.profile)
+
+
+def _activate(span, bind_thread):
+    token = _current.set(span)
+    ident = threading.get_ident()
+    previous = _thread_traces.get(ident)
+    if bind_thread:
+        _thread_traces[ident] = span.trace_id
+    return token, ident, previous
+
+
+def _deactivate(token, ident, previous, bind_thread):
+    _current.reset(token)
+    if bind_thread:
+        if previous is None:
+            _thread_traces.pop(ident, None)
+        else:
+            _thread_traces[ident] = previous
+
+
+# Context manager for a span covering a block of the current request; a no-op outside a trace.
+# Coroutines pass bind_thread=False: the event loop thread is shared by many requests.
+@contextlib.contextmanager
+def span(name, bind_thread=True, **attributes):
+    current = start_span(name, **attributes)
+    if current is _no_span:
+        yield current
+        return
+    state = _activate(current, bind_thread)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(e)
+        raise
+    finally:
+        _deactivate(*state, bind_thread)
+        current.end()
+
+
+# Function to add attributes to the current span, if any
+def annotate(**attributes):
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace_id if current else None
+
+
+# Function to check a trace context field: lowercase hex of the given length
+def _is_hex(value, length):
+    return len(value) == length and all(character in "0123456789abcdef" for character in value)
+
+
+# Function to read (trace id, parent span id, sampled) from a W3C traceparent header. Malformed
+# headers and all-zero ids are ignored as the spec requires; the trace id also names profile files.
+def _parse_traceparent(header):
+    parts = (header or "").strip().split("-")
+    if len(parts) != 4 or not _is_hex(parts[0], 2) or parts[0] == "ff" or not _is_hex(parts[3], 2):
+        return None, None, False
+    trace_id, parent_id = parts[1], parts[2]
+    if not _is_hex(trace_id, 32) or not _is_hex(parent_id, 16) or not trace_id.strip("0") or not parent_id.strip("0"):
+        return None, None, False
+    return trace_id, parent_id, bool(int(parts[3], 16) & 1)
+
+
+class _Trace:
+    def __init__(self, root, state, bind_thread):
+        self.root = root
+        self.state = state
+        self.bind_thread = bind_thread
+
+
+# Function to start the root span of a request or job and make it current; returns a handle for
+# finish_trace, or None when the request isn't traced
+def begin_trace(name, path, traceparent=None, bind_thread=True, profiled=True, **attributes):
+    trace_id, parent_id, caller_sampled = _parse_traceparent(traceparent)
+    profile = _take_armed(path) if profiled else None
+    exported = exporting and (caller_sampled or profile is not None or random.random() < trace_sample_rate)
+    if not exported and profile is None:
+        return None
+    root = Span(name, trace_id or uuid.uuid4().hex, parent_id, dict(attributes, path=path), exported, profile)
+    state = _activate(root, bind_thread)
+    if profile:
+        profile.start(root.trace_id)
+    return _Trace(root, state, bind_thread)
+
+
+def finish_trace(trace, error=None, **attributes):
+    if trace is None:
+        return
+    trace.root.set(**attributes)
+    _deactivate(*trace.state, trace.bind_thread)
+    trace.root.end(error)
+    if trace.root.profile:
+        trace.root.profile.finish(trace.root)
+
+
+# Context manager tracing a block as its own trace, e.g. a background job
+@contextlib.contextmanager
+def trace(name, path, traceparent=None, **attributes):
+    handle = begin_trace(name, path, traceparent, **attributes)
+    try:
+        yield handle.root if handle else _no_span
+    except BaseException as e:
+        finish_trace(handle, e)
+        handle = None
+        raise
+    finally:
+        finish_trace(handle)
+
+
+# Function to run a function with a copy of the caller's context (current span included), for executors
+def bind(function):
+    context = contextvars.copy_context()
+
+    def bound(*args, **kwargs):
+        return context.run(function, *args, **kwargs)
+    return bound
+
+
+# Function to strip query strings (signed URLs carry credentials) before a URL goes into a span
+def safe_url(url):
+    return (url or "").split("?")[0]
+
+
+def _export(finished_span):
+    global _exporter
+    try:
+        _export_queue.put_nowait(finished_span)
+    except queue.Full:
+        with _lock:
+            _stats["dropped"] += 1
+        return
+    if _exporter is None:
+        with _lock:
+            if _exporter is None:
+                _exporter = threading.Thread(target=_export_loop, name="trace-exporter", daemon=True)
+                _exporter.start()
+
+
+def _span_record(finished_span):
+    return {
+        "trace_id": finished_span.trace_id,
+        "span_id": finished_span.span_id,
+        "parent_id": finished_span.parent_id,
+        "name": finished_span.name,
+        "start_time": finished_span.start_time,
+        "duration": round(finished_span.duration, 6),
+        "attributes": finished_span.attributes,
+        "error": finished_span.error
+    }
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(finished_span):
+    start = int(finished_span.start_time * 1e9)
+    otlp_span = {
+        "traceId": finished_span.trace_id,
+        "spanId": finished_span.span_id,
+        "name": finished_span.name,
+        "kind": 1,
+        "startTimeUnixNano": str(start),
+        "endTimeUnixNano": str(start + int(finished_span.duration * 1e9)),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in finished_span.attributes.items() if value is not None],
+        "status": {"code": 2, "message": finished_span.error} if finished_span.error else {"code": 1}
+    }
+    if finished_span.parent_id:
+        otlp_span["parentSpanId"] = finished_span.parent_id
+    return otlp_span
+
+
+# Function to write batches of finished spans to the trace file and the collector
+def _export_loop():
+    collector_session = requests.Session()
+    while True:
+        batch = [_export_queue.get()]
+        while len(batch) < trace_batch_size:
+            try:
+                batch.append(_export_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if trace_file:
+                with open(trace_file, 'a') as file:
+                    file.writelines(json.dumps(_span_record(finished_span), default=str) + "\n" for finished_span in batch)
+            if trace_collector_url:
+                collector_session.post(trace_collector_url, json={"resourceSpans": [{
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": trace_service_name}}]},
+                    "scopeSpans": [{"scope": {"name": "faceswap"}, "spans": [_otlp_span(finished_span) for finished_span in batch]}]
+                }]}, timeout=10).raise_for_status()
+            with _lock:
+                _stats["exported"] += len(batch)
+        except Exception as e:
+            with _lock:
+                _stats["export_errors"] += 1
+            print(f"Error exporting traces: {e}")
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+    result.update({"exporting": exporting, "queued": _export_queue.qsize(), "sample_rate": trace_sample_rate})
+    return result
+
+
+class Profile:
+    def __init__(self, path, interval, expires_at):
+        self.path = path
+        self.interval = interval
+        self.expires_at = expires_at
+        self.trace_id = None
+        self.worker_stacks = Counter()
+        self.worker_runs = 0
+        self.lock = threading.Lock()
+
+    # Function to start sampling the API threads bound to this request's trace
+    def start(self, trace_id):
+        self.trace_id = trace_id
+        self.sampler = profiler.Sampler(self.interval, watch=lambda ident: _thread_traces.get(ident) == trace_id).start()
+
+    def add_worker_stacks(self, stacks):
+        with self.lock:
+            self.worker_stacks.update(stacks)
+            self.worker_runs += 1
+
+    def finish(self, root):
+        api_stacks = self.sampler.stop()
+        os.makedirs(profile_path, exist_ok=True)
+        files = {"api": os.path.join(profile_path, f"{self.trace_id}-api.folded")}
+        profiler.write_folded(api_stacks, files["api"])
+        if self.worker_stacks:
+            files["worker"] = os.path.join(profile_path, f"{self.trace_id}-worker.folded")
+            profiler.write_folded(self.worker_stacks, files["worker"])
+        summary = {
+            "trace_id": self.trace_id,
+            "path": root.attributes.get("path"),
+            "status_code": root.attributes.get("status_code"),
+            "started_at": root.start_time,
+            "duration": round(root.duration, 3),
+            "interval": self.interval,
+            "api_samples": sum(api_stacks.values()),
+            "worker_samples": sum(self.worker_stacks.values()),
+            "worker_runs": self.worker_runs,
+            "files": files
+        }
+        with _lock:
+            _profiles[self.trace_id] = summary
+            for trace_id in list(_profiles)[:-profiles_kept]:
+                del _profiles[trace_id]
+
+
+def _take_armed(path):
+    global _armed
+    if _armed is None:
+        return None
+    with _lock:
+        if _armed is None:
+            return None
+        if _armed.expires_at < time.time():
+            _armed = None
+            return None
+        if _armed.path and _armed.path != path:
+            return None
+        profile, _armed = _armed, None
+        return profile
+
+
+# Function to get the profile of the current request, if it is being profiled
+def current_profile():
+    current = _current.get()
+    return current.profile if current else None
+
+
+# Function to check an admin request: it must carry ADMIN_TOKEN, or come from this machine when no token is set
+def _authorized():
+    if admin_token:
+        return hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), admin_token.encode())
+    try:
+        address = ipaddress.ip_address(request.remote_addr or "")
+    except ValueError:
+        return False
+    return (getattr(address, "ipv4_mapped", None) or address).is_loopback
+
+
+# Function to add the tracing hooks and the profiling admin endpoints to a service
+def register_routes(app):
+    @app.before_request
+    def start_trace():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        data = request.get_json(silent=True)
+        # A background job is profiled when it runs (see jobs._run_job), not in the request answering 202
+        background = request.args.get("async", "").lower() in ("1", "true") or (isinstance(data, dict) and data.get("async") is True)
+        g.trace = begin_trace(f"{request.method} {route}", request.path, request.headers.get("traceparent"), profiled=not background, method=request.method, route=route)
+
+    @app.after_request
+    def add_trace_header(response):
+        if g.get("trace"):
+            g.trace.root.set(status_code=response.status_code)
+            response.headers["X-Trace-Id"] = g.trace.root.trace_id
+        return response
+
+    @app.teardown_request
+    def end_trace(error=None):
+        if g.get("trace"):
+            finish_trace(g.trace, error)
+            g.trace = None
+
+    @app.route('/admin/profile', methods=['POST'])
+    def arm_profile():
+        global _armed
+        if not _authorized():
+            return jsonify({"error": "Invalid admin token"}), 403
+        data = request.get_json(silent=True) or {}
+        interval = data.get('interval', profile_interval)
+        expires_in = data.get('expires_in', 600)
+        if not isinstance(interval, (int, float)) or not 0.001 <= interval <= 1:
+            return jsonify({"error": "interval must be between 0.001 and 1 seconds"}), 400
+        if not isinstance(expires_in, (int, float)) or expires_in <= 0:
+            return jsonify({"error": "expires_in must be a positive number of seconds"}), 400
+        with _lock:
+            _armed = Profile(data.get('path'), interval, time.time() + expires_in)
+        return jsonify({"message": "Profiling armed for the next matching request", "path": data.get('path'), "interval": interval, "expires_in": expires_in}), 200
+
+    @app.route('/admin/profile', methods=['DELETE'])
+    def disarm_profile():
+        global _armed
+        if not _authorized():
+            return jsonify({"error": "Invalid admin token"}), 403
+        with _lock:
+            was_armed, _armed = _armed is not None, None
+        return jsonify({"message": "Profiling disarmed", "was_armed": was_armed}), 200
+
+    @app.route('/admin/profiles', methods=['GET'])
+    def list_profiles():
+        if not _authorized():
+            return jsonify({"error": "Invalid admin token"}), 403
+        with _lock:
+            profiles = list(_profiles.values())
+            armed = {"path": _armed.path, "interval": _armed.interval, "expires_at": _armed.expires_at} if _armed else None
+        return jsonify({"armed": armed, "profiles": profiles, "tracing": stats()}), 200
+
+    @app.route('/admin/profiles/<trace_id>/<part>', methods=['GET'])
+    def get_profile(trace_id, part):
+        if not _authorized():
+            return jsonify({"error": "Invalid admin token"}), 403
+        with _lock:
+            profile = _profiles.get(trace_id)
+        if not profile or part not in profile["files"]:
+            return jsonify({"error": "Profile not found"}), 404
+        with open(profile["files"][part]) as file:
+            return file.read(), 200, {"Content-Type": "text/plain; charset=utf-8"}
@@ -1,152 +1,200 @@
 from flask import Flask, request, jsonify
 import os
-import random
-import subprocess
-import requests
-import boto3
-from botocore.exceptions import NoCredentialsError
-import uuid
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import download_cache
+import face_registry
+import facefusion_pool
+import jobs
+import library_index
+import metrics
+import preflight
+import s3_uploader
+import scheduler
+import tracing
+import workspace
 
 app = Flask(__name__)
+jobs.register_routes(app)
+face_registry.register_routes(app)
+download_cache.register_routes(app)
+library_index.register_routes(app)
+scheduler.register_routes(app)
+metrics.register_routes(app)
+tracing.register_routes(app)
 
 # Define paths
 base_path = "/home/azureuser/facefusion/"
-faceswap_images_path = os.path.join(base_path, "faceswap-images")
-source_path = os.path.join(base_path, "source.jpg")
-target_path_template = os.path.join(base_path, "target_{}.jpg")
-output_path_template = os.path.join(base_path, "output_{}.jpg")
 script_path = os.path.join(base_path, "facefusion.py")
 
 # AWS configuration from environment variables
-aws_access_key = os.getenv("AWS_ACCESS_KEY")
-aws_secret_key = os.getenv("AWS_SECRET_KEY")
 s3_bucket_name = os.getenv("S3_BUCKET_NAME")
-aws_region = os.getenv("AWS_REGION")
 
-# Function to download images from URLs
+# Fan-out configuration from environment variables
+default_image_count = int(os.getenv("FIVE_IMAGES_COUNT", "5"))
+max_image_count = int(os.getenv("FIVE_IMAGES_MAX_COUNT", "10"))
+swap_workers = int(os.getenv("FIVE_IMAGES_SWAP_WORKERS", str(max(1, facefusion_pool.pool_size))))
+swap_executor = ThreadPoolExecutor(max_workers=swap_workers, thread_name_prefix="swap")
+
+class SwapError(Exception):
+    def __init__(self, message, details):
+        super().__init__(message)
+        self.details = details
+
+# Function to download images from URLs, reusing the local download cache when they haven't changed
 def download_image(url, file_path):
-    try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(file_path, 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            return True
-        else:
-            return False
-    except Exception as e:
-        print(f"Error downloading image: {e}")
-        return False
+    return download_cache.fetch(url, file_path) is not None
 
-# Function to upload file to S3
+# Function to start uploading a file to S3 on the shared client; returns a future resolving to its URL
 def upload_to_s3(file_path, bucket_name):
-    try:
-        unique_filename = f"{uuid.uuid4()}.jpg"
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
-            region_name=aws_region
-        )
-        s3_client.upload_file(file_path, bucket_name, unique_filename)
-        s3_url = f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{unique_filename}"
-        return s3_url
-    except NoCredentialsError:
-        raise Exception("AWS credentials not found")
-    except Exception as e:
-        raise Exception(f"Failed to upload to S3: {str(e)}")
+    return s3_uploader.upload_file(file_path, bucket_name, ".jpg")
 
-# Function to select random target images based on gender
+# Function to select random target images based on gender from the library index
 def select_target_images(gender, num_images):
-    gender_folder = os.path.join(faceswap_images_path, gender)
-    if not os.path.exists(gender_folder):
-        raise Exception(f"No folder found for gender: {gender}")
-    
-    images = [img for img in os.listdir(gender_folder) if img.lower().endswith(('.png', '.jpg', '.jpeg'))]
-    if len(images) < num_images:
-        raise Exception(f"Not enough images in {gender_folder} for {num_images} face swaps")
-    
-    selected_images = random.sample(images, num_images)  # Randomly select non-repeating images
-    return [os.path.join(gender_folder, img) for img in selected_images]
+    return library_index.sample(gender, num_images)
+
+# Function to swap the source face onto one selected target image, as its own span of the request's trace
+def swap_target_image(index, target_image_path, source_path, gender, request_workspace, roi=False):
+    with tracing.span("target", index=index, target_image=os.path.basename(target_image_path)):
+        return _swap_target_image(index, target_image_path, source_path, gender, request_workspace, roi)
+
+def _swap_target_image(index, target_image_path, source_path, gender, request_workspace, roi):
+    started = time.perf_counter()
+    target_path = request_workspace.file(f"target_{index}.jpg")
+    output_path = request_workspace.file(f"output_{index}.jpg")
+
+    # Copy the target image
+    shutil.copyfile(target_image_path, target_path)
+
+    # Construct the command
+    command = [
+        "python3", script_path, "headless-run",
+        "--source-paths", source_path,
+        "--target-path", target_path,
+        "--output-path", output_path,
+        "--processor", "face_swapper",
+        "--face-detector-model", "yoloface",
+        "--face-detector-size", "640x640",
+        "--face-detector-angles", "0", "90", "180", "270",
+        "--face-detector-score", "0.5",
+        "--face-landmarker-model", "2dfan4",
+        "--face-landmarker-score", "0.5",
+        "--face-selector-mode", "reference",
+        "--face-selector-order", "large-small",
+        "--face-selector-gender", gender,
+        "--face-selector-age-start", "0",
+        "--face-selector-age-end", "100",
+        "--reference-face-distance", "0.6",
+        "--face-mask-types", "box", "region",
+        "--face-mask-blur", "0.3",
+        "--face-mask-padding", "0", "0", "0", "0",
+        "--execution-providers", "cpu",
+        "--execution-thread-count", "4",
+        "--execution-queue-count", "1",
+        "--output-image-quality", "100",
+        "--output-image-resolution", "1920x1080",
+        "--log-level", "info",
+        "--skip-download"
+    ]
+
+    # Run the script
+    # Hand the worker the source faces and the library's precomputed target faces
+    faces = face_registry.seed_faces(command)
+    target_faces = library_index.target_faces(target_image_path)
+    if target_faces:
+        faces[target_path] = target_faces
+    process = facefusion_pool.run_facefusion(command, faces=faces, roi=roi)
+    if process.returncode != 0:
+        raise SwapError(f"Facefusion script failed for target image {index}", process.stderr)
+
+    return output_path, {
+        "index": index,
+        "target_image": os.path.basename(target_image_path),
+        "swap_seconds": round(time.perf_counter() - started, 3),
+        "face_detection": process.face_detection
+    }
 
 @app.route('/five-images-faceswap', methods=['POST'])
+@scheduler.admit("image")
+@jobs.async_job
 def face_swap():
+    request_workspace = workspace.Workspace()
     try:
+        # Per-request paths so concurrent requests don't overwrite each other's files
+        source_path = request_workspace.file("source.jpg")
         data = request.json
         source_url = data.get('source_url')
+        face_id = data.get('face_id')
         gender = data.get('gender')
+        # Large library images can be swapped region by region at their native resolution
+        roi = data.get('roi', facefusion_pool.face_regions_by_default)
 
-        if not source_url or not gender:
-            return jsonify({"error": "Source URL and gender are required"}), 400
+        if not (source_url or face_id) or not gender:
+            return jsonify({"error": "Source URL (or face_id) and gender are required"}), 400
+
+        if face_id and not face_registry.get(face_id):
+            return jsonify({"error": "Unknown face_id"}), 404
 
         # Download source image
-        if not download_image(source_url, source_path):
+        source_path = face_registry.resolve_source(source_url, face_id, source_path, download_image)
+        if not source_path:
             return jsonify({"error": "Failed to download source image"}), 500
 
-        # Select 3 unique target images based on gender
+        # Inputs without the faces the swap needs are answered before they reach FaceFusion
+        rejected = preflight.rejection([(face_registry.preflight_input(face_id, source_path), "source image", 1)], data.get('preflight', True))
+        if rejected:
+            body, status_code = rejected
+            return jsonify(body), status_code
+
+        # Sources downloaded by URL are registered once they passed, so the next request with the same image skips detection
+        face_registry.register_source(face_id, source_path)
+
+        image_count = data.get('count', default_image_count)
+        if not isinstance(image_count, int) or image_count < 1 or image_count > max_image_count:
+            return jsonify({"error": f"count must be an integer between 1 and {max_image_count}"}), 400
+
+        # Select unique target images based on gender
         try:
-            selected_target_images = select_target_images(gender, 5)
+            selected_target_images = select_target_images(gender, image_count)
         except Exception as e:
             return jsonify({"error": str(e)}), 500
 
-        output_s3_urls = []
-
-        # Perform face swaps for each target image
-        for i, target_image_path in enumerate(selected_target_images):
-            try:
-                # Define paths for the current iteration
-                current_target_path = target_path_template.format(i + 1)
-                current_output_path = output_path_template.format(i + 1)
-
-                # Copy the target image
-                os.system(f"cp '{target_image_path}' '{current_target_path}'")
-
-                # Construct the command
-                command = [
-                    "python3", script_path, "headless-run",
-                    "--source-paths", source_path,
-                    "--target-path", current_target_path,
-                    "--output-path", current_output_path,
-                    "--processor", "face_swapper",
-                    "--face-detector-model", "yoloface",
-                    "--face-detector-size", "640x640",
-                    "--face-detector-angles", "0", "90", "180", "270",
-                    "--face-detector-score", "0.5",
-                    "--face-landmarker-model", "2dfan4",
-                    "--face-landmarker-score", "0.5",
-                    "--face-selector-mode", "reference",
-                    "--face-selector-order", "large-small",
-                    "--face-selector-gender", gender,
-                    "--face-selector-age-start", "0",
-                    "--face-selector-age-end", "100",
-                    "--reference-face-distance", "0.6",
-                    "--face-mask-types", "box", "region",
-                    "--face-mask-blur", "0.3",
-                    "--face-mask-padding", "0", "0", "0", "0",
-                    "--execution-providers", "cpu",
-                    "--execution-thread-count", "4",
-                    "--execution-queue-count", "1",
-                    "--output-image-quality", "100",
-                    "--output-image-resolution", "1920x1080",
-                    "--log-level", "info",
-                    "--skip-download"
-                ]
-
-                # Run the script
-                process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                if process.returncode != 0:
-                    return jsonify({"error": f"Facefusion script failed for target image {i+1}", "details": process.stderr}), 500
-
-                # Upload the output image to S3
-                output_s3_url = upload_to_s3(current_output_path, s3_bucket_name)
-                output_s3_urls.append(output_s3_url)
-
-            except Exception as e:
-                return jsonify({"error": f"Failed on image {i+1}: {str(e)}"}), 500
-
-        return jsonify({"message": "Face swaps completed successfully", "output_s3_urls": output_s3_urls}), 200
+        # Run the swaps concurrently; each finished output starts uploading while the rest are still swapping
+        swap_futures = {
+            swap_executor.submit(tracing.bind(swap_target_image), i + 1, target_image_path, source_path, gender, request_workspace, roi): i
+            for i, target_image_path in enumerate(selected_target_images)
+        }
+        upload_futures = {}
+        try:
+            for swap_future in as_completed(swap_futures):
+                i = swap_futures[swap_future]
+                output_path, timing = swap_future.result()
+                upload_futures[i] = (upload_to_s3(output_path, s3_bucket_name), timing)
+
+            output_s3_urls = []
+            timings = []
+            for i in range(len(selected_target_images)):
+                upload_future, timing = upload_futures[i]
+                output_s3_urls.append(upload_future.result())
+                timing["upload_seconds"] = upload_future.upload_seconds
+                timings.append(timing)
+        except SwapError as e:
+            return jsonify({"error": str(e), "details": e.details}), 500
+        except Exception as e:
+            return jsonify({"error": f"Failed on image {i + 1}: {str(e)}"}), 500
+        finally:
+            # Don't let the workspace be removed underneath swaps or uploads that are still running
+            for future in swap_futures:
+                future.cancel()
+            wait(list(swap_futures) + [upload_future for upload_future, _ in upload_futures.values()])
+
+        return jsonify({"message": "Face swaps completed successfully", "output_s3_urls": output_s3_urls, "timings": timings}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        request_workspace.cleanup()
 
 if __name__ == '__main__':
+    facefusion_pool.prestart(reloader=True)
     app.run(debug=True, host='0.0.0.0', port=8013)
@@ -1,120 +1,166 @@
 from flask import Flask, request, jsonify
 import os
-import subprocess
-import requests
-import boto3
-from botocore.exceptions import NoCredentialsError
-import uuid
+import download_cache
+import face_registry
+import facefusion_pool
+import http_client
+import jobs
+import metrics
+import preflight
+import result_cache
+import s3_uploader
+import scheduler
+import tracing
+import video_chunks
+import workspace
 
 app = Flask(__name__)
+jobs.register_routes(app)
+face_registry.register_routes(app)
+download_cache.register_routes(app)
+result_cache.register_routes(app)
+scheduler.register_routes(app)
+metrics.register_routes(app)
+tracing.register_routes(app)
 
 # Define paths
 base_path = "/home/azureuser/facefusion/"
-source_path = os.path.join(base_path, "source.jpg")
-target_path = os.path.join(base_path, "target.mp4")  # Update to handle video
-output_path = os.path.join(base_path, "output.mp4")  # Update to handle video
 script_path = os.path.join(base_path, "facefusion.py")
 print("All paths are defined")
 # AWS configuration from environment variables
-aws_access_key = os.getenv("AWS_ACCESS_KEY")
-aws_secret_key = os.getenv("AWS_SECRET_KEY")
 s3_bucket_name = os.getenv("S3_BUCKET_NAME")
-aws_region = os.getenv("AWS_REGION")
 
-# Function to download files from URLs
+# Function to download files from URLs, reusing the local download cache when they haven't changed
 def download_file(url, file_path):
-    try:
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            with open(file_path, 'wb') as file:
-                for chunk in response.iter_content(1024):
-                    file.write(chunk)
-            return True
-        else:
-            return False
-    except Exception as e:
-        print(f"Error downloading file: {e}")
-        return False
+    return download_cache.fetch(url, file_path) is not None
 
-# Function to upload file to S3
-def upload_to_s3(file_path, bucket_name):
-    try:
-        # Generate a unique object name using UUID
-        unique_filename = f"{uuid.uuid4()}.mp4"  # Changed to `.mp4` for video
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
-            region_name=aws_region
-        )
-        s3_client.upload_file(file_path, bucket_name, unique_filename)
-        s3_url = f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{unique_filename}"
-        return s3_url
-    except NoCredentialsError:
-        raise Exception("AWS credentials not found")
-    except Exception as e:
-        raise Exception(f"Failed to upload to S3: {str(e)}")
+# Function to start uploading a file to S3 on the shared client; returns a future resolving to its URL.
+# With a result key the object name is deterministic and an object stored before isn't uploaded again.
+def upload_to_s3(file_path, bucket_name, key=None):
+    return s3_uploader.upload_file(file_path, bucket_name, ".mp4", key=key, skip_existing=key is not None)
+
+# Function to build the FaceFusion command for one swap
+def build_command(source_path, target_path, output_path):
+    return [
+        "python3", script_path, "headless-run",
+        "--source-paths", source_path,
+        "--target-path", target_path,
+        "--output-path", output_path,
+        "--processor", "face_swapper",
+        "--face-detector-model", "yoloface",
+        "--face-detector-size", "640x640",
+        "--face-detector-angles", "0", "90", "180", "270",
+        "--face-detector-score", "0.5",
+        "--face-landmarker-model", "2dfan4",
+        "--face-landmarker-score", "0.5",
+        "--face-selector-mode", "reference",
+        "--face-selector-order", "large-small",
+        "--face-selector-gender", "male",
+        "--face-selector-age-start", "0",
+        "--face-selector-age-end", "100",
+        "--reference-face-distance", "0.6",
+        "--face-mask-types", "box", "region",
+        "--face-mask-blur", "0.3",
+        "--face-mask-padding", "0", "0", "0", "0",
+        "--execution-providers", "cpu",
+        "--execution-thread-count", "4",
+        "--execution-queue-count", "1",
+        "--output-image-resolution", "1920x1080",
+        "--output-video-encoder", "libx264",
+        "--output-video-preset", "veryfast",
+        "--output-video-quality", "80",
+        "--output-video-resolution", "1920x1080",
+        "--output-video-fps", "30",
+        "--log-level", "info"
+    ]
 
 @app.route('/faceswap', methods=['POST'])
+@scheduler.admit("video")
+@jobs.async_job
 def face_swap():
+    request_workspace = workspace.Workspace()
     try:
+        # Per-request paths so concurrent requests don't overwrite each other's files
+        source_path = request_workspace.file("source.jpg")
+        target_path = request_workspace.file("target.mp4")
+        output_path = request_workspace.file("output.mp4")
         data = request.json
         source_url = data.get('source_url')
+        face_id = data.get('face_id')
         target_url = data.get('target_url')
 
-        if not source_url or not target_url:
-            return jsonify({"error": "Source and target URLs are required"}), 400
+        if not (source_url or face_id) or not target_url:
+            return jsonify({"error": "Source URL (or face_id) and target URL are required"}), 400
+
+        # Tracking mode: full face detection every few frames, optical flow in between
+        tracking = data.get('tracking', facefusion_pool.face_tracking_by_default)
+        if not isinstance(tracking, bool):
+            return jsonify({"error": "tracking must be true or false"}), 400
+
+        segment_seconds = data.get('segment_seconds')
+        parallelism = data.get('parallelism')
+        if segment_seconds is not None and (not isinstance(segment_seconds, (int, float)) or segment_seconds <= 0):
+            return jsonify({"error": "segment_seconds must be a positive number"}), 400
+        if parallelism is not None and (not isinstance(parallelism, int) or parallelism < 1):
+            return jsonify({"error": "parallelism must be a positive integer"}), 400
+
+        if face_id and not face_registry.get(face_id):
+            return jsonify({"error": "Unknown face_id"}), 404
 
-        # Download source image and target video
-        if not download_file(source_url, source_path):
+        # Download all inputs concurrently through the shared HTTP client
+        downloads = http_client.gather({
+            "source": (face_registry.resolve_source, source_url, face_id, source_path, download_file),
+            "target": (download_file, target_url, target_path)
+        })
+        source_path = downloads["source"]
+        if not source_path:
             return jsonify({"error": "Failed to download source image"}), 500
-        if not download_file(target_url, target_path):
+        if not downloads["target"]:
             return jsonify({"error": "Failed to download target video"}), 500
+
+        # Inputs without the faces the swap needs are answered before they reach FaceFusion
+        rejected = preflight.rejection([(face_registry.preflight_input(face_id, source_path), "source image", 1)], data.get('preflight', True))
+        if rejected:
+            body, status_code = rejected
+            return jsonify(body), status_code
+
+        # Sources downloaded by URL are registered once they passed, so the next request with the same image skips detection
+        face_registry.register_source(face_id, source_path)
         # Construct the command for FaceFusion
-        command = [
-            "python3", script_path, "headless-run",
-            "--source-paths", source_path,
-            "--target-path", target_path,
-            "--output-path", output_path,
-            "--processor", "face_swapper",
-            "--face-detector-model", "yoloface",
-            "--face-detector-size", "640x640",
-            "--face-detector-angles", "0", "90", "180", "270",
-            "--face-detector-score", "0.5",
-            "--face-landmarker-model", "2dfan4",
-            "--face-landmarker-score", "0.5",
-            "--face-selector-mode", "reference",
-            "--face-selector-order", "large-small",
-            "--face-selector-gender", "male",
-            "--face-selector-age-start", "0",
-            "--face-selector-age-end", "100",
-            "--reference-face-distance", "0.6",
-            "--face-mask-types", "box", "region",
-            "--face-mask-blur", "0.3",
-            "--face-mask-padding", "0", "0", "0", "0",
-            "--execution-providers", "cpu",
-            "--execution-thread-count", "4",
-            "--execution-queue-count", "1",
-            "--output-image-resolution", "1920x1080",
-	    "--output-video-encoder", "libx264",
-	    "--output-video-preset", "veryfast",
-	    "--output-video-quality", "80",
-	    "--output-video-resolution", "1920x1080",
-	    "--output-video-fps", "30",
-            "--log-level", "info"
-        ]
-
-        # Run the FaceFusion script
-        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if process.returncode != 0:
-            return jsonify({"error": "FaceFusion script failed", "details": process.stderr}), 500
-
-        # Upload the output video to S3 with a unique filename
-        output_s3_url = upload_to_s3(output_path, s3_bucket_name)
-
-        return jsonify({"message": "Face swap video completed successfully", "output_s3_url": output_s3_url}), 200
+        command = build_command(source_path, target_path, output_path)
+
+        # Identical requests (same inputs and options) share one run and its stored result
+        result_key = result_cache.result_key(result_cache.script_route(__file__), result_cache.file_hashes(source_path, target_path), command, tracking=data.get('tracking'), chunked=data.get('chunked'), segment_seconds=data.get('segment_seconds')) if data.get('cache', True) else None
+        with result_cache.coalesce(result_key) as result:
+            if result.body:
+                return jsonify(result.body), 200
+
+            # Chunked mode: split the target at keyframes and swap the segments on several workers at once
+            if data.get('chunked', video_chunks.chunked_by_default):
+                try:
+                    chunks = video_chunks.swap_video(command, target_path, output_path, request_workspace, segment_seconds, parallelism, tracking)
+                except video_chunks.ChunkError as e:
+                    return jsonify({"error": str(e), "details": e.details}), 500
+                # None means the video is a single segment; it is swapped as a whole below
+                if chunks:
+                    output_s3_url = upload_to_s3(output_path, s3_bucket_name, result_cache.output_key(result_key)).result()
+                    face_detection = chunks.pop("face_detection")
+                    return jsonify(result.store({"message": "Face swap video completed successfully", "output_s3_url": output_s3_url, "face_detection": face_detection, "chunks": chunks})), 200
+
+            # Run the FaceFusion script
+            process = facefusion_pool.run_facefusion(command, faces=face_registry.seed_faces(command), tracking=tracking)
+            if process.returncode != 0:
+                return jsonify({"error": "FaceFusion script failed", "details": process.stderr}), 500
+
+            # Upload the output video to S3 under its result key (a unique name when caching is off)
+            output_s3_url = upload_to_s3(output_path, s3_bucket_name, result_cache.output_key(result_key)).result()
+
+            return jsonify(result.store({"message": "Face swap video completed successfully", "output_s3_url": output_s3_url, "face_detection": process.face_detection})), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        request_workspace.cleanup()
 
 if __name__ == '__main__':
+    facefusion_pool.prestart(reloader=True)
     app.run(debug=True, host='0.0.0.0', port=7860)
@@ -0,0 +1,131 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import os
+import subprocess
+import time
+import face_registry
+import facefusion_pool
+import tracing
+
+# Chunk-parallel video swaps. The target is split at keyframes into segments without
+# re-encoding, each segment is swapped as its own headless-run on a pool worker, and the
+# swapped segments are concatenated and remuxed with the original audio stream, again without
+# re-encoding. A long video then keeps several workers busy instead of one.
+#
+# Every segment picks its reference face from its own first frame, so the mode is opt-in per
+# request ("chunked": true) unless VIDEO_CHUNKED_DEFAULT=1.
+
+ffmpeg_path = os.getenv("FFMPEG_PATH", "ffmpeg")
+chunked_by_default = os.getenv("VIDEO_CHUNKED_DEFAULT", "0") == "1"
+segment_seconds = float(os.getenv("VIDEO_SEGMENT_SECONDS", "10"))
+segment_parallelism = int(os.getenv("VIDEO_SEGMENT_PARALLELISM", str(max(1, facefusion_pool.pool_size))))
+
+
+class ChunkError(Exception):
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+def _ffmpeg(args, error_message):
+    process = subprocess.run([ffmpeg_path, "-y", "-loglevel", "error"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        raise ChunkError(error_message, process.stderr)
+
+
+# Function to split the video stream at keyframes; returns [(segment_path, start, end)]. File
+# names carry the request id because FaceFusion keys its temp frame directory on the target name.
+def split_video(target_path, directory, seconds, name_id):
+    list_path = os.path.join(directory, "segments.csv")
+    _ffmpeg([
+        "-i", target_path,
+        "-map", "0:v:0", "-an", "-c", "copy",
+        "-f", "segment", "-segment_time", str(seconds), "-reset_timestamps", "1",
+        "-segment_list", list_path, "-segment_list_type", "csv",
+        os.path.join(directory, f"segment-{name_id}-%04d.mp4")
+    ], "Failed to split the target video")
+    with open(list_path, newline='') as file:
+        return [(os.path.join(directory, name), float(start), float(end)) for name, start, end in csv.reader(file)]
+
+
+# Function to join the swapped segments and put the original audio back, copying every stream
+def join_segments(segment_paths, audio_source_path, output_path, directory):
+    list_path = os.path.join(directory, "concat.txt")
+    with open(list_path, "w") as file:
+        file.writelines(f"file '{segment_path}'\n" for segment_path in segment_paths)
+    video_path = os.path.join(directory, "joined.mp4")
+    _ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", video_path], "Failed to concatenate the swapped segments")
+    _ffmpeg([
+        "-i", video_path, "-i", audio_source_path,
+        "-map", "0:v:0", "-map", "1:a?", "-c", "copy", "-shortest",
+        output_path
+    ], "Failed to remux the original audio")
+
+
+# Function to point a headless-run command at another target and output
+def _segment_command(command, target_path, output_path):
+    command = list(command)
+    command[command.index("--target-path") + 1] = target_path
+    command[command.index("--output-path") + 1] = output_path
+    return command
+
+
+def _swap_segment(index, command, faces, tracking, segment_path, start, end):
+    # Only the file name is renamed; the workspace directory may contain "segment-" as well
+    output_path = os.path.join(os.path.dirname(segment_path), os.path.basename(segment_path).replace("segment-", "swapped-", 1))
+    started = time.perf_counter()
+    process = facefusion_pool.run_facefusion(_segment_command(command, segment_path, output_path), faces=faces, tracking=tracking)
+    if process.returncode != 0:
+        raise ChunkError(f"FaceFusion script failed on segment {index}", process.stderr)
+    return output_path, process.face_detection, {
+        "index": index,
+        "start_seconds": round(start, 3),
+        "duration_seconds": round(end - start, 3),
+        "swap_seconds": round(time.perf_counter() - started, 3)
+    }
+
+
+# Function to swap a video segment by segment; returns the timings, or None when the video is
+# too short to split and should be swapped as a whole. With tracking, every segment starts its
+# own tracker on its first keyframe.
+def swap_video(command, target_path, output_path, request_workspace, seconds=None, parallelism=None, tracking=False):
+    seconds = seconds or segment_seconds
+    directory = os.path.join(request_workspace.path, "segments")
+    os.makedirs(directory, exist_ok=True)
+
+    started = time.perf_counter()
+    segments = split_video(target_path, directory, seconds, request_workspace.id)
+    split_seconds = round(time.perf_counter() - started, 3)
+    if len(segments) < 2:
+        return None
+
+    # Segments run on at most this many pool workers at once; the rest wait for a free thread
+    parallelism = max(1, min(parallelism or segment_parallelism, len(segments)))
+    faces = face_registry.seed_faces(command)
+    started = time.perf_counter()
+    segment_executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="segment")
+    try:
+        futures = [
+            segment_executor.submit(tracing.bind(_swap_segment), index, command, faces, tracking, segment_path, start, end)
+            for index, (segment_path, start, end) in enumerate(segments)
+        ]
+        results = [future.result() for future in futures]
+    finally:
+        # On failure, drop the segments that haven't started and wait for the running ones
+        # so the workspace isn't removed underneath them
+        segment_executor.shutdown(wait=True, cancel_futures=True)
+    swap_seconds = round(time.perf_counter() - started, 3)
+
+    started = time.perf_counter()
+    join_segments([segment_output for segment_output, _, _ in results], target_path, output_path, directory)
+    join_seconds = round(time.perf_counter() - started, 3)
+
+    return {
+        "segment_seconds": seconds,
+        "parallelism": parallelism,
+        "split_seconds": split_seconds,
+        "swap_seconds": swap_seconds,
+        "join_seconds": join_seconds,
+        "segments": [timing for _, _, timing in results],
+        "face_detection": facefusion_pool.combine_detection(*[detection for _, detection, _ in results])
+    }
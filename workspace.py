@@ -0,0 +1,27 @@
+import os
+import shutil
+import tempfile
+import uuid
+
+# Per-request workspaces. Every request gets its own directory and its own file names, so
+# concurrent requests never overwrite each other's inputs and outputs. The file names are
+# unique too (not just the directory) because FaceFusion keys its temp frame directory on
+# the target file name.
+
+base_path = os.getenv("FACEFUSION_PATH", "/home/azureuser/facefusion/")
+workspace_root = os.getenv("WORKSPACE_ROOT", os.path.join(base_path, ".workspaces"))
+
+
+class Workspace:
+    def __init__(self):
+        os.makedirs(workspace_root, exist_ok=True)
+        self.id = uuid.uuid4().hex
+        self.path = tempfile.mkdtemp(prefix=f"{self.id}-", dir=workspace_root)
+
+    # Function to get a unique path inside the workspace, e.g. "source.jpg" -> ".../source-<id>.jpg"
+    def file(self, name):
+        stem, extension = os.path.splitext(name)
+        return os.path.join(self.path, f"{stem}-{self.id}{extension}")
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)